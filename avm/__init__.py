@@ -472,7 +472,7 @@ class AVM(SmartPlugin):
                      ('MyFritz', 'urn:dslforum-org:service:X_AVM-DE_MyFritz:1')])
 
     def __init__(self, smarthome, username='', password='', host='fritz.box', port='49443', ssl='True', verify='False',
-                 cycle=300, call_monitor='False', call_monitor_incoming_filter=''):
+                 cycle=300, call_monitor='False', call_monitor_incoming_filter='', host_list='True'):
         """
         Initalizes the plugin. The parameters describe for this method are pulled from the entry in plugin.conf.
 
@@ -485,6 +485,7 @@ class AVM(SmartPlugin):
         :param cycle:              Update cycle in seconds
         :param call_monitor:       bool: Shall the MonitoringService for the CallMonitor be started?
         :param call_monitor_incoming_filter:    Filter only specific numbers to be watched by call monitor
+        :param host_list:          bool: Update all network_device items from one host list per cycle?
         """
         self.logger = logging.getLogger(__name__)
         self.logger.info('Init AVM Plugin')
@@ -499,6 +500,9 @@ class AVM(SmartPlugin):
             urllib3.disable_warnings()
 
         self._fritz_device = FritzDevice(host, port, ssl, username, password, self.get_instance_name())
+        # one digest auth for the requests of the update cycle, so the nonce of the FritzDevice is reused
+        self._auth = HTTPDigestAuth(self._fritz_device.get_user(), self._fritz_device.get_password())
+        self._host_list = self.to_bool(host_list)
 
         self._call_monitor = self.to_bool(call_monitor)
         if self._call_monitor:
@@ -1345,69 +1349,137 @@ class AVM(SmartPlugin):
 
         :param item: item to be updated (Supported item avm_data_types: network_device, child item avm_data_types: device_ip, device_connection_type, device_hostname)
         """
-        url = self._build_url("/upnp/control/hosts")
-        headers = self._header.copy()
-
-        if self.get_iattr_value(item.conf, 'avm_data_type') == 'network_device':
-            if 'mac' not in item.conf:
-                self.logger.error("No mac attribute provided in network_device item")
-                return
-            action = 'GetSpecificHostEntry'
-            headers['SOAPACTION'] = "%s#%s" % (self._urn_map['Hosts'], action)
-            soap_data = self._assemble_soap_data(action, self._urn_map['Hosts'], {'NewMACAddress': item.conf['mac']})
-        else:
+        if self.get_iattr_value(item.conf, 'avm_data_type') != 'network_device':
             self.logger.error(
                 "Attribute %s not supported by plugin method" % self.get_iattr_value(item.conf, 'avm_data_type'))
             return
+        if 'mac' not in item.conf:
+            self.logger.error("No mac attribute provided in network_device item")
+            return
+
+        if self._host_list:
+            hosts = self._get_host_list()
+            if hosts is False:
+                # host list failed in this cycle, the items are updated again in the next cycle
+                return
+            if hosts is not None:
+                self._update_host_items(item, hosts.get(item.conf['mac'].upper()))
+                return
+
+        url = self._build_url("/upnp/control/hosts")
+        headers = self._header.copy()
+        action = 'GetSpecificHostEntry'
+        headers['SOAPACTION'] = "%s#%s" % (self._urn_map['Hosts'], action)
+        soap_data = self._assemble_soap_data(action, self._urn_map['Hosts'], {'NewMACAddress': item.conf['mac']})
 
         try:
             response = self._session.post(url, data=soap_data, timeout=self._timeout, headers=headers,
-                                          auth=HTTPDigestAuth(self._fritz_device.get_user(),
-                                                              self._fritz_device.get_password()), verify=self._verify)
+                                          auth=self._auth, verify=self._verify)
             xml = minidom.parseString(response.content)
         except Exception as e:
             self.logger.error("Exception when sending POST request: %s" % str(e))
             return
 
-        tag_content = xml.getElementsByTagName('NewActive')
-        if len(tag_content) > 0:
-            item(tag_content[0].firstChild.data)
-            for child in item.return_children():
-                if 'avm_data_type' in child.conf:
-                    if child.conf['avm_data_type'] == 'device_ip':
-                        device_ip = xml.getElementsByTagName('NewIPAddress')
-                        if len(device_ip) > 0:
-                            if not device_ip[0].firstChild is None:
-                                child(device_ip[0].firstChild.data)
-                            else:
-                                child('')
-                        else:
-                            self.logger.error(
-                                "Attribute %s not available on the FritzDevice" % self.get_iattr_value(item.conf,
-                                                                                                       'avm_data_type'))
-                    elif child.conf['avm_data_type'] == 'device_connection_type':
-                        device_connection_type = xml.getElementsByTagName('NewInterfaceType')
-                        if len(device_connection_type) > 0:
-                            if not device_connection_type[0].firstChild is None:
-                                child(device_connection_type[0].firstChild.data)
-                            else:
-                                child('')
-                        else:
-                            self.logger.error(
-                                "Attribute %s not available on the FritzDevice" % self.get_iattr_value(item.conf,
-                                                                                                       'avm_data_type'))
-                    elif child.conf['avm_data_type'] == 'device_hostname':
-                        data = self._get_value_from_xml_node(xml, 'NewHostName')
-                        if not data is None:
-                            child(data)
-                        else:
-                            self.logger.error(
-                                "Attribute %s not available on the FritzDevice" % self.get_iattr_value(item.conf,
-                                                                                                       'avm_data_type'))
-        else:
+        host = None
+        if len(xml.getElementsByTagName('NewActive')) > 0:
+            host = {
+                'name': self._get_value_from_xml_node(xml, 'NewHostName'),
+                'interface_type': self._get_value_from_xml_node(xml, 'NewInterfaceType'),
+                'ip_address': self._get_value_from_xml_node(xml, 'NewIPAddress'),
+                'is_active': self._get_value_from_xml_node(xml, 'NewActive')
+            }
+        self._update_host_items(item, host)
+
+    def _update_host_items(self, item, host):
+        """
+        Sets a network_device item and its child items
+
+        :param item: network_device item
+        :param host: dict of the host (keys as in get_host_details) or None if the MAC address is unknown
+        """
+        if host is None:
             item(0)
             self.logger.debug(
                 "MAC Address not available on the FritzDevice - ID: %s" % self._fritz_device.get_identifier())
+            return
+
+        item(host['is_active'])
+        for child in item.return_children():
+            if 'avm_data_type' in child.conf:
+                if child.conf['avm_data_type'] == 'device_ip':
+                    child(host['ip_address'] or '')
+                elif child.conf['avm_data_type'] == 'device_connection_type':
+                    child(host['interface_type'] or '')
+                elif child.conf['avm_data_type'] == 'device_hostname':
+                    if host['name'] is not None:
+                        child(host['name'])
+                    else:
+                        self.logger.error(
+                            "Attribute %s not available on the FritzDevice" % self.get_iattr_value(item.conf,
+                                                                                                   'avm_data_type'))
+
+    def _get_host_list(self):
+        """
+        Gets all hosts of the FritzDevice with one request per update cycle, cached in the response cache
+
+        Uses: http://avm.de/fileadmin/user_upload/Global/Service/Schnittstellen/hostsSCPD.pdf (X_AVM-DE_GetHostListPath)
+
+        :return: dict of the hosts (keys as in get_host_details) by upper case MAC address, None if the FritzDevice
+                 does not support the list, False if the list could not be requested in this cycle
+        """
+        if "host_list" in self._response_cache:
+            return self._response_cache["host_list"]
+        self._response_cache["host_list"] = False
+
+        url = self._build_url("/upnp/control/hosts")
+        headers = self._header.copy()
+        action = 'X_AVM-DE_GetHostListPath'
+        headers['SOAPACTION'] = "%s#%s" % (self._urn_map['Hosts'], action)
+        soap_data = self._assemble_soap_data(action, self._urn_map['Hosts'])
+        try:
+            response = self._session.post(url, data=soap_data, timeout=self._timeout, headers=headers,
+                                          auth=self._auth, verify=self._verify)
+            xml = minidom.parseString(response.content)
+        except Exception as e:
+            self.logger.error("Exception when sending POST request or parsing response: %s" % str(e))
+            return False
+
+        path = self._get_value_from_xml_node(xml, 'NewX_AVM-DE_HostListPath')
+        if path is None:
+            if self._get_value_from_xml_node(xml, 'errorCode') == '401':
+                # older firmware (UPnP Invalid Action): stay with one GetSpecificHostEntry request per network_device item
+                self.logger.warning("Host list not available on the FritzDevice - ID: %s, requesting every "
+                                    "network_device separately" % self._fritz_device.get_identifier())
+                self._host_list = False
+                self._response_cache["host_list"] = None
+                return None
+            self.logger.error("Host list path not in response of the FritzDevice - ID: %s, error code %s" % (
+                self._fritz_device.get_identifier(), self._get_value_from_xml_node(xml, 'errorCode')))
+            return False
+
+        try:
+            host_list_result = self._session.get(self._build_url(path), timeout=self._timeout, verify=self._verify)
+            host_list_xml = minidom.parseString(host_list_result.content)
+        except Exception as e:
+            self.logger.error("Exception when sending GET request or parsing response: %s" % str(e))
+            return False
+
+        hosts = dict()
+        for entry in host_list_xml.getElementsByTagName('Item'):
+            mac_address = self._get_value_from_xml_node(entry, 'MACAddress')
+            if mac_address is None:
+                continue
+            hosts[mac_address.upper()] = {
+                'name': self._get_value_from_xml_node(entry, 'HostName'),
+                'interface_type': self._get_value_from_xml_node(entry, 'InterfaceType'),
+                'ip_address': self._get_value_from_xml_node(entry, 'IPAddress'),
+                'address_source': self._get_value_from_xml_node(entry, 'AddressSource'),
+                'mac_address': mac_address,
+                'is_active': self._get_value_from_xml_node(entry, 'Active'),
+                'lease_time_remaining': self._get_value_from_xml_node(entry, 'LeaseTimeRemaining')
+            }
+        self._response_cache["host_list"] = hosts
+        return hosts
 
     def _update_home_automation(self, item):
         """
@@ -22,10 +22,17 @@
 #  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import os
 import re
+import sys
+import json
+import gzip
+import array
+import struct
 import logging
 import datetime
 import functools
+import collections
 import time
 import threading
 import lib.db
@@ -52,6 +59,11 @@ COL_LOG_VAL_NUM = 4
 COL_LOG_VAL_BOOL = 5
 COL_LOG_CHANGED = 6
 
+# Binary dump format: magic, then per chunk a block header (item id, number
+# of rows, length of item name) followed by the item name and the columns
+DUMP_BIN_MAGIC = b'SHNGDB\x01'
+DUMP_BIN_BLOCK = struct.Struct('<IIH')
+
 class Database(SmartPlugin):
 
     ALLOW_MULTIINSTANCE = True
@@ -65,27 +77,158 @@ class Database(SmartPlugin):
       '3' : ["CREATE UNIQUE INDEX {log}_{item}_id_time ON {log} (item_id, time);", "DROP INDEX {log}_{item}_id_time;"],
       '4' : ["CREATE INDEX {log}_{item}_id_changed ON {log} (item_id, changed);", "DROP INDEX {log}_{item}_id_changed;"],
       '5' : ["CREATE UNIQUE INDEX {item}_id ON {item} (id);", "DROP INDEX {item}_id;"],
-      '6' : ["CREATE INDEX {item}_name ON {item} (name);", "DROP INDEX {item}_name;"]
+      '6' : ["CREATE INDEX {item}_name ON {item} (name);", "DROP INDEX {item}_name;"],
+      '7' : ["CREATE TABLE {rollup} (time BIGINT, item_id INTEGER, step BIGINT, duration BIGINT, val_sum REAL, val_min REAL, val_max REAL, on_sum REAL);", "DROP TABLE {rollup};"],
+      '8' : ["CREATE UNIQUE INDEX {rollup}_item_id_step_time ON {rollup} (item_id, step, time);", "DROP INDEX {rollup}_item_id_step_time;"]
+    }
+
+    # Rollup of log entries into buckets of size "step": the duration of a
+    # log entry is split across all buckets it spans, open log entries without
+    # duration are skipped. Log entries are read starting with the last entry
+    # before the recalculated time, which may reach into its bucket.
+    _rollup_delete = "DELETE FROM {rollup} WHERE item_id = :id AND step = :step AND time >= :time;"
+    _rollup_insert = "INSERT INTO {rollup}(time, item_id, step, duration, val_sum, val_min, val_max, on_sum) VALUES (:time, :id, :step, :duration, :val_sum, :val_min, :val_max, :on_sum);"
+    _rollup_logs = (
+        "SELECT time, duration, val_num, val_bool FROM {log} WHERE item_id = :id AND duration IS NOT NULL AND "
+        "time >= (SELECT COALESCE(MAX(time), :time) FROM {log} WHERE item_id = :id AND time < :time) "
+        "ORDER BY time;"
+    )
+    # Rollup of buckets of size "step" from the buckets of a finer size "finer"
+    # dividing it, which have to be updated before
+    _rollup_aggregate = (
+        "INSERT INTO {rollup}(time, item_id, step, duration, val_sum, val_min, val_max, on_sum) "
+        "SELECT (time {div} :step) * :step, item_id, :step, SUM(duration), SUM(val_sum), MIN(val_min), MAX(val_max), SUM(on_sum) "
+        "FROM {rollup} WHERE item_id = :id AND step = :finer AND time >= :time "
+        "GROUP BY (time {div} :step) * :step, item_id;"
+    )
+
+    _insert_log = "INSERT INTO {log}(item_id, time, val_str, val_num, val_bool, duration, changed) VALUES (:id,:time,:val_str,:val_num,:val_bool,:duration,:changed);"
+    _update_log = "UPDATE {log} SET duration = :duration, val_str = :val_str, val_num = :val_num, val_bool = :val_bool, changed = :changed WHERE item_id = :id AND time = :time;"
+    _update_item = "UPDATE {item} SET time = :time, val_str = :val_str, val_num = :val_num, val_bool = :val_bool, changed = :changed WHERE id = :id;"
+
+    # Driver specific upsert of log entries (based on unique index on item_id
+    # and time), drivers not listed here will use a SELECT and UPDATE/INSERT
+    _upsert = {
+      'on_conflict' : "INSERT INTO {log}(item_id, time, val_str, val_num, val_bool, duration, changed) VALUES (:id,:time,:val_str,:val_num,:val_bool,:duration,:changed) "
+                      "ON CONFLICT (item_id, time) DO UPDATE SET duration = excluded.duration, val_str = excluded.val_str, val_num = excluded.val_num, val_bool = excluded.val_bool, changed = excluded.changed;",
+      'on_duplicate_key' : "INSERT INTO {log}(item_id, time, val_str, val_num, val_bool, duration, changed) VALUES (:id,:time,:val_str,:val_num,:val_bool,:duration,:changed) "
+                           "ON DUPLICATE KEY UPDATE duration = VALUES(duration), val_str = VALUES(val_str), val_num = VALUES(val_num), val_bool = VALUES(val_bool), changed = VALUES(changed);"
+    }
+    _upsert_drivers = {
+      'sqlite3' : 'on_conflict',
+      'psycopg2' : 'on_conflict',
+      'pymysql' : 'on_duplicate_key',
+      'MySQLdb' : 'on_duplicate_key'
+    }
+
+    # Driver specific insert of items, the next id is allocated within the
+    # insert statement and returned by the database ("returning") or by the
+    # driver ("lastrowid" using LAST_INSERT_ID(expr)), drivers not listed here
+    # will select the id of the inserted name
+    _insert_item = {
+      'returning' : "INSERT INTO {item}(id, name) SELECT COALESCE(MAX(id), 0) + 1, :name FROM {item} RETURNING id;",
+      'lastrowid' : "INSERT INTO {item}(id, name) SELECT LAST_INSERT_ID(COALESCE(MAX(id), 0) + 1), :name FROM {item};",
+      None : "INSERT INTO {item}(id, name) SELECT COALESCE(MAX(id), 0) + 1, :name FROM {item};"
+    }
+    _insert_item_drivers = {
+      'sqlite3' : 'returning',
+      'psycopg2' : 'returning',
+      'pymysql' : 'lastrowid',
+      'MySQLdb' : 'lastrowid'
+    }
+
+    # Driver specific integer division operator, "/" for all other drivers
+    _div_drivers = {
+      'pymysql' : 'DIV',
+      'MySQLdb' : 'DIV'
     }
 
-    def __init__(self, smarthome, driver, connect, prefix="", cycle=60):
+    # Downsampling of log entries older than :cutoff into buckets of size
+    # "step" (open log entries and buckets already downsampled are skipped)
+    _retention_buckets = (
+        "SELECT (time {div} :step) * :step, MIN(time), MAX(time), SUM(duration), SUM(val_num * duration), SUM(val_bool * duration) "
+        "FROM {log} WHERE item_id = :id AND time < :cutoff AND duration IS NOT NULL "
+        "GROUP BY (time {div} :step) * :step HAVING COUNT(*) > 1 "
+        "ORDER BY 1 LIMIT :limit;"
+    )
+    _retention_levels = {'raw': None, 'minutely': '1i', 'hourly': '1h', 'daily': '1d', 'weekly': '1w', 'monthly': '1m'}
+
+    # Time frames in milliseconds
+    _frames = {'i': 60 * 1000, 'h': 60 * 60 * 1000, 'd': 24 * 60 * 60 * 1000, 'w': 7 * 24 * 60 * 60 * 1000, 'm': 30 * 24 * 60 * 60 * 1000, 'y': 365 * 24 * 60 * 60 * 1000}
+
+    def __init__(self, smarthome, driver, connect, prefix="", cycle=60, rollup=None, retention_cycle=3600, retention_batch=1000, spool=None, spool_threshold=100):
         self._sh = smarthome
         self.logger = logging.getLogger(__name__)
         self._dump_cycle = int(cycle)
         self._name = self.get_instance_name()
-        self._replace = {table: table if prefix == "" else prefix + "_" + table for table in ["log", "item"]}
+        self._replace = {table: table if prefix == "" else prefix + "_" + table for table in ["log", "item", "rollup"]}
         self._replace['item_columns'] = ", ".join(COL_ITEM)
         self._replace['log_columns'] = ", ".join(COL_LOG)
+        self._replace['div'] = self._div_drivers.get(driver, '/')
         self._buffer = {}
         self._buffer_lock = threading.Lock()
         self._dump_lock = threading.Lock()
+        self._item_ids = {}
+        self._item_names = {}
+        self._upsert_log = self._upsert_statement(driver)
+        self._insert_item_id = self._insert_item_method(driver)
+        self._rollup = self._parse_rollup(rollup)
+        self._rollup_ready = set()
+        self._retention = {}
+        self._retention_batch = int(retention_batch)
+        self._spool = spool
+        self._spool_threshold = int(spool_threshold)
+        self._spool_chunk = 10000
+        self._spool_lock = threading.Lock()
+        self._spool_segment = None
+        self._spool_seq = 0
+        if self._spool is not None:
+            os.makedirs(self._spool, exist_ok=True)
 
         self._db = lib.db.Database(("" if prefix == "" else prefix.capitalize() + "_") + "Database", driver, connect)
         self._db.connect()
         self._db.setup({i: [self._prepare(query[0]), self._prepare(query[1])] for i, query in self._setup.items()})
+        self._load_item_ids()
 
         smarthome.scheduler.add('Database dump ' + self._name + ("" if prefix == "" else " [" + prefix + "]"), self._dump, cycle=self._dump_cycle, prio=5)
 
+        smarthome.scheduler.add('Database retention ' + self._name + ("" if prefix == "" else " [" + prefix + "]"), self._retention_cycle, cycle=int(retention_cycle), prio=5)
+
+        if self._rollup:
+            self._rollup_check()
+            if len(self._rollup_ready) != len(self._rollup):
+                smarthome.scheduler.add('Database rollup ' + self._name + ("" if prefix == "" else " [" + prefix + "]"), self._rollup_rebuild, prio=5, next=smarthome.now())
+
+    def _parse_rollup(self, rollup):
+        if rollup is None or rollup == '':
+            return []
+        if isinstance(rollup, str):
+            rollup = rollup.split('|')
+        sizes = set()
+        for size in rollup:
+            size = str(size).strip()
+            try:
+                sizes.add(int(float(size[:-1]) * self._frames[size[-1]]))
+            except:
+                self.logger.warning("Database: Unknown rollup size '{0}'".format(size))
+        return sorted(sizes)
+
+    def _upsert_statement(self, driver):
+        if driver not in self._upsert_drivers:
+            return None
+        if driver == 'sqlite3':
+            import sqlite3
+            if sqlite3.sqlite_version_info < (3, 24, 0):
+                return None
+        return self._upsert[self._upsert_drivers[driver]]
+
+    def _insert_item_method(self, driver):
+        if driver == 'sqlite3':
+            import sqlite3
+            if sqlite3.sqlite_version_info < (3, 35, 0):
+                return None
+        return self._insert_item_drivers.get(driver)
+
     def parse_item(self, item):
         if self.has_iattr(item.conf, 'database'):
             self._buffer_lock.acquire()
@@ -95,6 +238,11 @@ class Database(SmartPlugin):
             item.db = functools.partial(self._single, item=item.id())
             item.dbplugin = self
 
+            if self.has_iattr(item.conf, 'database_retention'):
+                retention = self._parse_retention(self.get_iattr_value(item.conf, 'database_retention'))
+                if retention:
+                    self._retention[item] = retention
+
             if self.get_iattr_value(item.conf, 'database') == 'init':
                 if not self._db.lock(5):
                     self.logger.error("Can not acquire lock for database to read value for item {}".format(item.id()))
@@ -142,33 +290,127 @@ class Database(SmartPlugin):
             # add current value with None duration
             self._buffer[item].append((end, None, item()))
 
-    def dump(self, dumpfile, id = None, time = None, time_start = None, time_end = None, changed = None, changed_start = None, changed_end = None, cur = None):
+            # move completed values to spool when buffer is growing too much
+            if self._spool is not None and len(self._buffer[item]) > self._spool_threshold:
+                self._buffer_lock.acquire()
+                tuples = self._buffer[item][:-1]
+                self._buffer[item] = self._buffer[item][len(tuples):]
+                self._buffer_lock.release()
+                if not self._spool_write([(item, tuples)]):
+                    self._restore([(item, tuples)])
+
+    def dump(self, dumpfile, id = None, time = None, time_start = None, time_end = None, changed = None, changed_start = None, changed_end = None, cur = None, format = 'csv', compress = None, chunk = 1000):
         self.logger.info("Starting file dump to {} ...".format(dumpfile))
+        started = datetime.datetime.now()
+
+        if format not in ('csv', 'bin'):
+            self.logger.error("Unknown dump format {}".format(format))
+            return
 
         item_ids = self.readItems(cur=cur) if id is None else [self.readItem(id, cur=cur)]
 
-        s = ';'
-        h = ['item_id', 'item_name', 'time', 'duration', 'val_str', 'val_num', 'val_bool', 'changed', 'time_date', 'changed_date']
-        f = open(dumpfile, 'w')
-        f.write(s.join(h) + "\n")
+        if compress is None:
+            compress = dumpfile.endswith('.gz')
+        mode = 'wt' if format == 'csv' else 'wb'
+        f = gzip.open(dumpfile, mode) if compress else open(dumpfile, mode)
+        if format == 'csv':
+            h = ['item_id', 'item_name', 'time', 'duration', 'val_str', 'val_num', 'val_bool', 'changed', 'time_date', 'changed_date']
+            f.write(';'.join(h) + "\n")
+        else:
+            f.write(DUMP_BIN_MAGIC)
+
+        rows = 0
         for item in item_ids:
             self.logger.debug("... dumping item {}/{}".format(item[1], item[0]))
 
-            rows = self.readLogs(item[0], time=time, time_start=time_start, time_end=time_end, changed=changed, changed_start=changed_start, changed_end=changed_end, cur=cur)
-
-            for row in rows:
-                cols = []
-                for key in [COL_ITEM_ID, COL_ITEM_NAME]:
-                    cols.append(item[key])
-                for key in [COL_LOG_TIME, COL_LOG_DURATION, COL_LOG_VAL_STR, COL_LOG_VAL_NUM, COL_LOG_VAL_BOOL, COL_LOG_CHANGED]:
-                    cols.append(row[key])
-                for key in [COL_ITEM_ID, COL_LOG_CHANGED]:
-                  cols.append('' if row[key] is None else datetime.datetime.fromtimestamp(row[key]/1000.0))
-                cols = map(lambda col: '' if col is None else col, cols)
-                cols = map(lambda col: str(col) if not '"' in str(col) else col.replace('"', '\\"'), cols)
-                f.write(s.join(cols) + "\n")
+            condition, params = self._slice_condition(item[0], time=time, time_start=time_start, time_end=time_end, changed=changed, changed_start=changed_start, changed_end=changed_end)
+            for logs in self._fetchchunks("SELECT {log_columns} FROM {log} WHERE " + condition, params, chunk, cur=cur):
+                if format == 'csv':
+                    self._dump_csv(f, item, logs)
+                else:
+                    self._dump_bin(f, item, logs)
+                rows += len(logs)
         f.close()
-        self.logger.info("File dump completed ({} items) ...".format(len(item_ids)))
+
+        duration = (datetime.datetime.now() - started).total_seconds()
+        self.logger.info("File dump completed ({} items, {} rows in {:.1f}s, {:.0f} rows/s) ...".format(len(item_ids), rows, duration, rows / duration if duration > 0 else rows))
+
+    def readDump(self, dumpfile):
+        """ Read a dump file created in the binary format and yield the rows as
+            tuples (item_id, item_name, time, duration, val_str, val_num, val_bool, changed).
+        """
+        f = gzip.open(dumpfile, 'rb') if dumpfile.endswith('.gz') else open(dumpfile, 'rb')
+        try:
+            if f.read(len(DUMP_BIN_MAGIC)) != DUMP_BIN_MAGIC:
+                raise ValueError("{} is not a binary database dump".format(dumpfile))
+            while True:
+                header = f.read(DUMP_BIN_BLOCK.size)
+                if len(header) == 0:
+                    break
+                (id, count, length) = DUMP_BIN_BLOCK.unpack(header)
+                name = f.read(length).decode('utf-8')
+                times = self._read_bin_column(f, 'q', count)
+                durations = self._read_bin_column(f, 'q', count)
+                lengths = self._read_bin_column(f, 'i', count)
+                strs = f.read(sum(length for length in lengths if length is not None)).decode('utf-8')
+                nums = self._read_bin_column(f, 'd', count)
+                bools = self._read_bin_column(f, 'b', count)
+                changes = self._read_bin_column(f, 'q', count)
+                pos = 0
+                for i in range(count):
+                    val_str = None
+                    if lengths[i] is not None:
+                        val_str = strs[pos:pos + lengths[i]]
+                        pos += lengths[i]
+                    yield (id, name, times[i], durations[i], val_str, nums[i], bools[i], changes[i])
+        finally:
+            f.close()
+
+    def _dump_csv(self, f, item, logs):
+        prefix = self._dump_csv_col(item[COL_ITEM_ID]) + ';' + self._dump_csv_col(item[COL_ITEM_NAME]) + ';'
+        fromtimestamp = datetime.datetime.fromtimestamp
+        lines = []
+        for row in logs:
+            cols = [row[COL_LOG_TIME], row[COL_LOG_DURATION], row[COL_LOG_VAL_STR], row[COL_LOG_VAL_NUM], row[COL_LOG_VAL_BOOL], row[COL_LOG_CHANGED],
+                    None if row[COL_LOG_TIME] is None else fromtimestamp(row[COL_LOG_TIME] / 1000.0),
+                    None if row[COL_LOG_CHANGED] is None else fromtimestamp(row[COL_LOG_CHANGED] / 1000.0)]
+            lines.append(prefix + ';'.join([self._dump_csv_col(col) for col in cols]))
+        f.write("\n".join(lines) + "\n")
+
+    def _dump_csv_col(self, col):
+        if col is None:
+            return ''
+        col = str(col)
+        return col if not '"' in col else col.replace('"', '\\"')
+
+    def _dump_bin(self, f, item, logs):
+        # Each chunk is written as block of columns: a null mask (one byte per
+        # row) followed by the little-endian values of the column
+        name = str(item[COL_ITEM_NAME]).encode('utf-8')
+        strs = [None if row[COL_LOG_VAL_STR] is None else str(row[COL_LOG_VAL_STR]).encode('utf-8') for row in logs]
+        f.write(DUMP_BIN_BLOCK.pack(item[COL_ITEM_ID], len(logs), len(name)) + name)
+        f.write(self._bin_column('q', [row[COL_LOG_TIME] for row in logs]))
+        f.write(self._bin_column('q', [row[COL_LOG_DURATION] for row in logs]))
+        f.write(self._bin_column('i', [None if val is None else len(val) for val in strs]))
+        f.write(b''.join([val for val in strs if val is not None]))
+        f.write(self._bin_column('d', [row[COL_LOG_VAL_NUM] for row in logs]))
+        f.write(self._bin_column('b', [row[COL_LOG_VAL_BOOL] for row in logs]))
+        f.write(self._bin_column('q', [row[COL_LOG_CHANGED] for row in logs]))
+
+    def _bin_column(self, typecode, values):
+        mask = bytes([val is None for val in values])
+        values = array.array(typecode, [0 if val is None else val for val in values])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return mask + values.tobytes()
+
+    def _read_bin_column(self, f, typecode, count):
+        mask = f.read(count)
+        values = array.array(typecode)
+        values.frombytes(f.read(count * values.itemsize))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return [None if mask[i] else values[i] for i in range(count)]
 
     def cleanup(self):
         items = [item.id() for item in self._buffer]
@@ -180,29 +422,52 @@ class Database(SmartPlugin):
             for item in self.readItems(cur=cur):
                 if item[COL_ITEM_NAME] not in items:
                     self.deleteItem(item[COL_ITEM_ID], cur=cur)
+            self._load_item_ids(cur=cur)
         except Exception as e:
             self.logger.error("Database cleanup failed: {}".format(e))
         cur.close()
         self._db.release()
 
     def id(self, item, create=True, cur=None):
-        id = self.readItem(str(item.id()), cur=cur)
+        name = str(item.id())
+        if name in self._item_ids:
+            return self._item_ids[name]
+
+        id = self.readItem(name, cur=cur)
 
         if id == None and create == True:
-            id = [self.insertItem(item.id(), cur)]
+            return self.insertItem(name, cur)
+
+        if id == None:
+            return None
+
+        self._map_item_id(name, int(id[COL_ITEM_ID]))
+        return int(id[COL_ITEM_ID])
 
-        return None if id == None else int(id[COL_ITEM_ID])
+    def name(self, id):
+        return self._item_names.get(id)
 
     def insertItem(self, name, cur=None):
-        id = self._fetchone("SELECT MAX(id) FROM {item};", cur=cur)
-        self._execute(self._prepare("INSERT INTO {item}(id, name) VALUES(:id, :name);"), {'id':1 if id[0] == None else id[0]+1, 'name':name}, cur=cur)
-        id = self._fetchone("SELECT id FROM {item} where name = :name;", {'name':name}, cur=cur)
-        return int(id[0])
+        params = {'name':name}
+        query = self._insert_item[self._insert_item_id]
+        if self._insert_item_id == 'returning':
+            id = self._fetchone(query, params, cur=cur)
+        elif self._insert_item_id == 'lastrowid':
+            id = self._query(self._execute_lastrowid, query, params, cur)
+            id = None if not id else [id]
+        else:
+            self._execute(query, params, cur=cur)
+            id = self._fetchone("SELECT MAX(id) FROM {item} WHERE name = :name;", params, cur=cur)
+        if id is None or id[0] is None:
+            return None
+        id = int(id[0])
+        self._map_item_id(name, id)
+        return id
 
     def updateItem(self, id, time, duration=0, val=None, it=None, changed=None, cur=None):
         params = {'id':id, 'time':time, 'changed':changed}
         params.update(self._item_value_tuple(it, val))
-        self._execute(self._prepare("UPDATE {item} SET time = :time, val_str = :val_str, val_num = :val_num, val_bool = :val_bool, changed = :changed WHERE id = :id;"), params, cur=cur)
+        self._execute(self._prepare(self._update_item), params, cur=cur)
 
     def readItem(self, id, cur=None):
         params = {'id':id}
@@ -216,17 +481,20 @@ class Database(SmartPlugin):
     def deleteItem(self, id, cur=None):
         params = {'id':id}
         self.deleteLog(id, cur=cur)
+        self._execute(self._prepare("DELETE FROM {rollup} WHERE item_id = :id;"), params, cur=cur)
         self._execute(self._prepare("DELETE FROM {item} WHERE id = :id;"), params, cur=cur)
+        if id in self._item_names:
+            del self._item_ids[self._item_names.pop(id)]
 
     def insertLog(self, id, time, duration=0, val=None, it=None, changed=None, cur=None):
         params = {'id':id, 'time':time, 'changed':changed, 'duration':duration}
         params.update(self._item_value_tuple(it, val))
-        self._execute(self._prepare("INSERT INTO {log}(item_id, time, val_str, val_num, val_bool, duration, changed) VALUES (:id,:time,:val_str,:val_num,:val_bool,:duration,:changed);"), params, cur=cur)
+        self._execute(self._prepare(self._insert_log), params, cur=cur)
 
     def updateLog(self, id, time, duration=0, val=None, it=None, changed=None, cur=None):
         params = {'id':id, 'time':time, 'changed':changed, 'duration':duration}
         params.update(self._item_value_tuple(it, val))
-        self._execute(self._prepare("UPDATE {log} SET duration = :duration, val_str = :val_str, val_num = :val_num, val_bool = :val_bool, changed = :changed WHERE item_id = :id AND time = :time;"), params, cur=cur)
+        self._execute(self._prepare(self._update_log), params, cur=cur)
 
     def readLog(self, id, time, cur = None):
         params = {'id':id, 'time':time}
@@ -239,6 +507,9 @@ class Database(SmartPlugin):
     def deleteLog(self, id, time = None, time_start = None, time_end = None, changed = None, changed_start = None, changed_end = None, cur = None):
         condition, params = self._slice_condition(id, time=time, time_start=time_start, time_end=time_end, changed=changed, changed_start=changed_start, changed_end=changed_end)
         self._execute(self._prepare("DELETE FROM {log} WHERE " + condition), params, cur=cur)
+        if self._rollup:
+            since = [ts for ts in [time, time_start] if ts is not None and changed is None and changed_start is None and changed_end is None]
+            self._rollup_update(id, since[0] if len(since) else 0, cur=cur)
 
     def _slice_condition(self, id, time = None, time_start = None, time_end = None, changed = None, changed_start = None, changed_end = None):
         params = {
@@ -297,7 +568,12 @@ class Database(SmartPlugin):
         if self._dump_lock.acquire(timeout=60) == False:
             self.logger.warning('Skipping dump, since other dump running!')
             return
+        try:
+            self._dump_locked(finalize, items)
+        finally:
+            self._dump_lock.release()
 
+    def _dump_locked(self, finalize, items):
         self.logger.debug('Starting dump')
 
         if items == None:
@@ -305,81 +581,512 @@ class Database(SmartPlugin):
             items = list(self._buffer.keys())
             self._buffer_lock.release()
 
+        # Take the buffered tuples of all items at once
+        dumps = []
+        self._buffer_lock.acquire()
         for item in items:
-            self._buffer_lock.acquire()
             tuples = self._buffer[item]
             self._buffer[item] = self._buffer[item][len(tuples):]
-            self._buffer_lock.release()
-
             if len(tuples) or finalize:
+                dumps.append((item, tuples))
+        self._buffer_lock.release()
 
-                # Test connectivity
-                if self._db.verify(5) == 0:
-                    self.logger.error("Database: Connection not recovered, skipping dump");
-                    self._dump_lock.release()
-                    return
+        if len(dumps) == 0 and not self._spool_pending():
+            self.logger.debug('Dump completed')
+            return
 
-                # Can't lock, restore data
-                if not self._db.lock(300):
-                    self._buffer_lock.acquire()
-                    if item in self._buffer:
-                        self._buffer[item] = tuples + self._buffer[item]
-                    else:
-                        self._buffer[item] = tuples
-                    self._buffer_lock.release()
-                    if finalize:
-                        self.logger.error("Database: can't dump {} items due to fail to acquire lock!".format(len(self._buffer)))
-                    else:
-                        self.logger.error("Database: can't dump {} items due to fail to acquire lock - will try on next dump".format(len(self._buffer)))
-                    self._dump_lock.release()
-                    return
+        # Test connectivity
+        if self._db.verify(5) == 0:
+            self.logger.error("Database: Connection not recovered, skipping dump");
+            self._spool_or_restore(dumps)
+            return
 
-                cur = None
-                try:
-                    changed = self._timestamp(self._sh.now())
+        # Can't lock, restore data
+        if not self._db.lock(300):
+            self._spool_or_restore(dumps)
+            if finalize:
+                self.logger.error("Database: can't dump {} items due to fail to acquire lock!".format(len(self._buffer)))
+            else:
+                self.logger.error("Database: can't dump {} items due to fail to acquire lock - will try on next dump".format(len(self._buffer)))
+            return
 
-                    # Get current values of item
-                    start = self._timestamp(item.last_change())
-                    end = changed
-                    val = item()
+        # Replay values spooled while database was not available, then dump
+        # the buffered values. Items failing to dump are spooled again, and so
+        # are their following values to keep them in order. Values which can't
+        # be spooled are restored to the buffer.
+        started = time.time()
+        changed = self._timestamp(self._sh.now())
+        failed = set()
+        try:
+            rows = self._spool_replay(self._spool_take(), changed, failed)
+            (count, unspooled) = self._dump_spooling_failed(dumps, finalize, changed, failed)
+            rows += count
+            self._restore(unspooled)
+        finally:
+            self._db.release()
 
-                    # When finalizing (e.g. plugin shutdown) add current value to item and log
-                    if finalize:
-                        _update = (end, val, changed)
+        duration = time.time() - started
+        self.logger.debug('Dump completed: {} rows of {} items in {:.3f}s ({:.0f} rows/s)'.format(rows, len(dumps), duration, rows / duration if duration > 0 else rows))
+
+    def _dump_spooling_failed(self, dumps, finalize, changed, failed):
+        """ Dump the tuples of the given items and add the items failing to dump
+            to "failed". Tuples of failed items are spooled (when configured).
+            Returns the number of written log rows and the items (with their
+            tuples) neither written nor spooled.
+        """
+        spool = [(item, tuples) for (item, tuples) in dumps if item in failed]
+        dumps = [(item, tuples) for (item, tuples) in dumps if item not in failed]
+        (rows, errors) = self._dump_transaction(dumps, finalize, changed)
+        failed.update(item for (item, tuples) in errors)
+        spool.extend(errors)
+        if self._spool is not None and self._spool_write(spool):
+            return (rows, [])
+        return (rows, spool)
+
+    def _dump_transaction(self, dumps, finalize, changed):
+        """ Dump the tuples of the given items in one transaction, falling back
+            to one transaction per item. Returns the number of written log rows
+            and the list of items (with their tuples) failed to dump.
+        """
+        if len(dumps) == 0:
+            return (0, [])
+        cur = None
+        try:
+            cur = self._db.cursor()
+            rows = self._dump_bulk(dumps, finalize, changed, cur)
+            cur.close()
+            cur = None
+            self._db.commit()
+            return (rows, [])
+        except Exception as e:
+            self.logger.warning("Database: bulk dump failed, falling back to dump items one by one: {}".format(e))
+            self._db.rollback()
+            if cur is not None:
+                cur.close()
+            self._reload_item_ids()
+        rows = 0
+        errors = []
+        for (item, tuples) in dumps:
+            count = self._dump_item(item, tuples, finalize, changed)
+            if count is None:
+                errors.append((item, tuples))
+            else:
+                rows += count
+        return (rows, errors)
+
+    def _dump_bulk(self, dumps, finalize, changed, cur):
+        """ Dump the tuples of all items within the current transaction using
+            the given cursor and return the number of written log rows.
+        """
+        logs = []
+        updates = []
+        rollups = []
+        for (item, tuples) in dumps:
+            id = self.id(item, cur=cur)
+            it = item.type()
+            (tuples, _update) = self._dump_tuples(item, tuples, finalize, changed)
+
+            for t in tuples:
+                params = {'id':id, 'time':t[0], 'duration':t[1], 'changed':changed}
+                params.update(self._item_value_tuple(it, t[2]))
+                logs.append(params)
+            rollups.append((id, self._rollup_since(tuples)))
+
+            params = {'id':id, 'time':_update[0], 'changed':_update[2]}
+            params.update(self._item_value_tuple(it, _update[1]))
+            updates.append(params)
+
+        if self._upsert_log is not None:
+            self._executemany(self._upsert_log, logs, cur)
+        else:
+            for params in logs:
+                if len(self._db.fetchall(self._prepare("SELECT {log_columns} FROM {log} WHERE item_id = :id AND time = :time;"), params, cur=cur)):
+                    self._db.execute(self._prepare(self._update_log), params, cur=cur)
+                else:
+                    self._db.execute(self._prepare(self._insert_log), params, cur=cur)
+        self._executemany(self._update_item, updates, cur)
+        for (id, since) in rollups:
+            if since is not None:
+                self._rollup_update(id, since, cur=cur, execute=self._db.execute)
+        return len(logs)
+
+    def _dump_item(self, item, tuples, finalize, changed):
+        """ Dump the tuples of a single item in its own transaction and return
+            the number of written log rows (None on failure).
+        """
+        cur = None
+        rows = 0
+        try:
+            (tuples, _update) = self._dump_tuples(item, tuples, finalize, changed)
 
-                        current = (start, end - start, val)
-                        tuples.append(current)
+            cur = self._db.cursor()
+            id = self.id(item, cur=cur)
 
-                    else:
-                        _update = (start, val, changed)
+            # Dump tuples
+            self.logger.debug('Dumping {}/{} with {} values'.format(item.id(), id, len(tuples)))
 
-                    cur = self._db.cursor()
-                    id = self.id(item, cur=cur)
+            for t in tuples:
+                if len(self.readLog(id, t[0], cur)):
+                    self.updateLog(id, t[0], t[1], t[2], item.type(), changed, cur)
+                else:
+                    self.insertLog(id, t[0], t[1], t[2], item.type(), changed, cur)
 
-                    # Dump tuples
-                    self.logger.debug('Dumping {}/{} with {} values'.format(item.id(), id, len(tuples)))
+            self.updateItem(id, _update[0], None, _update[1], item.type(), _update[2], cur)
 
-                    for t in tuples:
-                        if len(self.readLog(id, t[0], cur)):
-                            self.updateLog(id, t[0], t[1], t[2], item.type(), changed, cur)
-                        else:
-                            self.insertLog(id, t[0], t[1], t[2], item.type(), changed, cur)
+            since = self._rollup_since(tuples)
+            if since is not None:
+                self._rollup_update(id, since, cur=cur)
 
-                    self.updateItem(id, _update[0], None, _update[1], item.type(), _update[2], cur)
+            cur.close()
+            cur = None
 
+            self._db.commit()
+            rows = len(tuples)
+        except Exception as e:
+            self.logger.warning("Database: problem updating {}: {}".format(item.id(), e))
+            self._db.rollback()
+            self._reload_item_ids()
+            rows = None
+        finally:
+            if cur is not None:
+                cur.close()
+        return rows
+
+    def _dump_tuples(self, item, tuples, finalize, changed):
+        # Get current values of item
+        start = self._timestamp(item.last_change())
+        end = changed
+        val = item()
+
+        # When finalizing (e.g. plugin shutdown) add current value to item and log
+        if finalize:
+            _update = (end, val, changed)
+            tuples = tuples + [(start, end - start, val)]
+        else:
+            _update = (start, val, changed)
+
+        return (tuples, _update)
+
+    def _parse_retention(self, retention):
+        """ Parse retention policy (e.g. "30d raw, 2y hourly") into a list of
+            tuples (age, step) sorted by age, step is None for raw values.
+        """
+        if isinstance(retention, str):
+            retention = retention.split(',')
+        policy = []
+        for entry in retention:
+            try:
+                (age, level) = str(entry).split()
+                level = self._retention_levels.get(level, level)
+                step = None if level is None else int(float(level[:-1]) * self._frames[level[-1]])
+                policy.append((int(float(age[:-1]) * self._frames[age[-1]]), step))
+            except:
+                self.logger.warning("Database: Unknown retention policy '{0}'".format(entry))
+                return []
+        return sorted(policy)
+
+    def _retention_cycle(self):
+        """ Apply the retention policies of all items, using small batches to
+            not block dumps and queries for a long time.
+        """
+        now = self._timestamp(self._sh.now())
+        for (item, policy) in list(self._retention.items()):
+            id = self.id(item, create=False)
+            if id is None:
+                continue
+            for (i, (age, step)) in enumerate(policy):
+                cutoff = now - age
+                if i + 1 < len(policy):
+                    step = policy[i + 1][1]
+                    if step is None:
+                        continue
+                    cutoff = cutoff - cutoff % step
+                    batch = functools.partial(self._retention_downsample, id, item.type(), cutoff, step)
+                else:
+                    batch = functools.partial(self._retention_delete, id, cutoff)
+                rows = 0
+                while self.alive:
+                    count = self._retention_batch_run(batch)
+                    if not count:
+                        break
+                    rows += count
+                if rows:
+                    self.logger.debug("Database: Retention for {} processed {} rows older than {}".format(item.id(), rows, cutoff))
+
+    def _retention_batch_run(self, batch):
+        if not self._db.lock(60):
+            self.logger.error("Database: Can't apply retention due to fail to acquire lock")
+            return 0
+        cur = self._db.cursor()
+        count = 0
+        try:
+            count = batch(cur)
+            cur.close()
+            cur = None
+            self._db.commit()
+        except Exception as e:
+            self.logger.error("Database: Applying retention failed: {}".format(e))
+            self._db.rollback()
+            count = 0
+        finally:
+            if cur is not None:
+                cur.close()
+        self._db.release()
+        return count
+
+    def _retention_downsample(self, id, it, cutoff, step, cur):
+        # String values can not be downsampled, they are kept until deleted
+        if it not in ('num', 'bool'):
+            return 0
+        changed = self._timestamp(self._sh.now())
+        count = 0
+        buckets = self._db.fetchall(self._prepare(self._retention_buckets), {'id':id, 'cutoff':cutoff, 'step':step, 'limit':self._retention_batch}, cur=cur)
+        for (bucket, start, end, duration, val_sum, on_sum) in buckets:
+            params = {'id':id, 'time_start':start, 'time_end':end}
+            count += self._db.fetchone(self._prepare("SELECT COUNT(*) FROM {log} WHERE item_id = :id AND time >= :time_start AND time <= :time_end AND duration IS NOT NULL;"), params, cur=cur)[0]
+            self._db.execute(self._prepare("DELETE FROM {log} WHERE item_id = :id AND time >= :time_start AND time <= :time_end AND duration IS NOT NULL;"), params, cur=cur)
+            val = None if not duration else val_sum / duration
+            params = {'id':id, 'time':start, 'duration':duration, 'changed':changed,
+                      'val_str':None, 'val_num':val, 'val_bool':int(bool(duration) and on_sum / duration >= 0.5)}
+            self._db.execute(self._prepare(self._insert_log), params, cur=cur)
+        return count
+
+    def _retention_delete(self, id, cutoff, cur):
+        params = {'id':id, 'cutoff':cutoff, 'limit':self._retention_batch}
+        times = self._db.fetchall(self._prepare("SELECT time FROM {log} WHERE item_id = :id AND time < :cutoff ORDER BY time LIMIT :limit;"), params, cur=cur)
+        if not times:
+            self._db.execute(self._prepare("DELETE FROM {rollup} WHERE item_id = :id AND time < :cutoff;"), params, cur=cur)
+            return 0
+        params['time_end'] = times[-1][0]
+        self._db.execute(self._prepare("DELETE FROM {log} WHERE item_id = :id AND time < :cutoff AND time <= :time_end;"), params, cur=cur)
+        return len(times)
+
+    def _rollup_since(self, tuples):
+        times = [t[0] for t in tuples if t[1] is not None]
+        return min(times) if len(times) else None
+
+    def _rollup_update(self, id, since, cur, execute=None):
+        """ Recalculate the rollup buckets of the given item starting with the
+            bucket containing the timestamp "since". Only the sizes without a
+            finer size dividing them are read from the log, the others are
+            aggregated from the buckets of the finer size.
+        """
+        if not self._rollup:
+            return
+        if execute is None:
+            execute = lambda query, params, cur: self._execute(query, params, cur=cur)
+        since = {step: since - since % step for step in self._rollup}
+        finer = {}
+        for step in self._rollup:
+            sizes = [size for size in finer if step % size == 0]
+            finer[step] = sizes[-1] if len(sizes) else None
+        logs = [step for step in self._rollup if finer[step] is None]
+        buckets = {step: {} for step in logs}
+        for rows in self._fetchchunks(self._rollup_logs, {'id':id, 'time':min(since[step] for step in logs)}, 1000, cur=cur):
+            for (time, duration, val_num, val_bool) in rows:
+                for step in logs:
+                    self._rollup_split(buckets[step], step, since[step], time, duration, val_num, val_bool)
+        for step in logs:
+            execute(self._prepare(self._rollup_delete), {'id':id, 'step':step, 'time':since[step]}, cur=cur)
+            for (bucket, values) in sorted(buckets[step].items()):
+                params = {'id':id, 'step':step, 'time':bucket}
+                params.update(values)
+                execute(self._prepare(self._rollup_insert), params, cur=cur)
+        for step in self._rollup:
+            if finer[step] is not None:
+                execute(self._prepare(self._rollup_delete), {'id':id, 'step':step, 'time':since[step]}, cur=cur)
+                execute(self._prepare(self._rollup_aggregate), {'id':id, 'step':step, 'finer':finer[step], 'time':since[step]}, cur=cur)
+
+    def _rollup_split(self, buckets, step, since, time, duration, val_num, val_bool):
+        # Add the parts of a log entry after "since" to the buckets it spans
+        start = max(time, since)
+        end = time + duration
+        if start > end or (start == end and time < since):
+            return
+        bucket = start - start % step
+        while True:
+            part = min(bucket + step, end) - start
+            values = buckets.setdefault(bucket, {'duration':0, 'val_sum':None, 'val_min':None, 'val_max':None, 'on_sum':None})
+            values['duration'] += part
+            if val_num is not None:
+                values['val_sum'] = (values['val_sum'] or 0) + val_num * part
+                values['val_min'] = val_num if values['val_min'] is None else min(values['val_min'], val_num)
+                values['val_max'] = val_num if values['val_max'] is None else max(values['val_max'], val_num)
+            if val_bool is not None:
+                values['on_sum'] = (values['on_sum'] or 0) + int(val_bool) * part
+            bucket += step
+            start = bucket
+            if start >= end:
+                break
+
+    def _rollup_check(self):
+        # Rollups are ready to use when rows exist or no logs are available at all
+        logs = self._fetchone("SELECT COUNT(*) FROM {log};")
+        for step in self._rollup:
+            rows = self._fetchone("SELECT COUNT(*) FROM {rollup} WHERE step = :step;", {'step':step})
+            if (rows is not None and rows[0] > 0) or (logs is not None and logs[0] == 0):
+                self._rollup_ready.add(step)
+
+    def _rollup_rebuild(self):
+        """ Rebuild all rollups from the log table, one transaction per item to
+            not block dumps and queries for a long time.
+        """
+        self.logger.info("Database: Rebuilding rollups ...")
+        for id in list(self._item_names.keys()):
+            if not self._db.lock(300):
+                self.logger.error("Database: Can't rebuild rollups due to fail to acquire lock")
+                return
+            cur = self._db.cursor()
+            try:
+                self._rollup_update(id, 0, cur=cur, execute=self._db.execute)
+                cur.close()
+                cur = None
+                self._db.commit()
+            except Exception as e:
+                self.logger.error("Database: Rebuilding rollups for item {} failed: {}".format(id, e))
+                self._db.rollback()
+                if cur is not None:
                     cur.close()
-                    cur = None
-
-                    self._db.commit()
-                except Exception as e:
-                    self.logger.warning("Database: problem updating {}: {}".format(item.id(), e))
-                    self._db.rollback()
-                finally:
-                    if cur is not None:
-                        cur.close()
                 self._db.release()
-        self.logger.debug('Dump completed')
-        self._dump_lock.release()
+                return
+            self._db.release()
+        self._rollup_ready = set(self._rollup)
+        self.logger.info("Database: Rebuilding rollups completed")
+
+    def _rollup_size(self, step):
+        sizes = [size for size in self._rollup if size <= step and size in self._rollup_ready]
+        return sizes[-1] if len(sizes) else None
+
+    def _spool_or_restore(self, dumps):
+        if self._spool is None or not self._spool_write(dumps):
+            self._restore(dumps)
+
+    def _spool_write(self, dumps):
+        """ Append the tuples of the given items to the current spool segment
+        """
+        lines = [json.dumps({'item': item.id(), 'tuples': tuples}, default=str) for (item, tuples) in dumps if len(tuples)]
+        if len(lines) == 0:
+            return True
+        written = False
+        self._spool_lock.acquire()
+        try:
+            if self._spool_segment is None:
+                self._spool_seq += 1
+                self._spool_segment = os.path.join(self._spool, 'database_{:016d}_{:06d}.spool'.format(int(time.time() * 1000), self._spool_seq))
+            with open(self._spool_segment, 'a') as f:
+                f.write("\n".join(lines) + "\n")
+            written = True
+        except Exception as e:
+            self.logger.error("Database: Writing spool segment {} failed: {}".format(self._spool_segment, e))
+        finally:
+            self._spool_lock.release()
+        return written
+
+    def _spool_segments(self):
+        if self._spool is None:
+            return []
+        try:
+            names = os.listdir(self._spool)
+        except OSError as e:
+            self.logger.error("Database: Reading spool directory {} failed: {}".format(self._spool, e))
+            return []
+        return sorted([os.path.join(self._spool, name) for name in names if name.endswith('.spool')])
+
+    def _spool_pending(self):
+        return len(self._spool_segments()) > 0
+
+    def _spool_take(self):
+        # Close current segment, new values will be spooled to a new segment
+        self._spool_lock.acquire()
+        segments = self._spool_segments()
+        self._spool_segment = None
+        self._spool_lock.release()
+        return segments
+
+    def _spool_replay(self, segments, changed, failed):
+        """ Replay the spooled tuples segment by segment in chunks of at most
+            "_spool_chunk" tuples, each in its own transaction. A segment is
+            removed once all of its tuples are written or spooled again.
+        """
+        rows = 0
+        for segment in segments:
+            complete = True
+            spooled = 0
+            for dumps in self._spool_read(segment):
+                (count, unspooled) = self._dump_spooling_failed(dumps, False, changed, failed)
+                rows += count
+                if len(unspooled):
+                    complete = False
+                spooled += sum(len(tuples) for (item, tuples) in dumps)
+            self.logger.info("Database: Replayed {} spooled values of segment {}".format(spooled, segment))
+            if complete:
+                self._spool_remove(segment)
+        return rows
+
+    def _spool_read(self, segment):
+        """ Read spooled tuples from the given segment and yield them merged by
+            item in chunks of at most "_spool_chunk" tuples (or one line).
+        """
+        merged = collections.OrderedDict()
+        count = 0
+        with open(segment, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    self.logger.warning("Database: Skipping invalid entry in spool segment {}".format(segment))
+                    continue
+                item = self._sh.return_item(entry['item'])
+                if item is None or item not in self._buffer:
+                    self.logger.warning("Database: Skipping spooled values of unknown item {}".format(entry['item']))
+                    continue
+                if count and count + len(entry['tuples']) > self._spool_chunk:
+                    yield list(merged.items())
+                    merged = collections.OrderedDict()
+                    count = 0
+                merged.setdefault(item, []).extend([tuple(t) for t in entry['tuples']])
+                count += len(entry['tuples'])
+        if count:
+            yield list(merged.items())
+
+    def _spool_remove(self, segment):
+        try:
+            os.remove(segment)
+        except OSError as e:
+            self.logger.error("Database: Removing spool segment {} failed: {}".format(segment, e))
+
+    def _restore(self, dumps):
+        self._buffer_lock.acquire()
+        for (item, tuples) in dumps:
+            if item in self._buffer:
+                self._buffer[item] = tuples + self._buffer[item]
+            else:
+                self._buffer[item] = tuples
+        self._buffer_lock.release()
+
+    def _load_item_ids(self, cur=None):
+        """ Load the mapping of item names to ids (and vice versa) from the
+            item table, which is used for all lookups of item ids afterwards.
+        """
+        ids = {}
+        names = {}
+        for (id, name) in self._fetchall("SELECT id, name FROM {item};", cur=cur) or []:
+            ids[name] = int(id)
+            names[int(id)] = name
+        self._item_ids = ids
+        self._item_names = names
+
+    def _reload_item_ids(self):
+        # Reload mapping after rollback (requires database lock)
+        cur = self._db.cursor()
+        try:
+            self._load_item_ids(cur=cur)
+        finally:
+            cur.close()
+
+    def _map_item_id(self, name, id):
+        self._item_ids[name] = id
+        self._item_names[id] = name
 
     def _series(self, func, start, end='now', count=100, ratio=1, update=False, step=None, sid=None, item=None):
         init = not update
@@ -393,11 +1100,17 @@ class Database(SmartPlugin):
             'on'  : 'MIN(time), ROUND(SUM(val_bool * duration) / SUM(duration), 2)',
             'on.order' : 'ORDER BY time ASC'
         }
+        rollups = {
+            'avg' : 'MIN(time), ROUND(SUM(val_sum) / SUM(duration), 2)',
+            'min' : 'MIN(time), MIN(val_min)',
+            'max' : 'MIN(time), MAX(val_max)',
+            'on'  : 'MIN(time), ROUND(SUM(on_sum) / SUM(duration), 2)'
+        }
         if func not in queries:
             raise NotImplementedError
 
         order = '' if func+'.order' not in queries else queries[func+'.order']
-        logs = self._fetch_log(item, queries[func], start, end, step=step, count=count, group="GROUP BY ROUND(time / :step)", order=order)
+        logs = self._fetch_log(item, queries[func], start, end, step=step, count=count, group="GROUP BY ROUND(time / :step)", order=order, rollup=rollups[func])
         tuples = logs['tuples']
         if tuples:
             if logs['istart'] > tuples[0][0]:
@@ -429,15 +1142,21 @@ class Database(SmartPlugin):
             'max' : 'MAX(val_num)',
             'on'  : 'ROUND(SUM(val_bool * duration) / SUM(duration), 2)'
         }
+        rollups = {
+            'avg' : 'ROUND(SUM(val_sum) / SUM(duration), 2)',
+            'min' : 'MIN(val_min)',
+            'max' : 'MAX(val_max)',
+            'on'  : 'ROUND(SUM(on_sum) / SUM(duration), 2)'
+        }
         if func not in queries:
             self.logger.warning("Unknown export function: {0}".format(func))
             return
-        logs = self._fetch_log(item, queries[func], start, end)
+        logs = self._fetch_log(item, queries[func], start, end, rollup=rollups[func])
         if logs['tuples'] is None:
             return
         return logs['tuples'][0][0]
 
-    def _fetch_log(self, item, columns, start, end, step=None, count=100, group='', order=''):
+    def _fetch_log(self, item, columns, start, end, step=None, count=100, group='', order='', rollup=None):
         _item = self._sh.return_item(item)
 
         istart = self._parse_ts(start)
@@ -458,6 +1177,19 @@ class Database(SmartPlugin):
             self._dump(items=[_item])
 
         params = {'id':id, 'time_start':istart, 'time_end':iend, 'inow':inow, 'step':step}
+
+        # Use the coarsest rollup satisfying the requested step
+        size = None if rollup is None else self._rollup_size(step)
+        if size is not None:
+            return {
+                'tuples' : self._fetchall(self._rollup_query(rollup, size, group, order, params), params),
+                'item'   : _item,
+                'istart' : istart,
+                'iend'   : iend,
+                'step'   : step,
+                'count'  : count
+            }
+
         duration_now = "COALESCE(duration, :inow - time)"
 
         # Duration calculation (S=Start, E=End):
@@ -505,6 +1237,73 @@ class Database(SmartPlugin):
             'count'  : count
         }
 
+    def _rollup_query(self, columns, size, group, order, params):
+        """ Build the query of the given columns using the rollup buckets within
+            start and end and the parts of log entries not covered by buckets:
+            before the first and after the last bucket and the open log entry.
+            All parts are weighted by their duration between start and end and
+            are grouped by the time they start.
+        """
+        params['size'] = size
+        params['core_start'] = params['time_start'] + (-params['time_start']) % size
+        params['core_end'] = params['time_end'] - params['time_end'] % size
+        if params['core_end'] < params['core_start']:
+            params['core_start'] = params['core_end'] = params['time_start']
+
+        def least(a, b):
+            return "(CASE WHEN {0} < {1} THEN {0} ELSE {1} END)".format(a, b)
+
+        def greatest(a, b):
+            return "(CASE WHEN {0} > {1} THEN {0} ELSE {1} END)".format(a, b)
+
+        def part(start, end, condition):
+            duration = "(" + least("COALESCE(time + duration, :inow)", end) + " - " + greatest("time", start) + ")"
+            return (
+                "SELECT " + greatest("time", start) + " AS time, " + duration + " AS duration, "
+                "val_num * " + duration + " AS val_sum, val_num AS val_min, val_num AS val_max, val_bool * " + duration + " AS on_sum "
+                "FROM {log} WHERE item_id = :id AND " + condition + " AND " + duration + " > 0"
+            )
+
+        return (
+            "SELECT " + columns + " FROM ("
+            "SELECT time, duration, val_sum, val_min, val_max, on_sum FROM {rollup} WHERE "
+            "item_id = :id AND step = :size AND time >= :core_start AND time < :core_end "
+            "UNION ALL " +
+            part(":time_start", ":core_start",
+                 "time >= (SELECT COALESCE(MAX(time), 0) FROM {log} WHERE item_id = :id AND time < :time_start) AND time < :core_start") +
+            " UNION ALL " +
+            part(":core_start", ":core_end",
+                 "time = (SELECT MAX(time) FROM {log} WHERE item_id = :id AND time < :core_end) AND duration IS NULL") +
+            " UNION ALL " +
+            part(":core_end", ":time_end",
+                 "time >= (SELECT COALESCE(MAX(time), 0) FROM {log} WHERE item_id = :id AND time < :core_end) AND time <= :time_end") +
+            ") rollup_parts " + group + " " + order
+        )
+
+    def _fetchchunks(self, query, params, size, cur=None):
+        """ Execute query and yield the resulting rows in chunks of the given
+            size using a dedicated cursor (the lock is held while iterating,
+            when no cursor is given).
+        """
+        if cur is None:
+            if self._db.verify(5) == 0:
+                self.logger.error("Database: Connection not recovered")
+                return
+            if not self._db.lock(300):
+                self.logger.error("Database: Can't query due to fail to acquire lock")
+                return
+        c = self._db.cursor()
+        try:
+            self._db.execute(self._prepare(query), params, cur=c)
+            rows = c.fetchmany(size)
+            while rows:
+                yield rows
+                rows = c.fetchmany(size)
+        finally:
+            c.close()
+            if cur is None:
+                self._db.release()
+
     def _fetchone(self, query, params={}, cur=None):
         tuples = self._query(self._db.fetchone, query, params, cur)
         return tuples
@@ -516,6 +1315,20 @@ class Database(SmartPlugin):
     def _execute(self, query, params, cur=None):
         self._query(self._db.execute, query, params, cur)
 
+    def _executemany(self, query, params_list, cur):
+        query = self._prepare(query)
+        for params in params_list:
+            self._db.execute(query, params, cur=cur)
+
+    def _execute_lastrowid(self, query, params, cur=None):
+        c = self._db.cursor() if cur is None else cur
+        try:
+            self._db.execute(query, params, cur=c)
+            return c.lastrowid
+        finally:
+            if cur is None:
+                c.close()
+
     def _query(self, func, query, params, cur=None):
         if cur is None:
             if self._db.verify(5) == 0:
@@ -537,14 +1350,7 @@ class Database(SmartPlugin):
         return tuples
 
     def _parse_ts(self, frame):
-        minute = 60 * 1000
-        hour = 60 * minute
-        day = 24 * hour
-        week = 7 * day
-        month = 30 * day
-        year = 365 * day
-
-        _frames = {'i': minute, 'h': hour, 'd': day, 'w': week, 'm': month, 'y': year}
+        _frames = self._frames
         try:
             return int(frame)
         except:
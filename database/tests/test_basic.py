@@ -1,4 +1,5 @@
 import os
+import gzip
 import datetime
 import tempfile
 
@@ -23,6 +24,20 @@ class TestDatabaseBasic(TestDatabaseBase):
         plugin = self.plugin()
         self.assertEqual(1, plugin.insertItem('manually.inserted'))
 
+    def test_insertItem_allocates_next_id(self):
+        plugin = self.plugin()
+        plugin.insertItem('manually.first')
+        plugin.deleteItem(plugin.insertItem('manually.deleted'))
+        self.assertEqual(2, plugin.insertItem('manually.second'))
+        self.assertEqual('manually.second', plugin.name(2))
+
+    def test_insertItem_without_driver_specific_insert(self):
+        plugin = self.plugin()
+        plugin._insert_item_id = None
+        self.assertEqual(1, plugin.insertItem('manually.first'))
+        self.assertEqual(2, plugin.insertItem('manually.second'))
+        self.assertEqual('manually.second', plugin.readItem(2)[1])
+
     def test_readItem_reads_unknown_as_none(self):
         plugin = self.plugin()
         res = plugin.readItem(1)
@@ -48,6 +63,22 @@ class TestDatabaseBasic(TestDatabaseBase):
         item = self.sh.return_item('main.num')
         plugin.deleteItem(plugin.id(item, True))
         self.assertIsNone(plugin.id(item, False))
+        self.assertIsNone(plugin.name(1))
+
+    def test_id_and_name_mapping(self):
+        plugin = self.plugin()
+        id = plugin.id(self.sh.return_item('main.num'), True)
+        self.assertEqual('main.num', plugin.name(id))
+        self.assertEqual(id, plugin.id(self.sh.return_item('main.num'), False))
+
+    def test_id_mapping_loaded_on_startup(self):
+        plugin = self.plugin()
+        id = plugin.insertItem('main.num')
+        plugin._item_ids = {}
+        plugin._item_names = {}
+        plugin._load_item_ids()
+        self.assertEqual(id, plugin.id(self.sh.return_item('main.num'), False))
+        self.assertEqual('main.num', plugin.name(id))
 
     def test_readItems(self):
         plugin = self.plugin()
@@ -248,6 +279,43 @@ class TestDatabaseBasic(TestDatabaseBase):
           self.read_tmpfile(name)
         )
 
+    def test_dump_log_chunked_gzip(self):
+        name = self.create_tmpfile()
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        plugin.insertLog(id, time=   0, duration=3600, val=10, it='num', changed=0)
+        plugin.insertLog(id, time=3600, duration=3600, val=20, it='num', changed=3600)
+        plugin.insertLog(id, time=7200, duration=3600, val=15, it='num', changed=7200)
+        plugin.dump(name, compress=True, chunk=2)
+        with gzip.open(name, 'rt') as f:
+            content = f.read()
+        os.unlink(name)
+        self.assertLines(
+          "item_id;item_name;time;duration;val_str;val_num;val_bool;changed;time_date;changed_date\n"
+          "1;main.num;0;3600;;10.0;1;0;1970-01-01 00:00:00;1970-01-01 00:00:00\n"
+          "1;main.num;3600;3600;;20.0;1;3600;1970-01-01 00:00:03.600000;1970-01-01 00:00:03.600000\n"
+          "1;main.num;7200;3600;;15.0;1;7200;1970-01-01 00:00:07.200000;1970-01-01 00:00:07.200000\n",
+          content
+        )
+        self.assertEqual(4, len(content.split("\n")) - 1)
+
+    def test_dump_log_bin(self):
+        name = self.create_tmpfile()
+        plugin = self.plugin()
+        id_num = self.create_item(plugin, 'main.num')
+        id_str = self.create_item(plugin, 'main.str')
+        plugin.insertLog(id_num, time=   0, duration=3600, val=10, it='num', changed=0)
+        plugin.insertLog(id_num, time=3600, duration=None, val=20, it='num', changed=3600)
+        plugin.insertLog(id_str, time=   0, duration=3600, val='täst', it='str', changed=0)
+        plugin.dump(name, format='bin', chunk=1)
+        rows = list(plugin.readDump(name))
+        os.unlink(name)
+        self.assertEqual([
+          (id_num, 'main.num', 0, 3600, None, 10.0, 1, 0),
+          (id_num, 'main.num', 3600, None, None, 20.0, 1, 3600),
+          (id_str, 'main.str', 0, 3600, 'täst', None, 1, 0)
+        ], rows)
+
     def test_cleanup_empty(self):
         plugin = self.plugin()
         plugin.cleanup()
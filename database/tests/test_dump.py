@@ -0,0 +1,175 @@
+import os
+import shutil
+import tempfile
+
+from plugins.database import Database
+from plugins.database.tests.base import TestDatabaseBase
+
+class TestDatabaseDump(TestDatabaseBase):
+
+    def buffer(self, plugin, name, tuples):
+        item = self.sh.return_item(name)
+        plugin._buffer[item] = [(self.t(t[0]), None if t[1] is None else self.t(t[1]), t[2]) for t in tuples]
+        return item
+
+    def logs(self, plugin, name):
+        id = plugin.id(self.sh.return_item(name), False)
+        return sorted([(log[0], log[2], log[4]) for log in plugin.readLogs(id)])
+
+    def test_dump_writes_buffered_tuples_of_all_items(self):
+        plugin = self.plugin()
+        self.buffer(plugin, 'main.num', [(1, 1, 10), (2, None, 20)])
+        self.buffer(plugin, 'main.bool', [(1, None, True)])
+        plugin._dump()
+        self.assertEqual([(self.t(1), self.t(1), 10), (self.t(2), None, 20)], self.logs(plugin, 'main.num'))
+        self.assertEqual([(self.t(1), None, 1)], self.logs(plugin, 'main.bool'))
+
+    def test_dump_updates_existing_log_entry(self):
+        plugin = self.plugin()
+        self.buffer(plugin, 'main.num', [(1, None, 10)])
+        plugin._dump()
+        self.buffer(plugin, 'main.num', [(1, 2, 10), (3, None, 20)])
+        plugin._dump()
+        self.assertEqual([(self.t(1), self.t(2), 10), (self.t(3), None, 20)], self.logs(plugin, 'main.num'))
+
+    def test_dump_updates_existing_log_entry_without_upsert(self):
+        plugin = self.plugin()
+        plugin._upsert_log = None
+        self.buffer(plugin, 'main.num', [(1, None, 10)])
+        plugin._dump()
+        self.buffer(plugin, 'main.num', [(1, 2, 10)])
+        plugin._dump()
+        self.assertEqual([(self.t(1), self.t(2), 10)], self.logs(plugin, 'main.num'))
+
+    def test_dump_empties_buffer(self):
+        plugin = self.plugin()
+        item = self.buffer(plugin, 'main.num', [(1, None, 10)])
+        plugin._dump()
+        self.assertEqual([], plugin._buffer[item])
+
+    def test_dump_spools_values_when_database_unavailable(self):
+        plugin = self.plugin()
+        plugin._spool = tempfile.mkdtemp()
+        try:
+            verify = plugin._db.verify
+            plugin._db.verify = lambda retry: 0
+            item = self.buffer(plugin, 'main.num', [(1, 1, 10), (2, None, 20)])
+            plugin._dump()
+            self.assertEqual([], plugin._buffer[item])
+            self.assertEqual(1, len(plugin._spool_segments()))
+
+            plugin._db.verify = verify
+            self.buffer(plugin, 'main.num', [(2, 1, 20), (3, None, 30)])
+            plugin._dump()
+            self.assertEqual([(self.t(1), self.t(1), 10), (self.t(2), self.t(1), 20), (self.t(3), None, 30)], self.logs(plugin, 'main.num'))
+            self.assertEqual([], plugin._spool_segments())
+        finally:
+            shutil.rmtree(plugin._spool)
+
+    def test_update_item_spools_values_above_threshold(self):
+        plugin = self.plugin()
+        plugin._spool = tempfile.mkdtemp()
+        plugin._spool_threshold = 2
+        try:
+            item = self.buffer(plugin, 'main.num', [(1, 1, 10), (2, None, 20)])
+            plugin.update_item(item)
+            self.assertEqual(1, len(plugin._buffer[item]))
+            self.assertEqual(None, plugin._buffer[item][0][1])
+            self.assertEqual(1, len(plugin._spool_segments()))
+            plugin._dump()
+            self.assertEqual(3, len(self.logs(plugin, 'main.num')))
+            self.assertEqual([], plugin._spool_segments())
+        finally:
+            shutil.rmtree(plugin._spool)
+
+    def test_dump_restores_values_when_spool_not_writable(self):
+        plugin = self.plugin()
+        spool = tempfile.mkdtemp()
+        plugin._spool = os.path.join(spool, 'missing')
+        try:
+            plugin._db.verify = lambda retry: 0
+            item = self.buffer(plugin, 'main.num', [(1, 1, 10), (2, None, 20)])
+            plugin._dump()
+            self.assertEqual([(self.t(1), self.t(1), 10), (self.t(2), None, 20)], plugin._buffer[item])
+        finally:
+            shutil.rmtree(spool)
+
+    def test_update_item_keeps_values_when_spool_not_writable(self):
+        plugin = self.plugin()
+        spool = tempfile.mkdtemp()
+        plugin._spool = os.path.join(spool, 'missing')
+        plugin._spool_threshold = 2
+        try:
+            item = self.buffer(plugin, 'main.num', [(1, 1, 10), (2, None, 20)])
+            plugin.update_item(item)
+            self.assertEqual(3, len(plugin._buffer[item]))
+            plugin._dump()
+            self.assertEqual(3, len(self.logs(plugin, 'main.num')))
+        finally:
+            shutil.rmtree(spool)
+
+    def test_dump_restores_values_of_failing_items_when_spool_not_writable(self):
+        plugin = self.plugin()
+        spool = tempfile.mkdtemp()
+        plugin._spool = os.path.join(spool, 'missing')
+        try:
+            bool_item = self.buffer(plugin, 'main.bool', [(1, None, True)])
+            self.buffer(plugin, 'main.num', [(1, None, 10)])
+
+            def dump_bulk(dumps, finalize, changed, cur):
+                raise Exception('bulk dump failed')
+            dump_item = plugin._dump_item
+            plugin._dump_bulk = dump_bulk
+            plugin._dump_item = lambda item, *args: None if item is bool_item else dump_item(item, *args)
+            plugin._dump()
+            self.assertEqual([(self.t(1), None, 10)], self.logs(plugin, 'main.num'))
+            self.assertEqual([(self.t(1), None, True)], plugin._buffer[bool_item])
+
+            del plugin._dump_bulk
+            del plugin._dump_item
+            plugin._dump()
+            self.assertEqual([(self.t(1), None, 1)], self.logs(plugin, 'main.bool'))
+        finally:
+            shutil.rmtree(spool)
+
+    def test_dump_spools_values_of_items_failing_to_dump(self):
+        plugin = self.plugin()
+        plugin._spool = tempfile.mkdtemp()
+        try:
+            bool_item = self.sh.return_item('main.bool')
+            plugin._spool_write([(bool_item, [(self.t(1), self.t(1), True)])])
+            self.buffer(plugin, 'main.num', [(1, None, 10)])
+            self.buffer(plugin, 'main.bool', [(2, None, False)])
+            segments = plugin._spool_segments()
+
+            def dump_bulk(dumps, finalize, changed, cur):
+                raise Exception('bulk dump failed')
+            dump_item = plugin._dump_item
+            plugin._dump_bulk = dump_bulk
+            plugin._dump_item = lambda item, *args: None if item is bool_item else dump_item(item, *args)
+            plugin._dump()
+
+            self.assertEqual([(self.t(1), None, 10)], self.logs(plugin, 'main.num'))
+            self.assertEqual(1, len(plugin._spool_segments()))
+            self.assertNotIn(segments[0], plugin._spool_segments())
+
+            del plugin._dump_bulk
+            del plugin._dump_item
+            plugin._dump()
+            self.assertEqual([(self.t(1), self.t(1), 1), (self.t(2), None, 0)], self.logs(plugin, 'main.bool'))
+            self.assertEqual([], plugin._spool_segments())
+        finally:
+            shutil.rmtree(plugin._spool)
+
+    def test_spool_read_yields_chunks(self):
+        plugin = self.plugin()
+        plugin._spool = tempfile.mkdtemp()
+        plugin._spool_chunk = 2
+        try:
+            item = self.sh.return_item('main.num')
+            for i in range(3):
+                plugin._spool_write([(item, [(self.t(i), self.t(1), i)])])
+            chunks = list(plugin._spool_read(plugin._spool_segments()[0]))
+            self.assertEqual([[(item, [(self.t(0), self.t(1), 0), (self.t(1), self.t(1), 1)])], [(item, [(self.t(2), self.t(1), 2)])]], chunks)
+        finally:
+            shutil.rmtree(plugin._spool)
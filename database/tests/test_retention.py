@@ -0,0 +1,60 @@
+
+from plugins.database import Database
+from plugins.database.tests.base import TestDatabaseBase
+
+class TestDatabaseRetention(TestDatabaseBase):
+
+    HOUR = 3600
+    DAY = 24 * HOUR
+
+    def plugin(self, retention=None, batch=1000):
+        plugin = super().plugin()
+        plugin.alive = True
+        plugin._retention_batch = batch
+        if retention is not None:
+            plugin._retention[self.sh.return_item('main.num')] = plugin._parse_retention(retention)
+        return plugin
+
+    def logs(self, plugin, name):
+        id = plugin.id(self.sh.return_item(name), False)
+        return sorted([(log[0], log[2], log[4]) for log in plugin.readLogs(id)])
+
+    def now(self, plugin):
+        return plugin._timestamp(self.sh.now()) // self.t(1)
+
+    def test_parse_retention(self):
+        plugin = self.plugin()
+        self.assertEqual([(self.t(30 * self.DAY), None), (self.t(730 * self.DAY), self.t(self.HOUR))], plugin._parse_retention('30d raw, 2y hourly'))
+        self.assertEqual([(self.t(self.DAY), None), (self.t(7 * self.DAY), self.t(900))], plugin._parse_retention(['1w 15i', '1d raw']))
+        self.assertEqual([], plugin._parse_retention('30d unknown'))
+
+    def test_retention_deletes_old_logs(self):
+        plugin = self.plugin('1d raw', batch=2)
+        now = self.now(plugin)
+        now = now - now % self.HOUR
+        start = now - 2 * self.DAY
+        self.create_log(plugin, 'main.num', self.log_slice(start, self.HOUR, [1] * 48))
+        plugin._retention_cycle()
+        logs = self.logs(plugin, 'main.num')
+        self.assertTrue(all(log[0] >= self.t(now - self.DAY - 1) for log in logs))
+        self.assertTrue(len(logs) in (23, 24))
+
+    def test_retention_downsamples_old_logs(self):
+        plugin = self.plugin('1h raw, 1y hourly', batch=1)
+        now = self.now(plugin)
+        start = now - now % self.HOUR - 3 * self.HOUR
+        self.create_log(plugin, 'main.num', self.log_slice(start, 900, [10, 20, 30, 40], [50, 50, 50, 50]))
+        plugin._retention_cycle()
+        self.assertEqual([
+          (self.t(start), self.t(self.HOUR), 25),
+          (self.t(start + self.HOUR), self.t(self.HOUR), 50)
+        ], self.logs(plugin, 'main.num'))
+
+    def test_retention_downsample_is_idempotent(self):
+        plugin = self.plugin('1h raw, 1y hourly')
+        now = self.now(plugin)
+        start = now - now % self.HOUR - 3 * self.HOUR
+        self.create_log(plugin, 'main.num', self.log_slice(start, 900, [10, 20, 30, 40]))
+        plugin._retention_cycle()
+        plugin._retention_cycle()
+        self.assertEqual([(self.t(start), self.t(self.HOUR), 25)], self.logs(plugin, 'main.num'))
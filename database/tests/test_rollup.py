@@ -0,0 +1,152 @@
+
+from plugins.database import Database
+from plugins.database.tests.base import TestDatabaseBase
+
+class TestDatabaseRollup(TestDatabaseBase):
+
+    def plugin(self, rollup='10i | 1h'):
+        plugin = super().plugin()
+        plugin._rollup = plugin._parse_rollup(rollup)
+        plugin._rollup_ready = set(plugin._rollup)
+        return plugin
+
+    def rollups(self, plugin, name, step):
+        id = plugin.id(self.sh.return_item(name), False)
+        return plugin._fetchall("SELECT time, duration, val_sum, val_min, val_max FROM {rollup} WHERE item_id = :id AND step = :step ORDER BY time;", {'id':id, 'step':step})
+
+    def test_parse_rollup(self):
+        plugin = self.plugin()
+        self.assertEqual([600000, 3600000], plugin._parse_rollup('10i | 1h'))
+        self.assertEqual([300000, 86400000], plugin._parse_rollup(['1d', '5i']))
+        self.assertEqual([], plugin._parse_rollup(None))
+
+    def test_rollup_size_picks_coarsest_rollup(self):
+        plugin = self.plugin()
+        self.assertIsNone(plugin._rollup_size(60000))
+        self.assertEqual(600000, plugin._rollup_size(600000))
+        self.assertEqual(600000, plugin._rollup_size(3599999))
+        self.assertEqual(3600000, plugin._rollup_size(86400000))
+
+    def test_rollup_size_ignores_rollups_not_ready(self):
+        plugin = self.plugin()
+        plugin._rollup_ready = set([600000])
+        self.assertEqual(600000, plugin._rollup_size(86400000))
+
+    def test_rollup_rebuild(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.num', [
+          (   0,  600, 10),
+          ( 600, 3600, 20),
+          (3600, None, 30)
+        ])
+        plugin._rollup_rebuild()
+        self.assertEqual([
+          (0, self.t(3600), 10 * self.t(600) + 20 * self.t(3000), 10, 20)
+        ], self.rollups(plugin, 'main.num', 3600000))
+        self.assertEqual([
+          (0, self.t(600), 10 * self.t(600), 10, 10),
+          (self.t(600), self.t(600), 20 * self.t(600), 20, 20),
+          (self.t(1200), self.t(600), 20 * self.t(600), 20, 20),
+          (self.t(1800), self.t(600), 20 * self.t(600), 20, 20),
+          (self.t(2400), self.t(600), 20 * self.t(600), 20, 20),
+          (self.t(3000), self.t(600), 20 * self.t(600), 20, 20)
+        ], self.rollups(plugin, 'main.num', 600000))
+
+    def test_rollup_splits_duration_across_buckets(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.num', [
+          (   0,  900, 10),
+          ( 900, 1000, 20)
+        ])
+        plugin._rollup_rebuild()
+        self.assertEqual([
+          (0, self.t(600), 10 * self.t(600), 10, 10),
+          (self.t(600), self.t(400), 10 * self.t(300) + 20 * self.t(100), 10, 20)
+        ], self.rollups(plugin, 'main.num', 600000))
+
+    def test_rollup_updated_on_dump(self):
+        plugin = self.plugin()
+        item = self.sh.return_item('main.num')
+        plugin._buffer[item] = [(self.t(0), self.t(600), 10), (self.t(600), None, 20)]
+        plugin._dump()
+        self.assertEqual([(0, self.t(600), 10 * self.t(600), 10, 10)], self.rollups(plugin, 'main.num', 600000))
+        plugin._buffer[item] = [(self.t(600), self.t(600), 20)]
+        plugin._dump()
+        self.assertEqual([
+          (0, self.t(600), 10 * self.t(600), 10, 10),
+          (self.t(600), self.t(600), 20 * self.t(600), 20, 20)
+        ], self.rollups(plugin, 'main.num', 600000))
+
+    def test_rollup_aggregated_from_finer_rollup_on_dump(self):
+        plugin = self.plugin('10i | 1h | 25i')
+        item = self.sh.return_item('main.num')
+        plugin._buffer[item] = [(self.t(0), self.t(900), 10), (self.t(900), None, 20)]
+        plugin._dump()
+        plugin._buffer[item] = [(self.t(900), self.t(3000), 20), (self.t(3900), self.t(300), 30), (self.t(4200), None, 40)]
+        plugin._dump()
+        self.assertEqual([
+          (0, self.t(3600), 10 * self.t(900) + 20 * self.t(2700), 10, 20),
+          (self.t(3600), self.t(600), 20 * self.t(300) + 30 * self.t(300), 20, 30)
+        ], self.rollups(plugin, 'main.num', 3600000))
+        dumped = {step: self.rollups(plugin, 'main.num', step) for step in plugin._rollup}
+        plugin._rollup_rebuild()
+        self.assertEqual(dumped, {step: self.rollups(plugin, 'main.num', step) for step in plugin._rollup})
+
+    def test_series_uses_rollup(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.num', [
+          (   0,  600, 10),
+          ( 600, 1200, 30)
+        ])
+        plugin._rollup_rebuild()
+        res = plugin._series('avg', start=self.t(0), end=self.t(7200), step=self.t(3600), item='main.num')
+        self.assertSeries([(0, 20), (7200, 20)], res)
+        res = plugin._series('max', start=self.t(0), end=self.t(7200), step=self.t(3600), item='main.num')
+        self.assertSeries([(0, 30), (7200, 30)], res)
+
+    def test_single_uses_rollup(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.num', [
+          (   0,  600, 10),
+          ( 600, 1200, 30)
+        ])
+        plugin._rollup_rebuild()
+        self.assertSingle(20, plugin._single('avg', start=self.t(0), end=self.t(360000), item='main.num'))
+        self.assertSingle(10, plugin._single('min', start=self.t(0), end=self.t(360000), item='main.num'))
+
+    def create_open_log(self, plugin):
+        self.create_log(plugin, 'main.num', [
+          (1200, 1800, 10),
+          (1800, 2400, 20),
+          (2400, 3000, 30),
+          (3000, 3600, 40),
+          (3600, 4500, 50),
+          (4500, None, 60)
+        ])
+        plugin._rollup_rebuild()
+
+    def raw(self, plugin, func, *args, **kwargs):
+        ready = plugin._rollup_ready
+        plugin._rollup_ready = set()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            plugin._rollup_ready = ready
+
+    def test_series_rollup_equals_raw_with_open_entry_and_unaligned_start(self):
+        plugin = self.plugin()
+        self.create_open_log(plugin)
+        for func in ('avg', 'min', 'max'):
+            kwargs = {'start':self.t(1500), 'end':self.t(6000), 'step':self.t(1800), 'item':'main.num'}
+            res = plugin._series(func, **kwargs)
+            self.assertEqual(self.raw(plugin, plugin._series, func, **kwargs)['series'], res['series'])
+        res = plugin._series('avg', start=self.t(1500), end=self.t(6000), step=self.t(1800), item='main.num')
+        self.assertSeries([(1500, 10), (1800, 30), (3600, 56.25), (6000, 56.25)], res)
+
+    def test_single_rollup_equals_raw_with_open_entry_and_unaligned_start(self):
+        plugin = self.plugin()
+        self.create_open_log(plugin)
+        for func in ('avg', 'min', 'max'):
+            kwargs = {'start':self.t(1500), 'end':self.t(6000), 'item':'main.num'}
+            self.assertEqual(self.raw(plugin, plugin._single, func, **kwargs), plugin._single(func, **kwargs))
+        self.assertSingle(42.67, plugin._single('avg', start=self.t(1500), end=self.t(6000), item='main.num'))
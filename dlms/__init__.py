@@ -56,6 +56,25 @@ This module implements the questioning of a smartmeter using the DLMS protocol
 #   OBIS    OBject Identification System                (see iec62056-61{ed1.0}en_obis_protocol.pdf)
 """
 
+class DlmsRecorder():
+    """
+    appends the bytes exchanged with the smartmeter to a file, one line per read or write:
+    <unix time> rx|tx <bytes as hex>
+    The file can be replayed with replay.py.
+    """
+
+    def __init__(self, filename):
+        self._file = open(filename, 'a')
+
+    def write(self, direction, data):
+        if data:
+            self._file.write('{:.3f} {} {}\n'.format(time.time(), direction, data.hex()))
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
 class DLMS(SmartPlugin):
     PLUGIN_VERSION = "1.2.5"
     ALLOW_MULTIINSTANCE = False
@@ -73,7 +92,7 @@ class DLMS(SmartPlugin):
         'dlms_obis_code',           # a single code in form of '1-1:1.8.1'
         'dlms_obis_readout']        # complete readout from smartmeter, if you want to examine codes yourself in a logic
     
-    def __init__(self, smarthome, serialport, baudrate="auto", update_cycle="60", instance = 0, device_address = b'', timeout = 2, use_checksum = True, reset_baudrate = True, no_waiting = False ):
+    def __init__(self, smarthome, serialport, baudrate="auto", update_cycle="60", instance = 0, device_address = b'', timeout = 2, use_checksum = True, reset_baudrate = True, no_waiting = False, record = None ):
         """
         This function initializes the DLMS plugin
         :param serialport: 
@@ -93,7 +112,9 @@ class DLMS(SmartPlugin):
         self._min_cycle_time = 0                                # we measure the time for the value query and add some security value of 10 seconds
             
         self.dlms_obis_code_items = []                          # this is a list of items to be updated
-        self.dlms_obis_codes = []                               # this is a list of codes that are to be parsed
+        self.dlms_obis_codes = {}                               # OBIS code: list of (item, index, key, converter) to update
+        self._serial_buffer = bytearray()                       # bytes read beyond the end of the last data block
+        self._recorder = DlmsRecorder(record) if record else None   # records the communication for replay.py
         
         self.dlms_obis_readout_items = []                       # this is a list of items that receive the full readout
  
@@ -127,6 +148,8 @@ class DLMS(SmartPlugin):
         if __name__ != '__main__':
             # clean up means to remove the scheduler for the update function
             self._sh.scheduler.remove('DLMS')
+        if self._recorder is not None:
+            self._recorder.close()
         self.logger.debug("stop dlms")
 
     def parse_item(self, item):
@@ -138,10 +161,20 @@ class DLMS(SmartPlugin):
             self.dlms_obis_code_items.append(item)
             self.logger.debug("Item '{}' has Attribute '{}' so it is added to the list of items "
                               "to receive OBIS Code Values".format(item, self.ITEM_TAG[0]))
-            obis_code = self.get_iattr_value(item.conf, self.ITEM_TAG[0])
-            if isinstance(obis_code, list):
-                obis_code = obis_code[0]
-            self.dlms_obis_codes.append( obis_code )
+            attribute = self.get_iattr_value(item.conf, self.ITEM_TAG[0])
+            if not isinstance(attribute, list):
+                self.logger.warning("Attribute '{}' is a single argument, not a list".format(attribute))
+                attribute = [attribute]
+            obis_code = attribute[0]
+            try:
+                Index = int(attribute[1]) if len(attribute)>1 else 0
+            except ValueError:
+                self.logger.warning("Index '{}' of item {} is not a number, using 0".format(attribute[1], item))
+                Index = 0
+            Key = attribute[2] if len(attribute)>2 else 'Value'
+            if not Key in ['Value', 'Unit']: Key = 'Value'
+            Converter = attribute[3] if len(attribute)>3 else ''
+            self.dlms_obis_codes.setdefault(obis_code, []).append((item, Index, Key, Converter))
             self.logger.debug("The OBIS Code '{}' is added to the list of codes to inspect".format(obis_code))
         elif self.has_iattr(item.conf, self.ITEM_TAG[1]):
             self.dlms_obis_readout_items.append(item)
@@ -165,30 +198,40 @@ class DLMS(SmartPlugin):
         elif timedelta > 0.000000001:
             return "{:.2f} ns".format(timedelta * 1000000000.0)
 
-    def _read_data_block_from_serial(self, the_serial, end_byte=0x0a):
+    def _read_data_block_from_serial(self, the_serial, end_byte=0x0a, trailer=0):
         """
         This function reads some bytes from serial interface
         it returns an array of bytes if a timeout occurs or a given end byte is encountered
         and otherwise None if an error occurred
+        Bytes already waiting are read at once, bytes read beyond the end of the block are kept for the next call
         :param the_serial: interface to read from
         :param end_byte: the indicator for end of data by source endpoint
+        :param trailer: number of bytes following the end byte which belong to the block, e.g. a checksum
         :returns the read data or None
         """
-        response = bytes()
+        response = self._serial_buffer
+        self._serial_buffer = bytearray()
+        start = 0
         try:
             while self.alive:
-                ch = the_serial.read()
+                if end_byte is not None:
+                    end = response.find(end_byte, start)
+                    if end >= 0 and len(response) > end + trailer:
+                        self._serial_buffer = response[end + trailer + 1:]
+                        del response[end + trailer + 1:]
+                        break
+                    if end < 0:
+                        start = len(response)
+                ch = the_serial.read(max(1, the_serial.in_waiting))
                 if len(ch) == 0:
                     break
+                if self._recorder is not None:
+                    self._recorder.write('rx', ch)
                 response += ch
-                if ch == end_byte:
-                    break
-                if (response[-1] == end_byte):
-                    break
         except Exception as e:
             self.logger.debug("Warning {0}".format(e))
             return None
-        return response
+        return bytes(response)
 
     def _update_values_callback(self):
         """
@@ -245,6 +288,7 @@ class DLMS(SmartPlugin):
         wait_before_acknowledge = 0.4   # wait for 400 ms before sending the request to change baudrate
         wait_after_acknowledge = 0.4    # wait for 400 ms after sending acknowledge
         dlms_serial = None
+        self._serial_buffer = bytearray()
 
         try:
             dlms_serial = serial.Serial(self._serialport,
@@ -282,6 +326,8 @@ class DLMS(SmartPlugin):
             dlms_serial.reset_input_buffer()    # replaced dlms_serial.flushInput()
             self.logger.debug("Writing request message {} to serial port '{}'".format(Request_Message, self._serialport))
             dlms_serial.write(Request_Message)
+            if self._recorder is not None:
+                self._recorder.write('tx', Request_Message)
             self.logger.debug("Flushing buffer from serial port '{}'".format(self._serialport))
             dlms_serial.flush()                 # replaced dlms_serial.drainOutput()
             self.logger.debug("Reset input buffer from serial port '{}'".format(self._serialport))
@@ -370,12 +416,15 @@ class DLMS(SmartPlugin):
                               "and tell smartmeter to switch to {} Baud".format(Acknowledge, NewBaudrate))
             try:
                 dlms_serial.write( Acknowledge )
+                if self._recorder is not None:
+                    self._recorder.write('tx', Acknowledge)
             except Exception as e:
                 self.logger.warning("Warning {0}".format(e))
                 return
             time.sleep(wait_after_acknowledge)
             dlms_serial.flush()                 # replaced dlms_serial.drainOutput()
             dlms_serial.reset_input_buffer()    # replaced dlms_serial.flushInput()            
+            self._serial_buffer = bytearray()
             if (NewBaudrate != InitialBaudrate):
                 # change request to set higher baudrate
                 dlms_serial.baudrate = NewBaudrate
@@ -387,6 +436,7 @@ class DLMS(SmartPlugin):
             time.sleep(wait_after_acknowledge)
             dlms_serial.flush()                 # replaced dlms_serial.drainOutput()
             dlms_serial.reset_input_buffer()    # replaced dlms_serial.flushInput()            
+            self._serial_buffer = bytearray()
             if (NewBaudrate != InitialBaudrate):
                 # change request to set higher baudrate
                 dlms_serial.baudrate = NewBaudrate
@@ -395,8 +445,9 @@ class DLMS(SmartPlugin):
                               "smartmeter and reader will stay at {} Baud".format(NewBaudrate))
 
         # now read the huge data block with all the OBIS codes
+        # it ends with ETX and the block check character, meters without ETX are read until the timeout
         self.logger.debug("Reading OBIS data from smartmeter")
-        response = self._read_data_block_from_serial( dlms_serial, None)
+        response = self._read_data_block_from_serial( dlms_serial, 0x03, 1)
 
         dlms_serial.close()
         self.logger.debug("Time for reading OBIS data: {}".format(self.format_time(time.time()- runtime)))
@@ -649,31 +700,19 @@ class DLMS(SmartPlugin):
         :param Values: list of dictionaries with Value / Unit entries
         """
         if __name__ != '__main__':
-            for item in self.dlms_obis_code_items:
-                if self.has_iattr(item.conf, self.ITEM_TAG[0]):
-                    attribute = self.get_iattr_value(item.conf, self.ITEM_TAG[0])
-                    if not isinstance(attribute, list):
-                        self.logger.warning("Attribute '{}' is a single argument, not a list".format(attribute))
-                        attribute = [attribute]
-                    obis_code = attribute[0]
-                    if obis_code == Code:
-                        #todo: error handling for key errors
-                        Index = int(attribute[1]) if len(attribute)>1 else 0
-                        Key = attribute[2] if len(attribute)>2 else 'Value'
-                        if not Key in ['Value', 'Unit']: Key = 'Value'
-                        Converter = attribute[3] if len(attribute)>3 else ''
-                        try:
-                            itemValue = Values[Index][Key]
-                            itemValue = self._convert_value(itemValue, Converter )
-                            item(itemValue, 'DLMS')
-                            self.logger.debug("Set item {} for Obis Code {} to Value {}".format(item, Code, itemValue))
-                        except IndexError as e:
-                            self.logger.warning("Index Error '{}' while setting item {} for Obis Code {} to Value "
-                                                "with Index '{}' in '{}'".format(str(e), item, Code, Index, Values))
-                        except KeyError as e:
-                            self.logger.warning("Key error '{}' while setting item {} for Obis Code {} to "
-                                                "Key '{}' in '{}'".format(str(e), item, Code, Key, Values[Index]))
-    
+            for item, Index, Key, Converter in self.dlms_obis_codes.get(Code, ()):
+                try:
+                    itemValue = Values[Index][Key]
+                    itemValue = self._convert_value(itemValue, Converter )
+                    item(itemValue, 'DLMS')
+                    self.logger.debug("Set item {} for Obis Code {} to Value {}".format(item, Code, itemValue))
+                except IndexError as e:
+                    self.logger.warning("Index Error '{}' while setting item {} for Obis Code {} to Value "
+                                        "with Index '{}' in '{}'".format(str(e), item, Code, Index, Values))
+                except KeyError as e:
+                    self.logger.warning("Key error '{}' while setting item {} for Obis Code {} to "
+                                        "Key '{}' in '{}'".format(str(e), item, Code, Key, Values[Index]))
+
     def _update_values(self, readout):
         """
         this function will take the readout from smart meter with one OBIS code per line, then splits up the line
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG.py.
+#  Visit:  https://github.com/smarthomeNG/
+#          https://knx-user-forum.de/forum/supportforen/smarthome-py
+#
+#  SmartHomeNG.py is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG.py is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG.py. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""
+Replays a recording of the dlms plugin (plugin parameter record) on a pseudo terminal, so the plugin
+can be run and measured without a smartmeter:
+
+    python3 plugins/dlms/replay.py var/dlms.rec --speed 10
+
+and configure the plugin with the printed serialport, e.g. /dev/pts/5.
+Like the smartmeter the replay waits for every request (tx) of the recording before it sends the
+following answer (rx). The first answer is sent with the delay of the recording after the request,
+the gaps between the following reads are divided by speed, speed 0 sends them as fast as possible.
+The recording starts again with the next request of the plugin.
+"""
+
+import argparse
+import logging
+import os
+import select
+import threading
+import time
+import tty
+
+logger = logging.getLogger(__name__)
+
+
+def load(filename):
+    """
+    reads a recording
+    :return: list of (unix time, direction, bytes)
+    """
+    records = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            timestamp, direction, data = line.split(' ')
+            records.append((float(timestamp), direction, bytes.fromhex(data)))
+    return records
+
+
+class ReplayPty():
+    """
+    answers the requests on the pseudo terminal port with the recorded answers
+    """
+
+    def __init__(self, filename, speed=1.0):
+        self.records = load(filename)
+        self.speed = float(speed)
+        self.queries = 0
+        self.alive = False
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        self.port = os.ttyname(self._slave)
+        self._thread = None
+
+    def start(self):
+        self.alive = True
+        self._thread = threading.Thread(target=self._replay, name='dlms replay')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.alive = False
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _receive(self, length):
+        """
+        reads length bytes written by the plugin
+        :return: the bytes or None if stopped
+        """
+        data = b''
+        while len(data) < length:
+            if not self.alive:
+                return None
+            readable, writable, failed = select.select([self._master], [], [], 0.1)
+            if readable:
+                data += os.read(self._master, length - len(data))
+        return data
+
+    def _replay(self):
+        while self.alive:
+            request = None
+            previous = None
+            for timestamp, direction, data in self.records:
+                if direction == 'tx':
+                    received = self._receive(len(data))
+                    if received is None:
+                        return
+                    if received != data:
+                        logger.warning('expected request {} but got {}'.format(data, received))
+                    request = (timestamp, time.time())
+                    previous = None
+                    continue
+                if previous is None and request is not None:  # answer, timed like the smartmeter
+                    delay = request[1] + timestamp - request[0] - time.time()
+                elif previous is not None and self.speed > 0:
+                    delay = previous[1] + (timestamp - previous[0]) / self.speed - time.time()
+                else:
+                    delay = 0
+                if delay > 0:
+                    time.sleep(delay)
+                os.write(self._master, data)
+                previous = (timestamp, time.time())
+            self.queries += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recording of the dlms plugin on a pseudo terminal')
+    parser.add_argument('recording')
+    parser.add_argument('--speed', type=float, default=1.0, help='acceleration of the recording, 0 for no delays')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    replay = ReplayPty(args.recording, args.speed)
+    replay.start()
+    print('replaying {} on serialport {}, stop with Ctrl-C'.format(args.recording, replay.port))
+    try:
+        while replay._thread.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    replay.stop()
@@ -0,0 +1,123 @@
+"""
+Timings of reading and dispatching recorded smartmeter readouts, run with
+
+    python -m pytest plugins/dlms/tests/test_replay_benchmark.py --benchmark-columns=min,mean,ops
+
+The recordings in recordings/ are made with the plugin parameter record. test_read and
+test_update_values use the reads of the data message, test_query replays the whole recording
+with replay.py on a pseudo terminal to a query of the plugin.
+Skipped if pyserial or pytest-benchmark are not installed.
+"""
+import functools
+import os
+
+import pytest
+
+pytest.importorskip('serial')
+pytest.importorskip('pytest_benchmark')
+
+from plugins.dlms import DLMS
+from plugins.dlms.replay import ReplayPty, load
+
+RECORDINGS = os.path.join(os.path.dirname(__file__), 'recordings')
+ITEMS = 100  # items per OBIS code of a readout
+
+
+class SmartHome():
+
+    @staticmethod
+    def string2bool(string):
+        return str(string).lower() in ('1', 'yes', 'true', 'on')
+
+
+class ReplaySerial():
+    """
+    returns the recorded reads like a serial port
+    """
+
+    def __init__(self, reads):
+        self._reads = list(reads)
+        self._pos = 0
+
+    @property
+    def in_waiting(self):
+        return len(self._reads[0]) - self._pos if self._reads else 0
+
+    def read(self, size=1):
+        if not self._reads:
+            return b''
+        data = self._reads[0][self._pos:self._pos + size]
+        self._pos += len(data)
+        if self._pos == len(self._reads[0]):
+            self._reads.pop(0)
+            self._pos = 0
+        return data
+
+
+class Item():
+
+    def __init__(self, attribute):
+        self.conf = {'dlms_obis_code': attribute}
+        self.value = None
+
+    def __call__(self, value, caller=None):
+        self.value = value
+
+
+@functools.lru_cache()
+def reads(name):
+    """
+    the reads of the data message, following the last request of the recording
+    """
+    records = load(os.path.join(RECORDINGS, name))
+    last = max(i for i, (timestamp, direction, data) in enumerate(records) if direction == 'tx')
+    return tuple(data for timestamp, direction, data in records[last + 1:])
+
+
+def plugin(name, serialport='replay'):
+    dlms = DLMS(SmartHome(), serialport)
+    dlms.alive = True
+    readout = str(b''.join(reads(name))[1:-4], 'ascii')
+    for line in readout.split('\r\n'):
+        if '(' in line:
+            for i in range(ITEMS):
+                dlms.parse_item(Item([line.split('(')[0], '0', 'Value', 'num']))
+    return dlms, readout
+
+
+def total(dlms):
+    for code in ('1-1:1.8.0', '1.8.0*00'):
+        for item, index, key, converter in dlms.dlms_obis_codes.get(code, ()):
+            return item.value
+
+
+@pytest.mark.parametrize('name', sorted(os.listdir(RECORDINGS)))
+def test_read(benchmark, name):
+    dlms = DLMS(SmartHome(), 'replay')
+    dlms.alive = True
+    benchmark.group = 'read'
+    response = benchmark(lambda: dlms._read_data_block_from_serial(ReplaySerial(reads(name)), 0x03, 1))
+    assert response == b''.join(reads(name))
+
+
+@pytest.mark.parametrize('name', sorted(os.listdir(RECORDINGS)))
+def test_update_values(benchmark, name):
+    dlms, readout = plugin(name)
+    benchmark.group = 'update_values'
+    benchmark(dlms._update_values, readout)
+    assert total(dlms) in (51206, 783.16)
+
+
+@pytest.mark.parametrize('name', sorted(os.listdir(RECORDINGS)))
+def test_query(benchmark, name):
+    replay = ReplayPty(os.path.join(RECORDINGS, name), speed=0)
+    replay.start()
+    try:
+        dlms, readout = plugin(name, replay.port)
+        benchmark.group = 'query'
+        result = benchmark.pedantic(dlms._query_smartmeter, rounds=1, iterations=1)
+    finally:
+        replay.stop()
+    assert result == readout
+    dlms._update_values(result)
+    assert total(dlms) in (51206, 783.16)
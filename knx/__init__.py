@@ -37,12 +37,13 @@ import logging
 import threading
 import struct
 import binascii
-import random
+import collections
+import functools
+import heapq
 import time
 
 import lib.connection
 from lib.model.smartplugin import SmartPlugin
-from datetime import timedelta
 from . import dpts
 
 # types from knxd\src\include\eibtypes.h
@@ -52,13 +53,13 @@ KNXD_CACHE_ENABLE   = 112    # 0x70
 KNXD_CACHE_DISABLE  = 113    # 0x71
 KNXD_CACHE_READ     = 116    # 0x74 
 
-KNXD_CACHEREAD_DELAY  = 0.35
-KNXD_CACHEREAD_DELAY  = 0.0
-
 KNXREAD = 0x00
 KNXRESP = 0x40
 KNXWRITE = 0x80
 
+KNXD_HEADER = struct.Struct(">HHH")         # type, source pa, destination ga of a knxd telegram
+KNX_FLAGS = ('read', 'response', 'write')   # flag names indexed by the two APCI bits (KNXREAD >> 6 ...)
+
 # deprecated due to the new smartplugin model
 # KNX_INSTANCE = 'knx_instance'     # which instance of plugin to use for a given item (deprecated!)
 KNX_DPT      = 'knx_dpt'          # data point type
@@ -77,6 +78,27 @@ ITEMS = 'items'
 LOGIC = 'logic'
 LOGICS = 'logics'
 DPT='dpt'
+DECODE = 'decode'
+GA = 'ga'
+
+
+def _ga_int(ga):
+    """
+    converts a group address string like '1/2/3' to its raw 16 bit integer
+    """
+    main, middle, sub = ga.split('/')
+    return (int(main) & 0x1f) << 11 | (int(middle) & 0x07) << 8 | (int(sub) & 0xff)
+
+
+@functools.lru_cache(maxsize=4096)
+def _ga_str(ga):
+    return "{0}/{1}/{2}".format((ga >> 11) & 0x1f, (ga >> 8) & 0x07, ga & 0xff)
+
+
+@functools.lru_cache(maxsize=4096)
+def _pa_str(pa):
+    return "{0}.{1}.{2}".format((pa >> 12) & 0x0f, (pa >> 8) & 0x0f, pa & 0xff)
+
 
 class KNX(lib.connection.Client,SmartPlugin):
     ALLOW_MULTIINSTANCE = True
@@ -89,13 +111,14 @@ class KNX(lib.connection.Client,SmartPlugin):
     ITEM_TAG_PLUS = [KNX_DTP]
 
     def __init__(self, smarthome, time_ga=None, date_ga=None, send_time=False, busmonitor=False, host='127.0.0.1',
-                 port=6720, readonly=False, instance='default', enable_stats = True):
+                 port=6720, readonly=False, instance='default', enable_stats = True, send_rate=20,
+                 response_timeout=2, response_retries=2):
         lib.connection.Client.__init__(self, host, port, monitor=True)
         self.logger = logging.getLogger(__name__)
         self.logger.debug("init knx")        
         self._sh = smarthome
-        self.gal = {}                   # group addresses to listen to {DPT: dpt, ITEMS: [item 1, item 2, ..., item n], LOGICS: [ logic 1, logic 2, ..., logic n]}
-        self.gar = {}                   # group addresses to reply if requested from knx, {DPT: dpt, ITEM: item, LOGIC: None}
+        self.gal = {}                   # raw ga integer to listen to {GA: ga, DPT: dpt, DECODE: decoder, ITEMS: [item 1, item 2, ..., item n], LOGICS: [ logic 1, logic 2, ..., logic n]}
+        self.gar = {}                   # raw ga integer to reply if requested from knx, {GA: ga, DPT: dpt, ITEM: item, LOGIC: None}
         self._init_ga = []
         self._cache_ga = []             # group addresses which should be initalized by the knxd cache
         self._cache_ga_response_pending = []
@@ -107,24 +130,40 @@ class KNX(lib.connection.Client,SmartPlugin):
         self._bm_format= "KNX[{0}]: {1} set {2} to {3}"
         # following needed for statistics
         self.enable_stats = enable_stats
-        self.stats_ga = {}              # statistics for used group addresses on the BUS
-        self.stats_pa = {}              # statistics for used group addresses on the BUS
+        self._stats_ga = {}             # statistics for used group addresses on the BUS {raw ga: [read, response, write]}
+        self._stats_pa = {}             # statistics for used physical addresses on the BUS {raw pa: [read, response, write]}
         self.stats_last_read = None     # last read request from KNX
         self.stats_last_write = None    # last write from KNX
         self.stats_last_response = None # last response from KNX
         self.stats_last_action = None   # the newes
-
+        # telegrams are sent by a separate thread limited to send_rate telegrams per second (token bucket)
+        self._send_rate = float(send_rate)
+        self._tokens = max(self._send_rate, 1)
+        self._tokens_time = time.monotonic()
+        self._send_queue = collections.deque()  # (packet, ga awaiting a response or None, retries, rate limited)
+        self._send_cond = threading.Condition()
+        self._send_thread = None
+        self._response_timeout = float(response_timeout)
+        self._response_retries = int(response_retries)
+        self._pending = {}              # raw ga: [ga, deadline, retries] of sent reads still waiting for a response
+        self._startup = {'requested': 0, 'answered': 0, 'failed': 0}
+        self._poll_ga = {}              # ga: poll interval in seconds from knx_poll
+        self._polls = []                # heap of [due, ga, interval] read by the send thread
+
+        self._bm_logger = self.logger
         if self.to_bool(busmonitor,default=busmonitor):
-            self._busmonitor = self.logger.info
+            self._bm_level = logging.INFO
         else:
-            self._busmonitor = self.logger.debug
+            self._bm_level = logging.DEBUG
 
             # write bus messages in a separate logger
             if isinstance(busmonitor, str):
                 if busmonitor.lower() in ['logger']:
                     self._bm_separatefile = True
                     self._bm_format = "{0};{1};{2};{3}"
-                    self._busmonitor = logging.getLogger("knx_busmonitor").info
+                    self._bm_logger = logging.getLogger("knx_busmonitor")
+                    self._bm_level = logging.INFO
+        self._busmonitor = functools.partial(self._bm_logger.log, self._bm_level)
 
         if send_time:
             self._sh.scheduler.add('KNX[{0}] time'.format(self.get_instance_name()), self._send_time, prio=5, cycle=int(send_time))
@@ -151,12 +190,36 @@ class KNX(lib.connection.Client,SmartPlugin):
         send.extend(data)
         self.send(send)
 
-    def groupwrite(self, ga, payload, dpt, flag='write'):
-        pkt = bytearray([0, KNXD_GROUP_PACKET])
+    def _packet(self, typ, ga):
+        pkt = bytearray([0, typ])
         try:
             pkt.extend(self.encode(ga, 'ga'))
         except:
             self.logger.warning('KNX[{0}]: problem encoding ga: {1}'.format(self.get_instance_name(), ga))
+            return None
+        return pkt
+
+    def _enqueue(self, pkt, ga=None, retries=0, limit=True):
+        """
+        queues a packet for the send thread, the send queue lock has to be held by the caller
+        :param pkt: packet as passed to _send
+        :param ga: group address to wait for a response from, the read is repeated after response_timeout
+        :param retries: how often the read is repeated without a response
+        :param limit: False for knxd control packets which do not count against send_rate
+        """
+        self._send_queue.append((pkt, ga, retries, limit))
+        self._send_cond.notify()
+
+    def _queue(self, pkt):
+        self._send_cond.acquire()
+        try:
+            self._enqueue(pkt)
+        finally:
+            self._send_cond.release()
+
+    def groupwrite(self, ga, payload, dpt, flag='write'):
+        pkt = self._packet(KNXD_GROUP_PACKET, ga)
+        if pkt is None:
             return
         pkt.extend([0])
         pkt.extend(self.encode(payload, dpt))
@@ -173,47 +236,156 @@ class KNX(lib.connection.Client,SmartPlugin):
         if self.readonly:
             self.logger.info("KNX[{2}]: groupwrite telegram for: {0} - Value: {1} not send. Plugin in READONLY mode. ".format(ga,payload,self.get_instance_name()))
         else:
-            self._send(pkt)
+            self._queue(pkt)
+
+    def _cacheread_packet(self, ga):
+        pkt = self._packet(KNXD_CACHE_READ, ga)
+        if pkt is not None:
+            pkt.extend([0, 0])
+        return pkt
 
     def _cacheread(self, ga):
-        pkt = bytearray([0, KNXD_CACHE_READ])
-        try:
-            pkt.extend(self.encode(ga, 'ga'))
-        except:
-            self.logger.warning('KNX[{0}]: problem encoding ga: {1}'.format(self.get_instance_name(), ga))
+        pkt = self._cacheread_packet(ga)
+        if pkt is None:
             return
-        pkt.extend([0, 0])
         self.logger.debug('KNX[{0}]: reading knxd cache for ga: {1}'.format(self.get_instance_name(), ga))
-        self._send(pkt)
+        self._queue(pkt)
+
+    def _groupread_packet(self, ga):
+        pkt = self._packet(KNXD_GROUP_PACKET, ga)
+        if pkt is not None:
+            pkt.extend([0, KNXREAD])
+        return pkt
 
     def groupread(self, ga):
-        pkt = bytearray([0, KNXD_GROUP_PACKET])
-        try:
-            pkt.extend(self.encode(ga, 'ga'))
-        except:
-            self.logger.warning('KNX[{0}]: problem encoding ga: {1}'.format(self.get_instance_name(), ga))
-            return
-        pkt.extend([0, KNXREAD])
-        self._send(pkt)
+        pkt = self._groupread_packet(ga)
+        if pkt is not None:
+            self._queue(pkt)
+
+    def _send_delay(self):
+        """
+        takes a token from the bucket
+        :return: 0 if a telegram may be sent now, else the seconds until the next token is available
+        """
+        if self._send_rate <= 0:
+            return 0
+        now = time.monotonic()
+        self._tokens = min(max(self._send_rate, 1), self._tokens + (now - self._tokens_time) * self._send_rate)
+        self._tokens_time = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self._send_rate
+
+    def _expire_pending(self):
+        """
+        repeats reads without a response within response_timeout as group read, the send queue lock has to be held
+        :return: seconds until the next pending read expires or None
+        """
+        now = time.monotonic()
+        next = None
+        for gai, (ga, deadline, retries) in list(self._pending.items()):
+            if deadline > now:
+                if next is None or deadline - now < next:
+                    next = deadline - now
+            elif retries > 0:
+                del self._pending[gai]
+                self.logger.debug('KNX[{0}]: no response for {1}, reading again'.format(self.get_instance_name(), ga))
+                self._enqueue(self._groupread_packet(ga), ga, retries - 1)
+            else:
+                del self._pending[gai]
+                self.logger.warning('KNX[{0}]: no response for {1} after {2} retries'.format(self.get_instance_name(), ga, self._response_retries))
+                self._startup['failed'] += 1
+                self._startup_finished()
+        return next
 
-    def _poll(self, **kwargs):
-        if ITEM in kwargs:
-            item = kwargs[ITEM]
-        else:
-            item = 'unknown item'
+    def _answered(self, gai):
+        """
+        called from parse_telegram for a write or response on a ga with a pending read
+        """
+        self._send_cond.acquire()
+        try:
+            pending = self._pending.pop(gai, None)
+            if pending is not None:
+                if pending[0] in self._cache_ga_response_pending:
+                    self._cache_ga_response_pending.remove(pending[0])
+                self._startup['answered'] += 1
+                self._startup_finished()
+        finally:
+            self._send_cond.release()
+
+    def _startup_finished(self):
+        if self._startup['answered'] + self._startup['failed'] == self._startup['requested']:
+            self.logger.info('KNX[{0}]: finished startup reads, {1} answered, {2} without response'.format(
+                self.get_instance_name(), self._startup['answered'], self._startup['failed']))
+
+    def _schedule_polls(self):
+        """
+        builds the poll heap, the first reads of all ga with the same interval are spread evenly
+        over one interval after the first interval has passed
+        """
+        now = time.monotonic()
+        by_interval = {}
+        for ga, interval in sorted(self._poll_ga.items()):
+            by_interval.setdefault(interval, []).append(ga)
+        polls = []
+        for interval, gas in by_interval.items():
+            for n, ga in enumerate(gas):
+                polls.append([now + interval + interval * n / len(gas), ga, interval])
+        heapq.heapify(polls)
+        self._polls = polls
+
+    def _poll_due(self):
+        """
+        queues the next due poll if nothing else is waiting to be sent, the send queue lock has to be held
+        Polls only use the send capacity left over by other telegrams, so they never push the bus above send_rate.
+        :return: seconds until the next poll is due or None
+        """
+        if not self._polls:
+            return None
+        now = time.monotonic()
+        poll = self._polls[0]
+        if poll[0] > now:
+            return poll[0] - now
+        if self._send_queue or not self.connected:
+            return 1
+        self._enqueue(self._groupread_packet(poll[1]))
+        poll[0] += poll[2]
+        if poll[0] <= now:
+            # fell behind a whole interval, e.g. while disconnected
+            poll[0] = now + poll[2]
+        heapq.heapreplace(self._polls, poll)
+        return None
 
-        if 'ga' in kwargs:
-            self.groupread(kwargs['ga'])
-        else:
-            self.logger.warning('KNX[{0}]: problem polling {1}, no known ga'.format(self.get_instance_name(), item))
-        
-        if 'interval' in kwargs and 'ga' in kwargs:
-            ga = kwargs['ga']
-            interval = int(kwargs['interval'])
-            next = self._sh.now() + timedelta(seconds = interval)
-            self._sh.scheduler.add('KNX[{0}] poll {1}'.format(self.get_instance_name(), item), self._poll,
-                                   value={'instance': self.get_instance_name(), ITEM: item, 'ga': ga, 'interval': interval},
-                                   next=next)
+    def _send_worker(self):
+        while self.alive:
+            self._send_cond.acquire()
+            try:
+                if not self.connected:
+                    # keep the queue and the pending reads, handle_connect sends them again
+                    self._send_cond.wait(1)
+                    continue
+                timeout = self._expire_pending()
+                poll = self._poll_due()
+                if poll is not None and (timeout is None or poll < timeout):
+                    timeout = poll
+                if not self._send_queue:
+                    self._send_cond.wait(timeout if timeout is not None else 1)
+                    continue
+                pkt, ga, retries, limit = self._send_queue[0]
+                delay = self._send_delay() if limit else 0
+                if delay:
+                    self._send_cond.wait(delay)
+                    continue
+                self._send_queue.popleft()
+                if ga is not None:
+                    self._pending[_ga_int(ga)] = [ga, time.monotonic() + self._response_timeout, retries]
+            finally:
+                self._send_cond.release()
+            if self.connected:
+                self._send(pkt)
+            else:
+                self.logger.debug('KNX[{0}]: not connected, dropping telegram {1}'.format(self.get_instance_name(), binascii.hexlify(pkt).decode()))
 
     def _send_time(self):
         self.send_time(self.time_ga, self.date_ga)
@@ -230,29 +402,52 @@ class KNX(lib.connection.Client,SmartPlugin):
         enable_cache = bytearray([0, KNXD_CACHE_ENABLE])
         self._send(enable_cache)
         self.found_terminator = self.parse_length
-        if self._cache_ga != []:
-            if self.connected:
-                self.logger.debug('KNX[{0}]: reading knxd cache'.format(self.get_instance_name()))
+        # the send thread sends the cache reads, opens the group monitor and sends the init reads
+        # in this order, so the connection callback returns immediately
+        self._send_cond.acquire()
+        try:
+            # telegrams queued while disconnected and reads still waiting for a response on the
+            # previous connection are sent again, knxd control packets of the previous connection not
+            cache = []
+            queued = []
+            for entry in self._send_queue:
+                if not entry[3]:
+                    continue
+                if entry[0][1] == KNXD_CACHE_READ:
+                    cache.append(entry)
+                else:
+                    queued.append(entry)
+            for ga, deadline, retries in self._pending.values():
+                if ga in self._cache_ga_response_pending:
+                    cache.append((self._cacheread_packet(ga), ga, retries, True))
+                else:
+                    queued.append((self._groupread_packet(ga), ga, retries, True))
+            self._pending = {}
+            self._send_queue.clear()
+
+            if self._cache_ga != []:
+                self.logger.debug('KNX[{0}]: queue knxd cache read for {1} ga'.format(self.get_instance_name(), len(self._cache_ga)))
                 for ga in self._cache_ga:
                     self._cache_ga_response_pending.append(ga)
-                for ga in self._cache_ga:
-                    self._cacheread(ga)
-                    # wait a little to not overdrive the knxd unless there is a fix
-                    time.sleep(KNXD_CACHEREAD_DELAY)
+                    cache.append((self._cacheread_packet(ga), ga, self._response_retries, True))
+                self._startup['requested'] += len(self._cache_ga)
                 self._cache_ga = []
-                self.logger.debug('KNX[{0}]: finished reading knxd cache'.format(self.get_instance_name()))
-
-        self.logger.debug('KNX[{0}]: enable group monitor'.format(self.get_instance_name()))
-        init = bytearray([0, KNXD_OPEN_GROUPCON, 0, 0, 0])
-        self._send(init)
-        self.terminator = 2
-        if self._init_ga != []:
-            if self.connected:
-                self.logger.debug('KNX[{0}]: knxd init read for {1} ga'.format(self.get_instance_name(),len(self._init_ga)))
+            for entry in cache:
+                self._enqueue(*entry)
+
+            self.logger.debug('KNX[{0}]: enable group monitor'.format(self.get_instance_name()))
+            self._enqueue(bytearray([0, KNXD_OPEN_GROUPCON, 0, 0, 0]), limit=False)
+            for entry in queued:
+                self._enqueue(*entry)
+            if self._init_ga != []:
+                self.logger.debug('KNX[{0}]: queue knxd init read for {1} ga'.format(self.get_instance_name(), len(self._init_ga)))
                 for ga in self._init_ga:
-                    self.groupread(ga)
+                    self._enqueue(self._groupread_packet(ga), ga, self._response_retries)
+                self._startup['requested'] += len(self._init_ga)
                 self._init_ga = []
-                self.logger.debug('KNX[{0}]: finished knxd init read'.format(self.get_instance_name()))
+        finally:
+            self._send_cond.release()
+        self.terminator = 2
 
 #   def collect_incoming_data(self, data):
 #       print('#  bin   h  d')
@@ -290,103 +485,127 @@ class KNX(lib.connection.Client,SmartPlugin):
         # self.found_terminator is introduced in lib/connection.py
         self.found_terminator = self.parse_length  # reset parser and terminator
         self.terminator = 2
-        typ = struct.unpack(">H", data[0:2])[0]
-        if (typ != KNXD_GROUP_PACKET and typ != KNXD_CACHE_READ) or len(data) < 8:
+        if len(data) < 8:
+            # self.logger.debug("Ignore telegram.")
+            return
+        typ, src, dst = KNXD_HEADER.unpack_from(data)
+        if typ != KNXD_GROUP_PACKET and typ != KNXD_CACHE_READ:
             # self.logger.debug("Ignore telegram.")
             return
         if (data[6] & 0x03 or (data[7] & 0xC0) == 0xC0):
             self.logger.debug("KNX[{0}]: Unknown APDU".format(self.get_instance_name()))
             return
-        src = self.decode(data[2:4], 'pa')
-        dst = self.decode(data[4:6], 'ga')
-        flg = data[7] & 0xC0
-        if flg == KNXWRITE:
-            flg = 'write'
-        elif flg == KNXREAD:
-            flg = 'read'
-        elif flg == KNXRESP:
-            flg = 'response'
-        else:
-            self.logger.warning("KNX[{0}]: Unknown flag: {1:02x} src: {2} dest: {3}".format(self.get_instance_name(), flg, src, dst))
-            return
-        if len(data) == 8:
-            payload = bytearray([data[7] & 0x3f])
-        else:
-            payload = data[8:]
+        flg = data[7] >> 6          # index into KNX_FLAGS
 
         if self.enable_stats:
-            # update statistics on used group addresses
-            if not dst in self.stats_ga:
-                self.stats_ga[dst] = {}
-
-            if not flg in self.stats_ga[dst]:
-                self.stats_ga[dst][flg] = 1
-            else:
-                self.stats_ga[dst][flg] = self.stats_ga[dst][flg] + 1
-
-            # update statistics on used group addresses
-            if not src in self.stats_pa:
-                self.stats_pa[src] = {}
-
-            if not flg in self.stats_pa[src]:
-                self.stats_pa[src][flg] = 1
-            else:
-                self.stats_pa[src][flg] = self.stats_pa[src][flg] + 1
+            # update statistics on used group and physical addresses
+            counters = self._stats_ga.get(dst)
+            if counters is None:
+                counters = self._stats_ga[dst] = [0, 0, 0]
+            counters[flg] += 1
+            counters = self._stats_pa.get(src)
+            if counters is None:
+                counters = self._stats_pa[src] = [0, 0, 0]
+            counters[flg] += 1
 
         # further inspect what to do next
-        if flg == 'write' or flg == 'response':
-            if dst not in self.gal:  # update item/logic
-                self._busmonitor(self._bm_format.format(self.get_instance_name(), src, dst, binascii.hexlify(payload).decode()))
+        if flg != KNXREAD >> 6:
+            if self._pending and dst in self._pending:
+                self._answered(dst)
+            if len(data) == 8:
+                payload = bytearray([data[7] & 0x3f])
+            else:
+                payload = data[8:]
+            listen = self.gal.get(dst)
+            if listen is None:  # update item/logic
+                if self._bm_logger.isEnabledFor(self._bm_level):
+                    self._busmonitor(self._bm_format.format(self.get_instance_name(), _pa_str(src), _ga_str(dst), binascii.hexlify(payload).decode()))
                 return
-            dpt = self.gal[dst][DPT]
+            ga = listen[GA]
             try:
-                val = self.decode(payload, dpt)
+                val = listen[DECODE](payload)
             except Exception as e:
-                self.logger.exception("KNX[{0}]: Problem decoding frame from {1} to {2} with '{3}' and DPT {4}. Exception: {5}".format(self.get_instance_name(), src, dst, binascii.hexlify(payload).decode(), dpt, e))
+                self.logger.exception("KNX[{0}]: Problem decoding frame from {1} to {2} with '{3}' and DPT {4}. Exception: {5}".format(self.get_instance_name(), _pa_str(src), ga, binascii.hexlify(payload).decode(), listen[DPT], e))
                 return
             if val is not None:
-                self._busmonitor(self._bm_format.format(self.get_instance_name(), src, dst, val))
-                #print "in:  {0}".format(self.decode(payload, 'hex'))
-                #out = ''
-                #for i in self.encode(val, dpt):
-                #    out += " {0:x}".format(i)
-                #print "out:{0}".format(out)
+                src = _pa_str(src)
+                if self._bm_logger.isEnabledFor(self._bm_level):
+                    self._busmonitor(self._bm_format.format(self.get_instance_name(), src, ga, val))
 
                 # remove all ga that came from a cache read request
                 if typ == KNXD_CACHE_READ:
-                    if dst in self._cache_ga_response_pending:
-                        self._cache_ga_response_pending.remove(dst)
-                way = "" if typ != KNXD_CACHE_READ else " (from knxd Cache)"
-                self.logger.debug("KNX[{0}]: {5} request from {1} to {2} with '{3}' and DPT {4}{6}".format(self.get_instance_name(), src, dst, binascii.hexlify(payload).decode(), dpt, flg, way))
-                for item in self.gal[dst][ITEMS]:
-                    item(val, 'KNX', src, dst)
-                for logic in self.gal[dst][LOGICS]:
-                    logic.trigger('KNX', src, val, dst)
+                    if ga in self._cache_ga_response_pending:
+                        self._cache_ga_response_pending.remove(ga)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    way = "" if typ != KNXD_CACHE_READ else " (from knxd Cache)"
+                    self.logger.debug("KNX[{0}]: {5} request from {1} to {2} with '{3}' and DPT {4}{6}".format(self.get_instance_name(), src, ga, binascii.hexlify(payload).decode(), listen[DPT], KNX_FLAGS[flg], way))
+                for item in listen[ITEMS]:
+                    item(val, 'KNX', src, ga)
+                for logic in listen[LOGICS]:
+                    logic.trigger('KNX', src, val, ga)
             else:
-                self.logger.warning("KNX[{0}]: Wrong payload '{3}' for ga '{2}' with dpt '{1}'.".format(self.get_instance_name(), dpt, dst, binascii.hexlify(payload).decode()))
+                self.logger.warning("KNX[{0}]: Wrong payload '{3}' for ga '{2}' with dpt '{1}'.".format(self.get_instance_name(), listen[DPT], ga, binascii.hexlify(payload).decode()))
             if self.enable_stats:
-                if flg == 'write':
+                if flg == KNXWRITE >> 6:
                     self.stats_last_write = self._sh.now()
                 else:
                     self.stats_last_response = self._sh.now()
-        elif flg == 'read':
-            self.logger.debug("KNX[{0}]: {1} read {2}".format(self.get_instance_name(), src, dst))
+        else:
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("KNX[{0}]: {1} read {2}".format(self.get_instance_name(), _pa_str(src), _ga_str(dst)))
             if self.enable_stats:
                 self.stats_last_read = self._sh.now()
-            if dst in self.gar:  # read item
-                if self.gar[dst][ITEM] is not None:
-                    item = self.gar[dst][ITEM]
-                    self.groupwrite(dst, item(), self.get_iattr_value(item.conf,KNX_DPT), 'response')
-                if self.gar[dst][LOGIC] is not None:
-                    self.gar[dst][LOGIC].trigger('KNX', src, None, dst)
+            reply = self.gar.get(dst)
+            if reply is not None:  # read item
+                if reply[ITEM] is not None:
+                    item = reply[ITEM]
+                    self.groupwrite(reply[GA], item(), reply[DPT], 'response')
+                if reply[LOGIC] is not None:
+                    reply[LOGIC].trigger('KNX', _pa_str(src), None, reply[GA])
 
     def run(self):
         self.alive = True
+        self._schedule_polls()
+        self._send_thread = threading.Thread(target=self._send_worker, name='KNX[{0}] send'.format(self.get_instance_name()))
+        self._send_thread.daemon = True
+        self._send_thread.start()
 
     def stop(self):
         self.alive = False
+        self._send_cond.acquire()
+        self._send_cond.notify()
+        self._send_cond.release()
         self.handle_close()
 
+    def _ga_int(self, ga, obj):
+        """
+        converts a configured group address to its raw integer, warns and returns None if it is malformed
+        :param ga: group address string like '1/2/3'
+        :param obj: item or logic the group address is configured for
+        """
+        try:
+            return _ga_int(ga)
+        except (AttributeError, ValueError):
+            self.logger.warning("KNX[{0}]: Ignoring invalid ga '{1}' of {2}".format(self.get_instance_name(), ga, obj))
+            return None
+
+    def _listen(self, ga, dpt, obj):
+        """
+        returns the entry in self.gal for a group address and creates it if needed
+        The decoder for the dpt is looked up once here so parse_telegram can call it directly.
+        :param ga: group address string like '1/2/3'
+        :param dpt: data point type of the first item or logic listening on this ga
+        :param obj: item or logic the group address is configured for
+        :return: dict or None if the group address is malformed
+        """
+        gai = self._ga_int(ga, obj)
+        if gai is None:
+            return None
+        listen = self.gal.get(gai)
+        if listen is None:
+            listen = self.gal[gai] = {GA: _ga_str(gai), DPT: dpt, DECODE: dpts.decode[str(dpt)], ITEMS: [], LOGICS: []}
+        return listen
+
     def parse_item(self, item):
         """
         examines item attributes to see if action is needed by change of the item via SmartHomeNG
@@ -424,31 +643,27 @@ class KNX(lib.connection.Client,SmartPlugin):
                 knx_listen = [knx_listen, ]
             for ga in knx_listen:
                 self.logger.debug("KNX[{0}]: {1} listen on {2}".format(self.get_instance_name(), item, ga))
-                if not ga in self.gal:
-                    self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: []}
-                else:
-                    if not item in self.gal[ga][ITEMS]:
-                        self.gal[ga][ITEMS].append(item)
+                listen = self._listen(ga, dpt, item)
+                if listen is not None and not item in listen[ITEMS]:
+                    listen[ITEMS].append(item)
 
         if self.has_iattr(item.conf, KNX_INIT):
             ga = self.get_iattr_value(item.conf, KNX_INIT)
             self.logger.debug("KNX[{0}]: {1} listen on and init with {2}".format(self.get_instance_name(), item, ga))
-            if not ga in self.gal:
-                self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: []}
-            else:
-                if not item in self.gal[ga][ITEMS]:
-                    self.gal[ga][ITEMS].append(item)
-            self._init_ga.append(ga)
+            listen = self._listen(ga, dpt, item)
+            if listen is not None:
+                if not item in listen[ITEMS]:
+                    listen[ITEMS].append(item)
+                self._init_ga.append(listen[GA])
 
         if self.has_iattr(item.conf, KNX_CACHE):
             ga = self.get_iattr_value(item.conf, KNX_CACHE)
             self.logger.debug("KNX[{0}]: {1} listen on and init with cache {2}".format(self.get_instance_name(), item, ga))
-            if not ga in self.gal:
-                self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: []}
-            else:
-                if not item in self.gal[ga][ITEMS]:
-                    self.gal[ga][ITEMS].append(item)
-            self._cache_ga.append(ga)
+            listen = self._listen(ga, dpt, item)
+            if listen is not None:
+                if not item in listen[ITEMS]:
+                    listen[ITEMS].append(item)
+                self._cache_ga.append(listen[GA])
 
         if self.has_iattr(item.conf, KNX_REPLY):
             knx_reply = self.get_iattr_value(item.conf, KNX_REPLY)
@@ -456,12 +671,15 @@ class KNX(lib.connection.Client,SmartPlugin):
                 knx_reply = [knx_reply, ]
             for ga in knx_reply:
                 self.logger.debug("KNX[{0}]: {1} reply to {2}".format(self.get_instance_name(), item, ga))
-                if ga not in self.gar:
-                    self.gar[ga] = {DPT: dpt, ITEM: item, LOGIC: None}
+                gai = self._ga_int(ga, item)
+                if gai is None:
+                    continue
+                if gai not in self.gar:
+                    self.gar[gai] = {GA: _ga_str(gai), DPT: dpt, ITEM: item, LOGIC: None}
                 else:
                     self.logger.warning(
                         "KNX[{0}]: {1} knx_reply ({2}) already defined for {3}".format(self.get_instance_name(), item.id(), ga,
-                                                                                       self.gar[ga][ITEM]))
+                                                                                       self.gar[gai][ITEM]))
 
         if self.has_iattr(item.conf, KNX_SEND):
             if isinstance(self.get_iattr_value(item.conf, KNX_SEND), str):
@@ -473,30 +691,42 @@ class KNX(lib.connection.Client,SmartPlugin):
                 self.set_attr_value(item.conf, KNX_STATUS, [self.get_iattr_value(item.conf, KNX_STATUS), ])
                 #item.conf['knx_status'] = [self.get_iattr_value(item.conf,'knx_status'), ]
 
-        if self.has_iattr(item.conf, KNX_STATUS) or self.has_iattr(item.conf, KNX_SEND):
-            return self.update_item
-
         if self.has_iattr(item.conf, KNX_POLL):
-            #
-            # Todo: 
-            # - knx_poll = ga | poll_time
-            # - use the instance aware function self.get_iattr_value instead of intem.conf[...]
-            #
-            if self.has_iattr(item.conf, KNX_LISTEN):
-                knx_listen = item.conf[KNX_LISTEN]
-                poll_interval = int(item.conf[KNX_POLL])
-                self.logger.info(
-                    "KNX[{0}]: Item {1} is polled on GA {2} every {3} seconds".format(self.get_instance_name(), item, knx_listen,
-                                                                                      poll_interval))
-                randomwait = random.randrange(15)
-                next = self._sh.now() + timedelta(seconds=poll_interval + randomwait)
-                self._sh.scheduler.add('KNX[{0}] poll {1}'.format(self.get_instance_name(), item), self._poll,
-                                       value={ITEM: item, 'ga': knx_listen, 'interval': poll_interval}, next=next)
+            # knx_poll = ga | poll_time or just the poll_time to poll the first knx_listen ga
+            knx_poll = self.get_iattr_value(item.conf, KNX_POLL)
+            if isinstance(knx_poll, list) and len(knx_poll) == 2:
+                ga, poll_interval = knx_poll
+                listen = self._listen(ga, dpt, item)
+                if listen is not None and not item in listen[ITEMS]:
+                    listen[ITEMS].append(item)
+            elif self.has_iattr(item.conf, KNX_LISTEN):
+                ga = self.get_iattr_value(item.conf, KNX_LISTEN)
+                if isinstance(ga, list):
+                    ga = ga[0]
+                poll_interval = knx_poll
             else:
+                ga = None
                 self.logger.warning(
                     "KNX[{0}]: Ignoring knx_poll for item {1}: please add a knx_listen GA to poll.".format(
                         self.get_instance_name(), item))
-                pass
+            if ga is not None:
+                gai = self._ga_int(ga, item)
+                try:
+                    poll_interval = int(poll_interval)
+                except (TypeError, ValueError):
+                    self.logger.warning("KNX[{0}]: Ignoring knx_poll for item {1}: invalid interval {2}".format(
+                        self.get_instance_name(), item, poll_interval))
+                    gai = None
+                if gai is not None and poll_interval > 0:
+                    ga = _ga_str(gai)
+                    self.logger.info(
+                        "KNX[{0}]: Item {1} is polled on GA {2} every {3} seconds".format(self.get_instance_name(), item, ga,
+                                                                                          poll_interval))
+                    # several items polling the same ga share the shortest interval
+                    self._poll_ga[ga] = min(poll_interval, self._poll_ga.get(ga, poll_interval))
+
+        if self.has_iattr(item.conf, KNX_STATUS) or self.has_iattr(item.conf, KNX_SEND):
+            return self.update_item
 
         return None
 
@@ -523,10 +753,9 @@ class KNX(lib.connection.Client,SmartPlugin):
                 knx_listen = [knx_listen, ]
             for ga in knx_listen:
                 self.logger.debug("KNX[{0}]: {1} listen on {2}".format(self.get_instance_name(), logic, ga))
-                if not ga in self.gal:
-                    self.gal[ga] = {DPT: dpt, ITEMS: [], LOGICS: [logic]}
-                else:
-                    self.gal[ga][LOGICS].append(logic)
+                listen = self._listen(ga, dpt, logic)
+                if listen is not None:
+                    listen[LOGICS].append(logic)
 
         if KNX_REPLY in logic.conf:
             knx_reply = logic.conf[KNX_REPLY]
@@ -534,14 +763,17 @@ class KNX(lib.connection.Client,SmartPlugin):
                 knx_reply = [knx_reply, ]
             for ga in knx_reply:
                 self.logger.debug("KNX[{0}]: {1} reply to {2}".format(self.get_instance_name(), logic, ga))
-                if ga in self.gar:
-                    if self.gar[ga][LOGIC] is False:
-                        obj = self.gar[ga][ITEM]
+                gai = self._ga_int(ga, logic)
+                if gai is None:
+                    continue
+                if gai in self.gar:
+                    if self.gar[gai][LOGIC] is False:
+                        obj = self.gar[gai][ITEM]
                     else:
-                        obj = self.gar[ga][LOGIC]
+                        obj = self.gar[gai][LOGIC]
                     self.logger.warning("KNX[{0}]: {1} knx_reply ({2}) already defined for {3}".format(self.get_instance_name(), logic, ga, obj))
                 else:
-                    self.gar[ga] = {DPT: dpt, ITEM: None, LOGIC: logic}
+                    self.gar[gai] = {GA: _ga_str(gai), DPT: dpt, ITEM: None, LOGIC: logic}
 
     def update_item(self, item, caller=None, source=None, dest=None):
         """
@@ -598,17 +830,15 @@ class KNX(lib.connection.Client,SmartPlugin):
         """
         clear statistic values for group addresses
         """
-        if len(self.stats_ga):
-            for ga in self.stats_ga:
-                self.stats_ga[ga] = {}
+        for counters in self._stats_ga.values():
+            counters[:] = [0, 0, 0]
 
     def clear_stats_pa(self):
         """
         clear statistic values for physical addresses
         """
-        if len(self.stats_pa):
-            for ga in self.stats_pa:
-                self.stats_pa[ga] = {}
+        for counters in self._stats_pa.values():
+            counters[:] = [0, 0, 0]
 
     def get_stats_ga(self):
         """
@@ -624,7 +854,7 @@ class KNX(lib.connection.Client,SmartPlugin):
         ```
         :return: dict
         """
-        return self.stats_ga
+        return self._render_stats(self._stats_ga, _ga_str)
 
     def get_stats_pa(self):
         """
@@ -640,7 +870,16 @@ class KNX(lib.connection.Client,SmartPlugin):
         ```
         :return: dict
         """
-        return self.stats_pa
+        return self._render_stats(self._stats_pa, _pa_str)
+
+    def _render_stats(self, stats, to_str):
+        """
+        converts the integer keyed counters collected in parse_telegram to the dict returned by get_stats_ga/get_stats_pa
+        """
+        rendered = {}
+        for address, counters in list(stats.items()):
+            rendered[to_str(address)] = {KNX_FLAGS[flg]: n for flg, n in enumerate(counters) if n}
+        return rendered
 
     def get_stats_last_read(self):
         """
@@ -673,6 +912,21 @@ class KNX(lib.connection.Client,SmartPlugin):
             ar.remove(None)
         return max(ar)
 
+    def get_startup_progress(self):
+        """
+        returns the progress of the knx_cache and knx_init reads sent after connecting to knxd
+        ```
+        { 'requested' : n,      # number of ga read at startup
+          'answered' : n,       # ga which sent a response
+          'failed' : n,         # ga without response after all retries
+          'pending' : n }       # ga still queued or waiting for a response
+        ```
+        :return: dict
+        """
+        progress = dict(self._startup)
+        progress['pending'] = progress['requested'] - progress['answered'] - progress['failed']
+        return progress
+
     def get_unsatisfied_cache_read_ga(self):
         """
         At start all items that have a knx_cache attribute will be queried to knxd
@@ -22,6 +22,19 @@
 import struct
 import datetime
 
+# precompiled structs, saves the format cache lookup of struct.pack/unpack on every call
+_U8 = struct.Struct('>B')
+_S8 = struct.Struct('b')
+_U16 = struct.Struct('>H')
+_S16 = struct.Struct('>h')
+_U32 = struct.Struct('>I')
+_S32 = struct.Struct('>i')
+_F32 = struct.Struct('>f')
+_RGB = struct.Struct('>BBB')
+
+# DPT 9: value = 0.01 * mantissa * 2^exponent, one factor per 4 bit exponent
+_DPT9_SCALE = [0.01 * pow(2, e) for e in range(16)]
+
 
 def en1(value):
     return [int(value) & 0x01]
@@ -81,7 +94,7 @@ def en5(value):
 def de5(payload):
     if len(payload) != 1:
         return None
-    return round(struct.unpack('>B', payload)[0], 1)
+    return round(_U8.unpack(payload)[0], 1)
 
 
 def en5001(value):
@@ -95,7 +108,7 @@ def en5001(value):
 def de5001(payload):
     if len(payload) != 1:
         return None
-    return round(struct.unpack('>B', payload)[0] * 100.0 / 255, 1)
+    return round(_U8.unpack(payload)[0] * 100.0 / 255, 1)
 
 
 def en6(value):
@@ -103,25 +116,25 @@ def en6(value):
         value = -128
     elif value > 127:
         value = 127
-    return [0, struct.pack('b', int(value))[0]]
+    return [0, _S8.pack(int(value))[0]]
 
 
 def de6(payload):
     if len(payload) != 1:
         return None
-    return struct.unpack('b', payload)[0]
+    return _S8.unpack(payload)[0]
 
 
 def en7(value):
     ret = bytearray([0])
-    ret.extend(struct.pack('>H', int(value)))
+    ret.extend(_U16.pack(int(value)))
     return ret
 
 
 def de7(payload):
     if len(payload) != 2:
         return None
-    return struct.unpack('>H', payload)[0]
+    return _U16.unpack(payload)[0]
 
 
 def en8(value):
@@ -130,26 +143,28 @@ def en8(value):
     elif value > 32767:
         value = 32767
     ret = bytearray([0])
-    ret.extend(struct.pack('>h', int(value)))
+    ret.extend(_S16.pack(int(value)))
     return ret
 
 
 def de8(payload):
     if len(payload) != 2:
         return None
-    return struct.unpack('>h', payload)[0]
+    return _S16.unpack(payload)[0]
 
 
 def en9(value):
     s = 0
-    e = 0
     if value < 0:
         s = 0x8000
     m = int(value * 100)
-    while (m > 2047) or (m < -2048):
-        e = e + 1
-        m = m >> 1
-    num = s | (e << 11) | (int(m) & 0x07ff)
+    # smallest exponent that fits the mantissa into 12 bit two's complement
+    e = (m if m >= 0 else ~m).bit_length() - 11
+    if e > 0:
+        m = m >> e
+    else:
+        e = 0
+    num = s | (e << 11) | (m & 0x07ff)
     return en7(num)
 
 
@@ -157,14 +172,10 @@ def de9(payload):
     if len(payload) != 2:
         return None
     i1 = payload[0]
-    i2 = payload[1]
-    s = (i1 & 0x80) >> 7
-    e = (i1 & 0x78) >> 3
-    m = (i1 & 0x07) << 8 | i2
-    if s == 1:
-        s = -1 << 11
-    f = (m | s) * 0.01 * pow(2, e)
-    return round(f, 2)
+    m = (i1 & 0x07) << 8 | payload[1]
+    if i1 & 0x80:
+        m = m | (-1 << 11)
+    return round(m * _DPT9_SCALE[(i1 & 0x78) >> 3], 2)
 
 
 def en10(dt):
@@ -195,14 +206,14 @@ def en12(value):
     elif value > 4294967295:
         value = 4294967295
     ret = bytearray([0])
-    ret.extend(struct.pack('>I', int(value)))
+    ret.extend(_U32.pack(int(value)))
     return ret
 
 
 def de12(payload):
     if len(payload) != 4:
         return None
-    return struct.unpack('>I', payload)[0]
+    return _U32.unpack(payload)[0]
 
 
 def en13(value):
@@ -211,26 +222,26 @@ def en13(value):
     elif value > 2147483647:
         value = 2147483647
     ret = bytearray([0])
-    ret.extend(struct.pack('>i', int(value)))
+    ret.extend(_S32.pack(int(value)))
     return ret
 
 
 def de13(payload):
     if len(payload) != 4:
         return None
-    return struct.unpack('>i', payload)[0]
+    return _S32.unpack(payload)[0]
 
 
 def en14(value):
     ret = bytearray([0])
-    ret.extend(struct.pack('>f', value))
+    ret.extend(_F32.pack(value))
     return ret
 
 
 def de14(payload):
     if len(payload) != 4:
         return None
-    return struct.unpack('>f', payload)[0]
+    return _F32.unpack(payload)[0]
 
 
 def en16000(value):
@@ -262,7 +273,28 @@ def en17(value):
 def de17(payload):
     if len(payload) != 1:
         return None
-    return struct.unpack('>B', payload)[0] & 0x3f
+    return payload[0] & 0x3f
+
+
+def en19(dt):
+    # daylight saving time is signalled by the SUTI flag, the clock quality byte is left at 0
+    flags = 0x01 if dt.dst() else 0x00
+    return [0, dt.year - 1900, dt.month, dt.day, (dt.isoweekday() << 5) | dt.hour, dt.minute, dt.second, flags, 0]
+
+
+def de19(payload):
+    if len(payload) != 8:
+        return None
+    # fault, no year, no date or no time flag set
+    if payload[6] & 0x9a:
+        return None
+    y = payload[0] + 1900
+    m = payload[1] & 0x0f
+    d = payload[2] & 0x1f
+    h = payload[3] & 0x1f
+    if h == 24:  # 24:00:00 is the end of the day
+        return datetime.datetime(y, m, d) + datetime.timedelta(days=1)
+    return datetime.datetime(y, m, d, h, payload[4] & 0x3f, payload[5] & 0x3f)
 
 
 def en20(value):
@@ -272,7 +304,7 @@ def en20(value):
 def de20(payload):
     if len(payload) != 1:
         return None
-    return struct.unpack('>B', payload)[0]
+    return payload[0]
 
 
 def en24(value):
@@ -286,6 +318,17 @@ def de24(payload):
     return payload.rstrip(b'\x00').decode('iso-8859-1')
 
 
+def en28(value):
+    enc = bytearray(1)
+    enc.extend(value.encode('utf-8', 'replace'))
+    enc.append(0)
+    return enc
+
+
+def de28(payload):
+    return payload.rstrip(b'\x00').decode('utf-8', 'replace')
+
+
 def en232(value):
     return [0, int(value[0]) & 0xff, int(value[1]) & 0xff, int(value[2]) & 0xff]
 
@@ -293,13 +336,13 @@ def en232(value):
 def de232(payload):
     if len(payload) != 3:
         return None
-    return list(struct.unpack('>BBB', payload))
+    return list(_RGB.unpack(payload))
 
 
 def depa(string):
     if len(string) != 2:
         return None
-    pa = struct.unpack(">H", string)[0]
+    pa = _U16.unpack(string)[0]
     return "{0}.{1}.{2}".format((pa >> 12) & 0x0f, (pa >> 8) & 0x0f, (pa) & 0xff)
 
 
@@ -311,7 +354,7 @@ def enga(ga):
 def dega(string):
     if len(string) != 2:
         return None
-    ga = struct.unpack(">H", string)[0]
+    ga = _U16.unpack(string)[0]
     return "{0}/{1}/{2}".format((ga >> 11) & 0x1f, (ga >> 8) & 0x07, (ga) & 0xff)
 
 
@@ -338,8 +381,10 @@ decode = {
     '16001': de16001,
     '16.001': de16001,
     '17': de17,
+    '19': de19,
     '20': de20,
     '24': de24,
+    '28': de28,
     '232': de232,
     'pa': depa,
     'ga': dega
@@ -368,9 +413,32 @@ encode = {
     '16001': en16001,
     '16.001': en16001,
     '17': en17,
+    '19': en19,
     '20': en20,
     '24': en24,
+    '28': en28,
     '232': en232,
     'ga': enga
 }
-# DPT: 19, 28
+
+
+def decode_many(payloads, dpt):
+    """
+    decodes a sequence of payloads of the same dpt, e.g. when replaying a busmonitor log
+    :param payloads: iterable of bytes/bytearray payloads
+    :param dpt: data point type as used in knx_dpt
+    :return: list of decoded values, None for payloads that do not fit the dpt
+    """
+    dec = decode[str(dpt)]
+    return [dec(payload) for payload in payloads]
+
+
+def encode_many(values, dpt):
+    """
+    encodes a sequence of values of the same dpt
+    :param values: iterable of values
+    :param dpt: data point type as used in knx_dpt
+    :return: list of encoded payloads as returned by the single value encoders
+    """
+    enc = encode[str(dpt)]
+    return [enc(value) for value in values]
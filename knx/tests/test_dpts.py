@@ -0,0 +1,55 @@
+import datetime
+import unittest
+
+from plugins.knx import dpts
+
+
+def roundtrip(value, dpt):
+    # encoders prepend the APCI byte which is not part of the payload handed to the decoders
+    return dpts.decode[dpt](bytes(dpts.encode[dpt](value))[1:])
+
+
+class TestDpts(unittest.TestCase):
+
+    def test_dpt9_roundtrip(self):
+        for value in [0, 0.01, -0.01, 20.48, -20.48, 21.5, -273.0, 670760.96, -671088.64]:
+            self.assertAlmostEqual(value, roundtrip(value, '9'), delta=abs(value) / 1000 + 0.01)
+
+    def test_dpt9_decode(self):
+        self.assertEqual(21.0, dpts.de9(bytes([0x0c, 0x1a])))
+        self.assertEqual(-0.01, dpts.de9(bytes([0x87, 0xff])))
+        self.assertEqual(670760.96, dpts.de9(bytes([0x7f, 0xff])))
+        self.assertIsNone(dpts.de9(bytes([0x0c])))
+
+    def test_dpt9_encode(self):
+        self.assertEqual(bytes([0, 0x0c, 0x1a]), bytes(dpts.en9(21.0)))
+        self.assertEqual(bytes([0, 0x87, 0xff]), bytes(dpts.en9(-0.01)))
+
+    def test_dpt19_roundtrip(self):
+        value = datetime.datetime(2017, 3, 4, 13, 14, 15)
+        self.assertEqual(value, roundtrip(value, '19'))
+
+    def test_dpt19_end_of_day(self):
+        payload = bytes([117, 3, 4, (6 << 5) | 24, 0, 0, 0, 0])
+        self.assertEqual(datetime.datetime(2017, 3, 5), dpts.de19(payload))
+
+    def test_dpt19_invalid(self):
+        payload = bytes([117, 3, 4, 13, 14, 15, 0x80, 0])
+        self.assertIsNone(dpts.de19(payload))
+        self.assertIsNone(dpts.de19(payload[:7]))
+
+    def test_dpt28_roundtrip(self):
+        self.assertEqual('Grüße ✓', roundtrip('Grüße ✓', '28'))
+
+    def test_decode_many(self):
+        payloads = [bytes([0x0c, 0x1a]), bytes([0x0c]), bytes([0x87, 0xff])]
+        self.assertEqual([21.0, None, -0.01], dpts.decode_many(payloads, '9'))
+        self.assertEqual([True, False], dpts.decode_many([bytes([1]), bytes([0])], 1))
+
+    def test_encode_many(self):
+        self.assertEqual([bytes(dpts.en9(21.0)), bytes(dpts.en9(-0.01))],
+                         [bytes(p) for p in dpts.encode_many([21.0, -0.01], '9')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Encode/decode timings per DPT, run with
+
+    python -m pytest plugins/knx/tests/test_dpts_benchmark.py --benchmark-columns=min,mean,ops
+
+Each round converts a batch of BATCH values, so the reported mean divided by BATCH is the time per telegram.
+Skipped if pytest-benchmark is not installed.
+"""
+import datetime
+
+import pytest
+
+from plugins.knx import dpts
+
+pytest.importorskip('pytest_benchmark')
+
+BATCH = 1000
+
+SAMPLES = {
+    '1': True,
+    '2': [1, 0],
+    '3': [1, 5],
+    '4.002': 'c',
+    '5': 200,
+    '5.001': 50,
+    '6': -100,
+    '7': 60000,
+    '8': -30000,
+    '9': 21.5,
+    '10': datetime.datetime(2017, 3, 4, 13, 14, 15),
+    '11': datetime.date(2017, 3, 4),
+    '12': 4000000000,
+    '13': -2000000000,
+    '14': 3.14,
+    '16': 'SmartHomeNG',
+    '16.001': 'SmartHomeNG',
+    '17': 42,
+    '19': datetime.datetime(2017, 3, 4, 13, 14, 15),
+    '20': 3,
+    '24': 'SmartHomeNG',
+    '28': 'SmartHomeNG',
+    '232': [255, 128, 0],
+}
+
+
+def payload(dpt):
+    enc = bytes(dpts.encode[dpt](SAMPLES[dpt]))
+    # dpt 1-3 are encoded into the APCI byte, all others are prefixed with it
+    return enc if len(enc) == 1 else enc[1:]
+
+
+@pytest.mark.parametrize('dpt', sorted(SAMPLES))
+def test_encode(benchmark, dpt):
+    values = [SAMPLES[dpt]] * BATCH
+    benchmark.group = 'encode'
+    benchmark(dpts.encode_many, values, dpt)
+
+
+@pytest.mark.parametrize('dpt', sorted(SAMPLES))
+def test_decode(benchmark, dpt):
+    payloads = [payload(dpt)] * BATCH
+    benchmark.group = 'decode'
+    values = benchmark(dpts.decode_many, payloads, dpt)
+    assert values[0] is not None
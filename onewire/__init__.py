@@ -19,13 +19,23 @@
 #  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import concurrent.futures
 import logging
+import queue
 import socket
+import struct
 import threading
 import time
 
 logger = logging.getLogger('')
 
+# family codes of the DS18x20 temperature sensors converted by /simultaneous/temperature
+SIMULTANEOUS_FAMILIES = ('10', '22', '28', '3B')
+SIMULTANEOUS_WAIT = 0.8  # seconds, 12 bit conversion of a DS18B20 takes up to 750 ms
+
+OW_HEADER = struct.Struct('>iiiiii')  # version, payload length, type/return value, flags, size, offset
+OW_PERSISTENCE = 0x00000004
+
 
 class owex(Exception):
     pass
@@ -42,18 +52,18 @@ class OwBase():
         self.port = int(port)
         self._lock = threading.Lock()
         self._flag = 0x00000100   # ownet
-        self._flag += 0x00000004  # persistence
+        self._flag += OW_PERSISTENCE
         self._flag += 0x00000002  # list special directories
         self.connected = False
         self._connection_attempts = 0
         self._connection_errorlog = 60
+        self.persistent = None  # granted by owserver with the first reply of a connection
+        self._stats = {}  # path: [requests, errors, latency sum, latency max]
 
     def connect(self):
         self._lock.acquire()
         try:
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._sock.settimeout(2)
-            self._sock.connect((self.host, self.port))
+            self._open()
         except Exception as e:
             self._connection_attempts -= 1
             if self._connection_attempts <= 0:
@@ -62,7 +72,6 @@ class OwBase():
             self._lock.release()
             return
         else:
-            self.connected = True
             logger.info('1-Wire: connected to {0}:{1}'.format(self.host, self.port))
             self._connection_attempts = 0
             self._lock.release()
@@ -71,9 +80,23 @@ class OwBase():
         except Exception as e:
             pass
 
+    def _open(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.settimeout(2)
+        self._sock.connect((self.host, self.port))
+        self.connected = True
+        self.persistent = None
+
     def read(self, path):
         return self._request(path, cmd=2)
 
+    def read_many(self, paths):
+        """
+        reads several paths with one round trip if owserver granted persistence
+        returns a list with the payload or the exception of every path
+        """
+        return self._pipeline([(path, 2, None) for path in paths])
+
     def write(self, path, value):
         return self._request(path, cmd=3, value=value)
 
@@ -91,72 +114,106 @@ class OwBase():
                 self.tree(item)
 
     def _request(self, path, cmd=10, value=None):
-        if value is not None:
-            payload = path + '\x00' + str(value) + '\x00'
-            data = len(str(value)) + 1
-        else:
-            payload = path + '\x00'
-            data = 65536
-        header = bytearray(24)
-        header[4:8] = len(payload).to_bytes(4, byteorder='big')
-        header[8:12] = cmd.to_bytes(4, byteorder='big')
-        header[12:16] = self._flag.to_bytes(4, byteorder='big')
-        header[16:20] = data.to_bytes(4, byteorder='big')
+        result = self._pipeline([(path, cmd, value)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _pipeline(self, requests):
         if not self.connected:
             raise owex("No connection to owserver.")
         self._lock.acquire()
         try:
-            data = header + payload.encode()
-            self._sock.sendall(data)
-        except Exception as e:
-            self.close()
+            return self._transact(requests)
+        finally:
             self._lock.release()
-            raise owex("error sending request: {0}".format(e))
-        while True:
-            header = bytearray()
+
+    def _transact(self, requests):
+        results = []
+        retried = False
+        while len(results) < len(requests):
+            if not self.connected or self.persistent is False:  # owserver closes the connection after every reply without persistence
+                try:
+                    self._open()
+                except Exception as e:
+                    self.close()
+                    raise owex("error connecting: {0}".format(e))
+            pending = requests[len(results):]
+            if not self.persistent:  # pipeline only if the connection stays open
+                pending = pending[:1]
+            start = time.time()
             try:
-                header = self._sock.recv(24)
-            except socket.timeout:
+                self._sock.sendall(b''.join(self._message(*request) for request in pending))
+                for path, cmd, value in pending:
+                    results.append(self._reply(path, cmd, start))
+            except ConnectionError as e:
                 self.close()
-                self._lock.release()
-                raise owex("error receiving header: timeout")
-            except Exception as e:
+                if retried:
+                    self._count(requests[len(results)][0], None)
+                    raise owex("error receiving reply: {0}".format(e))
+                retried = True  # owserver dropped an idle connection, try once more
+            except socket.timeout:
                 self.close()
-                self._lock.release()
-                raise owex("error receiving header: {0}".format(e))
-            if len(header) != 24:
+                self._count(requests[len(results)][0], None)
+                raise owex("error receiving reply: timeout")
+            except OSError as e:
                 self.close()
-                self._lock.release()
-                raise owex("error receiving header: no data")
-#           version = int.from_bytes(data[0:4], byteorder='big')
-            length = int.from_bytes(header[4:8], byteorder='big')
-            ret = int.from_bytes(header[8:12], byteorder='big')
-#           flags = int.from_bytes(data[12:16], byteorder='big')
-#           size = int.from_bytes(data[16:20], byteorder='big')
-#           offset = int.from_bytes(data[20:24], byteorder='big')
-            if not length == 4294967295:
+                self._count(requests[len(results)][0], None)
+                raise owex("error receiving reply: {0}".format(e))
+        return results
+
+    def _message(self, path, cmd, value):
+        if value is not None:
+            payload = (path + '\x00' + str(value) + '\x00').encode()
+            data = len(str(value)) + 1
+        else:
+            payload = (path + '\x00').encode()
+            data = 65536
+        return OW_HEADER.pack(0, len(payload), cmd, self._flag, data, 0) + payload
+
+    def _reply(self, path, cmd, start):
+        while True:
+            version, length, ret, flags, size, offset = OW_HEADER.unpack(self._recv(24))
+            if length != -1:  # -1 is a keepalive of a busy owserver
                 break
-        if ret == 4294967295:  # unknown path
-            self._lock.release()
-            raise owexpath("path '{0}' not found.".format(path))
-        if length == 0:
-            self._lock.release()
-            if cmd != 3:
-                raise owex('no payload for {0}'.format(path))
-            return
-        try:
-            payload = self._sock.recv(length)
-        except socket.timeout:
-            self.close()
-            self._lock.release()
-            raise owex("error receiving payload: timeout")
-        except Exception as e:
-            self.close()
-            self._lock.release()
-            raise owex("error receiving payload: {0}".format(e))
-        self._lock.release()
+        payload = self._recv(length) if length > 0 else None
+        self.persistent = bool(flags & OW_PERSISTENCE)
+        latency = time.time() - start
+        if ret < 0:
+            self._count(path, latency, True)
+            if ret in (-1, -2):  # unknown path, ENOENT
+                return owexpath("path '{0}' not found.".format(path))
+            return owex("owserver error {0} for {1}".format(-ret, path))
+        if payload is None and cmd != 3:
+            self._count(path, latency, True)
+            return owex('no payload for {0}'.format(path))
+        self._count(path, latency)
         return payload
 
+    def _recv(self, length):
+        data = bytearray(length)
+        view = memoryview(data)
+        while view:
+            received = self._sock.recv_into(view)
+            if received == 0:
+                raise ConnectionError("connection closed by owserver")
+            view = view[received:]
+        return bytes(data)
+
+    def _count(self, path, latency, error=False):
+        if path.startswith('/uncached'):
+            path = path[9:]
+        stats = self._stats.get(path)
+        if stats is None:
+            stats = self._stats[path] = [0, 0, 0.0, 0.0]
+        stats[0] += 1
+        if error or latency is None:
+            stats[1] += 1
+        if latency is not None:
+            stats[2] += latency
+            if latency > stats[3]:
+                stats[3] = latency
+
     def close(self):
         self.connected = False
         try:
@@ -229,6 +286,31 @@ class OwBase():
             return
 
 
+class OwPool():
+    """
+    persistent owserver connections, each used by one thread at a time
+    """
+
+    def __init__(self, host, port, size):
+        self.connections = [OwBase(host, port) for i in range(size)]
+        self._idle = queue.Queue()
+        for ow in self.connections:
+            self._idle.put(ow)
+
+    def get(self):
+        ow = self._idle.get()
+        if not ow.connected:
+            ow.connect()
+        return ow
+
+    def put(self, ow):
+        self._idle.put(ow)
+
+    def close(self):
+        for ow in self.connections:
+            ow.close()
+
+
 class OneWire(OwBase):
     _buses = {}
     _sensors = {}
@@ -242,12 +324,16 @@ class OneWire(OwBase):
     _flip = {0: '1', False: '1', 1: '0', True: '0', '0': True, '1': False}
     _supported = {'T': 'Temperature', 'H': 'Humidity', 'V': 'Voltage', 'BM': 'Busmaster', 'B': 'iButton', 'L': 'Light/Lux', 'IA': 'Input A', 'IB': 'Input B', 'OA': 'Output A', 'OB': 'Output B', 'I0': 'Input 0', 'I1': 'Input 1', 'I2': 'Input 2', 'I3': 'Input 3', 'I4': 'Input 4', 'I5': 'Input 5', 'I6': 'Input 6', 'I7': 'Input 7', 'O0': 'Output 0', 'O1': 'Output 1', 'O2': 'Output 2', 'O3': 'Output 3', 'O4': 'Output 4', 'O5': 'Output 5', 'O6': 'Output 6', 'O7': 'Output 7', 'T9': 'Temperature 9Bit', 'T10': 'Temperature 10Bit', 'T11': 'Temperature 11Bit', 'T12': 'Temperature 12Bit', 'VOC': 'VOC'}
 
-    def __init__(self, smarthome, cycle=300, io_wait=5, button_wait=0.5, host='127.0.0.1', port=4304):
+    def __init__(self, smarthome, cycle=300, io_wait=5, button_wait=0.5, host='127.0.0.1', port=4304, simultaneous=False, connections=1):
         OwBase.__init__(self, host, port)
         self._sh = smarthome
         self._io_wait = float(io_wait)
         self._button_wait = float(button_wait)
         self._cycle = int(cycle)
+        self._simultaneous = str(simultaneous).lower() in ('1', 'yes', 'true', 'on')
+        self._connections = max(1, int(connections))
+        self._bus_pool = None   # owserver connections of the bus cycle, separate from the I/O and iButton connection
+        self._bus_cycletimes = {}
         smarthome.connections.monitor(self)
 
     def wrapper(self, bus):  # dummy method not needed right now
@@ -291,6 +377,8 @@ class OneWire(OwBase):
     def stop(self):
         self.alive = False
         self.close()
+        if self._bus_pool is not None:
+            self._bus_pool.close()
 
     def _io_loop(self):
         threading.currentThread().name = '1w-io'
@@ -370,6 +458,9 @@ class OneWire(OwBase):
         pass
 
     def _sensor_cycle(self):
+        if self._simultaneous or self._connections > 1:
+            self._bus_cycle()
+            return
         if not self.connected:
             return
         start = time.time()
@@ -377,35 +468,129 @@ class OneWire(OwBase):
             if not self.alive:
                 break
             for key in self._sensors[addr]:
-                item = self._sensors[addr][key]['item']
-                path = self._sensors[addr][key]['path']
-                if path is None:
-                    logger.info("1-Wire: path not found for {0}".format(item.id()))
-                    continue
                 try:
-                    value = self.read('/uncached' + path).decode()
-                    if key.startswith('T') and value == '85.0000':
-                        logger.info("1-Wire: problem reading {0}. Wiring problem?".format(addr))
-                        continue
-                    value = float(value)
+                    self._read_sensor(addr, key)
                 except Exception as e:
-                    logger.warning("1-Wire: problem reading {} {}: {}".format(addr, path, e))
-                    if not self.connected:
+                    logger.warning("1-Wire: problem reading {} {}: {}".format(addr, self._sensors[addr][key]['path'], e))
+                    if not self.connected:  # connection errors close the connection, unknown paths don't
                         return
-                    else:
-                        self.close()
-                        break
-                if key == 'L':  # light lux conversion
-                    if value > 0:
-                        value = round(10 ** ((float(value) / 47) * 1000))
-                    else:
-                        value = 0
-                elif key == 'VOC':
-                    value = value * 310 + 450
-                item(value, '1-Wire', path)
         cycletime = time.time() - start
         logger.debug("1-Wire: sensor cycle takes {0} seconds".format(cycletime))
 
+    def _read_sensor(self, addr, key):
+        """
+        reads one sensor value and updates the item
+        """
+        path = self._sensor_path(addr, key)
+        if path is None:
+            return
+        self._update_sensor(addr, key, self.read(path))
+
+    def _sensor_path(self, addr, key, latest=False):
+        """
+        returns the uncached owserver path of a sensor value
+        :param latest: the result of the last simultaneous conversion instead of converting again
+        """
+        path = self._sensors[addr][key]['path']
+        if path is None:
+            logger.info("1-Wire: path not found for {0}".format(self._sensors[addr][key]['item'].id()))
+            return
+        if latest and key == 'T' and path.endswith('/temperature'):
+            return '/uncached' + path[:-len('temperature')] + 'latesttemp'
+        return '/uncached' + path
+
+    def _update_sensor(self, addr, key, payload):
+        value = payload.decode()
+        if key.startswith('T') and value.strip() == '85.0000':
+            logger.info("1-Wire: problem reading {0}. Wiring problem?".format(addr))
+            return
+        value = float(value)
+        if key == 'L':  # light lux conversion
+            if value > 0:
+                value = round(10 ** ((float(value) / 47) * 1000))
+            else:
+                value = 0
+        elif key == 'VOC':
+            value = value * 310 + 450
+        self._sensors[addr][key]['item'](value, '1-Wire', self._sensors[addr][key]['path'])
+
+    def _bus_cycle(self):
+        """
+        polls the sensors bus by bus, up to 'connections' buses at the same time
+        """
+        if self._bus_pool is None:
+            self._bus_pool = OwPool(self.host, self.port, self._connections)
+        start = time.time()
+        buses = [(bus, [addr for addr in addrs if addr in self._sensors]) for bus, addrs in list(self._buses.items())]
+        buses = [(bus, addrs) for bus, addrs in buses if addrs]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._connections) as executor:
+            for bus, addrs in buses:
+                executor.submit(self._bus_poll, bus, addrs)
+        logger.debug("1-Wire: sensor cycle of {0} buses takes {1:.2f} seconds".format(len(buses), time.time() - start))
+
+    def _bus_poll(self, bus, addrs):
+        ow = self._bus_pool.get()
+        try:
+            if not ow.connected or not self.alive:
+                return
+            start = time.time()
+            latest = False
+            if self._simultaneous and any(addr[:2] in SIMULTANEOUS_FAMILIES and 'T' in self._sensors[addr] for addr in addrs):
+                try:
+                    ow.write('/' + bus + '/simultaneous/temperature', 1)
+                    time.sleep(SIMULTANEOUS_WAIT)
+                    latest = True
+                except Exception as e:
+                    logger.warning("1-Wire: problem starting simultaneous conversion on {0}: {1}".format(bus, e))
+            sensors = []
+            for addr in addrs:
+                for key in self._sensors[addr]:
+                    path = self._sensor_path(addr, key, latest and addr[:2] in SIMULTANEOUS_FAMILIES)
+                    if path is not None:
+                        sensors.append((addr, key, path))
+            try:
+                payloads = ow.read_many([path for addr, key, path in sensors])
+            except Exception as e:
+                logger.warning("1-Wire: problem reading {0}: {1}".format(bus, e))
+                return
+            for (addr, key, path), payload in zip(sensors, payloads):
+                try:
+                    if isinstance(payload, Exception):
+                        raise payload
+                    self._update_sensor(addr, key, payload)
+                except Exception as e:
+                    logger.warning("1-Wire: problem reading {} {}: {}".format(addr, path, e))
+            self._bus_cycletimes[bus] = time.time() - start
+            logger.debug("1-Wire: {0} cycle takes {1:.2f} seconds".format(bus, self._bus_cycletimes[bus]))
+        finally:
+            self._bus_pool.put(ow)
+
+    def get_bus_cycletimes(self):
+        """
+        returns the duration in seconds of the last sensor cycle per bus, e.g. {'bus.0': 1.2, 'bus.1': 0.9}
+        only filled if simultaneous or more than one connection is configured
+        """
+        return dict(self._bus_cycletimes)
+
+    def get_stats(self):
+        """
+        returns the owserver requests, errors and latencies in seconds per path of all connections, e.g.
+        {'/28.0123456789AB/temperature': {'requests': 12, 'errors': 0, 'latency_avg': 0.76, 'latency_max': 0.81}}
+        """
+        connections = [self]
+        if self._bus_pool is not None:
+            connections += self._bus_pool.connections
+        totals = {}
+        for ow in connections:
+            for path, stats in list(ow._stats.items()):
+                total = totals.setdefault(path, [0, 0, 0.0, 0.0])
+                total[0] += stats[0]
+                total[1] += stats[1]
+                total[2] += stats[2]
+                total[3] = max(total[3], stats[3])
+        return {path: {'requests': requests, 'errors': errors, 'latency_avg': latency / requests, 'latency_max': latency_max}
+                for path, (requests, errors, latency, latency_max) in totals.items()}
+
     def _discovery(self):
         self._intruders = []  # reset intrusion detection
         if not self.connected:
@@ -23,6 +23,10 @@ import datetime
 import functools
 import logging
 import os
+import queue
+import socket
+import threading
+import time
 
 import rrdtool
 
@@ -31,13 +35,17 @@ logger = logging.getLogger('')
 
 class RRD():
 
-    def __init__(self, smarthome, step=300, rrd_dir=None):
+    def __init__(self, smarthome, step=300, rrd_dir=None, rrdcached=None):
         self._sh = smarthome
         if rrd_dir is None:
             rrd_dir = smarthome.base_dir + '/var/rrd/'
         self._rrd_dir = rrd_dir
         self._rrds = {}
         self.step = int(step)
+        self._rrdcached = rrdcached
+        self._queue = queue.Queue()
+        self._worker = None
+        self._stats = {'cycles': 0, 'updates': 0, 'errors': 0, 'last_duration': 0.0, 'max_duration': 0.0}
 
     def run(self):
         self.alive = True
@@ -46,27 +54,112 @@ class RRD():
             rrd = self._rrds[itempath]
             if not os.path.isfile(rrd['rrdb']):
                 self._create(rrd)
+        # updates are written by a worker thread to not block the scheduler
+        self._worker = threading.Thread(target=self._update_worker, name='RRDtool')
+        self._worker.daemon = True
+        self._worker.start()
         offset = 100  # wait 100 seconds for 1-Wire to update values
         self._sh.scheduler.add('RRDtool', self._update_cycle, cycle=self.step, offset=offset, prio=5)
 
     def stop(self):
         self.alive = False
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join(10)
+            self._worker = None
+
+    def get_stats(self):
+        return dict(self._stats)
 
     def _update_cycle(self):
+        # collect values of all items with the timestamp of this cycle
+        now = str(int(time.time()))
+        updates = []
         for itempath in self._rrds:
             rrd = self._rrds[itempath]
             if rrd['type'] == 'GAUGE':
-                value = 'N:' + str(float(rrd['item']()))
+                value = now + ':' + str(float(rrd['item']()))
             else:  # 'COUNTER'
-                value = 'N:' + str(int(rrd['step'] * rrd['item']()))
-            try:
-                rrdtool.update(
-                    rrd['rrdb'],
-                    value
-                )
-            except Exception as e:
-                logger.warning("RRD: error updating {}: {}".format(itempath, e))
-                continue
+                value = now + ':' + str(int(rrd['step'] * rrd['item']()))
+            updates.append((itempath, rrd['rrdb'], value))
+        if self._worker is None:
+            self._update(updates)
+        else:
+            self._queue.put(updates)
+
+    def _update_worker(self):
+        while True:
+            updates = self._queue.get()
+            if updates is None:
+                break
+            self._update(updates)
+
+    def _update(self, updates):
+        start = time.time()
+        if self._rrdcached is not None:
+            errors = self._update_rrdcached(updates)
+        else:
+            errors = 0
+            for itempath, rrdb, value in updates:
+                try:
+                    rrdtool.update(
+                        rrdb,
+                        value
+                    )
+                except Exception as e:
+                    logger.warning("RRD: error updating {}: {}".format(itempath, e))
+                    errors += 1
+        duration = time.time() - start
+        self._stats['cycles'] += 1
+        self._stats['updates'] += len(updates) - errors
+        self._stats['errors'] += errors
+        self._stats['last_duration'] = duration
+        self._stats['max_duration'] = max(self._stats['max_duration'], duration)
+        logger.debug("RRD: updated {} rrds in {:.3f}s ({} errors)".format(len(updates), duration, errors))
+
+    def _update_rrdcached(self, updates):
+        """ Send all updates to rrdcached using a single BATCH command, returns
+            the number of failed updates.
+        """
+        try:
+            sock = self._rrdcached_connect()
+        except Exception as e:
+            logger.warning("RRD: could not connect to rrdcached {}: {}".format(self._rrdcached, e))
+            return len(updates)
+        try:
+            f = sock.makefile('rw', encoding='utf-8', newline='\n')
+            f.write("BATCH\n")
+            f.flush()
+            reply = f.readline()
+            if not reply.startswith('0'):
+                raise Exception("BATCH rejected: {}".format(reply.strip()))
+            f.write(''.join(["UPDATE {} {}\n".format(rrdb, value) for itempath, rrdb, value in updates]) + ".\n")
+            f.flush()
+            reply = f.readline()
+            errors = int(reply.split()[0])
+            for i in range(errors):
+                line = f.readline().split(' ', 1)
+                itempath = updates[int(line[0]) - 1][0] if line[0].isdigit() and 0 < int(line[0]) <= len(updates) else '?'
+                logger.warning("RRD: error updating {}: {}".format(itempath, line[-1].strip()))
+            return errors
+        except Exception as e:
+            logger.warning("RRD: error updating rrds using rrdcached {}: {}".format(self._rrdcached, e))
+            return len(updates)
+        finally:
+            sock.close()
+
+    def _rrdcached_connect(self):
+        address = self._rrdcached
+        if address.startswith('unix:'):
+            address = address[5:]
+        if address.startswith('/'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(10)
+            sock.connect(address)
+        else:
+            host, _, port = address.partition(':')
+            sock = socket.create_connection((host, int(port) if port else 42217), 10)
+        return sock
 
     def parse_item(self, item):
         if 'rrd' not in item.conf:
@@ -130,6 +223,8 @@ class RRD():
                 query.extend(['--end', "now-{}".format(end)])
         if step is not None:
             query.extend(['--resolution', step])
+        if self._rrdcached is not None:
+            query.extend(['--daemon', self._rrdcached])
         try:
             meta, name, data = rrdtool.fetch(*query)
         except Exception as e:
@@ -180,6 +275,8 @@ class RRD():
                 query.extend(['--end', "{}".format(end)])
             else:
                 query.extend(['--end', "now-{}".format(end)])
+        if self._rrdcached is not None:
+            query.extend(['--daemon', self._rrdcached])
         try:
             meta, name, data = rrdtool.fetch(*query)
         except Exception as e:
@@ -31,6 +31,147 @@ import errno
 
 from lib.model.smartplugin import SmartPlugin
 
+SML_ESCAPE = b'\x1b\x1b\x1b\x1b'
+SML_START = SML_ESCAPE + b'\x01\x01\x01\x01'
+SML_MAX_FRAME = 8192
+
+SML_INT = {  # precompiled unpack of int (5) and uint (6) by length
+    (5, 1): struct.Struct('>b'), (5, 2): struct.Struct('>h'), (5, 4): struct.Struct('>i'), (5, 8): struct.Struct('>q'),
+    (6, 1): struct.Struct('>B'), (6, 2): struct.Struct('>H'), (6, 4): struct.Struct('>I'), (6, 8): struct.Struct('>Q')
+}
+
+
+def _crc16_x25_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC16_X25_TABLE = _crc16_x25_table()
+
+
+def crc16_x25(data):
+    """
+    CRC-16/X-25 as used by the SML transport layer
+    """
+    crc = 0xffff
+    table = CRC16_X25_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+    return crc ^ 0xffff
+
+
+class SmlStream():
+    """
+    splits a byte stream into SML transport frames
+
+    Bytes are fed as they arrive. feed() returns the message data of every
+    frame completed by these bytes whose checksum is correct, partial frames
+    are kept for the next call.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.frames = 0
+        self.errors = 0
+        self.reset()
+
+    def reset(self):
+        self._buffer = bytearray()
+        self._pos = None  # offset of the next 4 byte block to check if a frame started
+
+    def feed(self, data):
+        self._buffer += data
+        frames = []
+        buffer = self._buffer
+        while True:
+            if self._pos is None:
+                start = buffer.find(SML_START)
+                if start < 0:
+                    del buffer[:-7]
+                    break
+                del buffer[:start]
+                self._pos = 8
+            end = self._pos
+            while True:  # escape sequences are aligned to 4 bytes, a new frame may start anywhere
+                end = buffer.find(SML_ESCAPE, end)
+                if end < 0 or end % 4 == 0 or len(buffer) < end + 8 or buffer[end + 4:end + 8] == SML_START[4:]:
+                    break
+                end += 1
+            if end < 0 or len(buffer) < end + 8:
+                if len(buffer) > SML_MAX_FRAME:
+                    self.logger.warning('Sml: no end of frame within {} bytes'.format(SML_MAX_FRAME))
+                    self.errors += 1
+                    del buffer[:8]
+                    self._pos = None
+                    continue
+                self._pos = max(self._pos, len(buffer) - 7) if end < 0 else end
+                break
+            escape = buffer[end + 4]
+            if buffer[end + 4:end + 8] == SML_ESCAPE:  # escaped data
+                self._pos = end + 8
+            elif buffer[end + 4:end + 8] == SML_START[4:]:  # start of a new frame, drop the incomplete one
+                self.errors += 1
+                del buffer[:end]
+                self._pos = 8
+            elif escape == 0x1a:  # end of frame
+                frame = bytes(buffer[:end + 8])
+                del buffer[:end + 8]
+                self._pos = None
+                message = self._message(frame)
+                if message is not None:
+                    frames.append(message)
+            else:
+                self.logger.warning('Sml: unknown escape sequence {}'.format(buffer[end + 4:end + 8].hex()))
+                self.errors += 1
+                del buffer[:end + 8]
+                self._pos = None
+        return frames
+
+    def _message(self, frame):
+        crc = crc16_x25(frame[:-2])
+        # the standard sends the checksum low byte first, some meters send it high byte first
+        if frame[-2:] != bytes((crc & 0xff, crc >> 8)) and frame[-2:] != bytes((crc >> 8, crc & 0xff)):
+            self.logger.warning('Sml: checksum error in frame of {} bytes'.format(len(frame)))
+            self.errors += 1
+            return None
+        self.frames += 1
+        padding = frame[-3]
+        message = frame[8:-8 - padding] if padding < 4 else frame[8:-8]
+        if SML_ESCAPE in message:
+            unescaped = bytearray()
+            i = 0
+            while i < len(message):
+                block = message[i:i + 4]
+                unescaped += block
+                i += 8 if block == SML_ESCAPE else 4
+            message = bytes(unescaped)
+        return message
+
+
+class SmlRecorder():
+    """
+    appends the bytes read from the meter to a file, one line per read:
+    <unix time> rx <bytes as hex>
+    The file can be replayed with replay.py.
+    """
+
+    def __init__(self, filename):
+        self._file = open(filename, 'a')
+
+    def write(self, direction, data):
+        if data:
+            self._file.write('{:.3f} {} {}\n'.format(time.time(), direction, data.hex()))
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
 class Sml(SmartPlugin):
 
     ALLOW_MULTIINSTANCE = True
@@ -48,20 +189,25 @@ class Sml(SmartPlugin):
       'smart-meter-gateway-com-1' : 'hex'
     }
 
-    def __init__(self, smarthome, host=None, port=0, serialport=None, device="raw", cycle=300):
+    def __init__(self, smarthome, host=None, port=0, serialport=None, device="raw", cycle=300, push=False, record=None):
         self._sh = smarthome
         self.host = host
         self.port = int(port)
         self.serialport = serialport
         self.cycle = cycle
+        self._push = self.to_bool(push)
+        self._reader = None
+        self._recorder = SmlRecorder(record) if record else None
         self.connected = False
         self._serial = None
         self._sock = None
         self._target = None
-        self._dataoffset = 0
         self._items = {}
+        self._sampling = {}  # item: down-sampling settings and state
         self._lock = threading.Lock()
         self.logger = logging.getLogger(__name__)
+        self._stream = SmlStream(self.logger)
+        self._hexrest = ''
 
         if device in self._devices:
           device = self._devices[device]
@@ -78,11 +224,21 @@ class Sml(SmartPlugin):
 
     def run(self):
         self.alive = True
-        self._sh.scheduler.add('Sml', self._refresh, cycle=self.cycle)
+        if self._push:
+            self._reader = threading.Thread(target=self._push_loop, name='Sml {}'.format(self.get_instance_name()))
+            self._reader.daemon = True
+            self._reader.start()
+        else:
+            self._sh.scheduler.add('Sml', self._refresh, cycle=self.cycle)
 
     def stop(self):
         self.alive = False
         self.disconnect()
+        if self._reader is not None:
+            self._reader.join(5)
+            self._reader = None
+        if self._recorder is not None:
+            self._recorder.close()
 
     def parse_item(self, item):
         if self.has_iattr(item.conf, 'sml_obis'):
@@ -93,6 +249,14 @@ class Sml(SmartPlugin):
             if prop not in self._items[obis]:
                 self._items[obis][prop] = []
             self._items[obis][prop].append(item)
+            sampling = {
+              'interval'  : float(self.get_iattr_value(item.conf, 'sml_interval')) if self.has_iattr(item.conf, 'sml_interval') else 0,
+              'average'   : float(self.get_iattr_value(item.conf, 'sml_average')) if self.has_iattr(item.conf, 'sml_average') else 0,
+              'on_change' : self.to_bool(self.get_iattr_value(item.conf, 'sml_on_change')) if self.has_iattr(item.conf, 'sml_on_change') else False
+            }
+            if sampling['interval'] or sampling['average'] or sampling['on_change']:
+                sampling.update({'last': None, 'time': 0, 'sum': 0, 'count': 0, 'start': None})
+                self._sampling[item] = sampling
             self.logger.debug('attach {} {} {}'.format(item.id(), obis, prop))
             return self.update_item
         return None
@@ -106,18 +270,26 @@ class Sml(SmartPlugin):
 
     def connect(self):
         self._lock.acquire()
+        if self.connected:  # already connected by the push reader or the connection monitor
+            self._lock.release()
+            return
         target = None
+        self._stream.reset()
+        self._hexrest = ''
         try:
             if self.serialport is not None:
                 self._target = 'serial://{}'.format(self.serialport)
                 self._serial = serial.Serial(
-                    self.serialport, 9600, serial.EIGHTBITS, serial.PARITY_NONE, serial.STOPBITS_ONE, timeout=0)
+                    self.serialport, 9600, serial.EIGHTBITS, serial.PARITY_NONE, serial.STOPBITS_ONE, timeout=1 if self._push else 0)
             elif self.host is not None:
                 self._target = 'tcp://{}:{}'.format(self.host, self.port)
                 self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self._sock.settimeout(2)
                 self._sock.connect((self.host, self.port))
-                self._sock.setblocking(False)
+                if self._push:
+                    self._sock.settimeout(1)
+                else:
+                    self._sock.setblocking(False)
         except Exception as e:
             self.logger.error('Sml: Could not connect to {}: {}'.format(self._target, e))
             self._lock.release()
@@ -135,6 +307,7 @@ class Sml(SmartPlugin):
                     self._serial = None
                 elif self._sock is not None:
                     self._sock.shutdown(socket.SHUT_RDWR)
+                    self._sock.close()
                     self._sock = None
             except:
                 pass
@@ -143,47 +316,47 @@ class Sml(SmartPlugin):
             self._target = None
 
     def _read(self, length):
-        total = []
-        while 1:
-            if self._serial is not None:
-                data = self._serial.read(length)
-                if data:
-                    total.append(data)
+        data = self._receive(length)
+        if self._recorder is not None:
+            self._recorder.write('rx', data)
+        return data
+
+    def _receive(self, length):
+        if self._serial is not None:
+            return self._serial.read(length)
+        elif self._sock is not None:
+            try:
+                data = self._sock.recv(length)
+            except socket.timeout:
+                return b''
+            except socket.error as e:
+                if e.args[0] == errno.EAGAIN or e.args[0] == errno.EWOULDBLOCK:
+                    return b''
                 else:
-                    break
-            elif self._sock is not None:
-                try:
-                    data = self._sock.recv(length)
-                    if data:
-                        total.append(data)
-                except socket.error as e:
-                    if e.args[0] == errno.EAGAIN or e.args[0] == errno.EWOULDBLOCK:
-                        break
-                    else:
-                        raise e
-
-        return b''.join(total)
-        
+                    raise e
+            if not data:
+                raise Exception('connection closed')
+            return data
+        return b''
+
     def _refresh(self):
         if self.connected:
             start = time.time()
             retry = 5
             while retry > 0:
                 try:
-                    data = self._read(512)
-                    if len(data) == 0:
+                    total = 0
+                    while True:  # values are updated as soon as a frame is complete
+                        data = self._read(512)
+                        if not data:
+                            break
+                        total += len(data)
+                        for message in self._stream.feed(self._prepare(data)):
+                            self._update(self._parse(message))
+                    if total == 0:
                         self.logger.error('Reading data from device returned 0 bytes!')
 
                     retry = 0
-                    values = self._parse(self._prepare(data))
-
-                    for obis in values:
-                        self.logger.debug('Entry {}'.format(values[obis]))
-
-                        if obis in self._items:
-                            for prop in self._items[obis]:
-                                for item in self._items[obis][prop]:
-                                    item(values[obis][prop], 'Sml')
 
                 except Exception as e:
                     self.logger.error('Reading data from {0} failed: {1} - reconnecting!'.format(self._target, e))
@@ -200,109 +373,169 @@ class Sml(SmartPlugin):
             cycletime = time.time() - start
             self.logger.debug("cycle takes {0} seconds".format(cycletime))
 
-    def _parse(self, data):
-        # Search SML List Entry sequences like:
-        # "77 07 81 81 c7 82 03 ff 01 01 01 01 04 xx xx xx xx" - manufactor
-        # "77 07 01 00 00 00 09 ff 01 01 01 01 0b xx xx xx xx xx xx xx xx xx xx 01" - server id
-        # "77 07 01 00 01 08 00 ff 63 01 80 01 62 1e 52 ff 56 00 00 00 29 85 01"
+    def _push_loop(self):
+        """
+        keeps the connection open and updates the items with every telegram the meter sends
+        """
+        while self.alive:
+            if not self.connected:
+                self.connect()
+                if not self.connected:
+                    time.sleep(5)
+                    continue
+            try:
+                data = self._read(512)
+                if data:
+                    for message in self._stream.feed(self._prepare(data)):
+                        self._update(self._parse(message))
+            except Exception as e:
+                if not self.alive:
+                    break
+                self.logger.error('Reading data from {0} failed: {1} - reconnecting!'.format(self._target, e))
+                self.disconnect()
+                time.sleep(1)
+
+    def _update(self, values):
+        now = time.time()
+        for obis in values:
+            self.logger.debug('Entry {}'.format(values[obis]))
+
+            if obis in self._items:
+                for prop in self._items[obis]:
+                    for item in self._items[obis][prop]:
+                        value = values[obis].get(prop)
+                        if item in self._sampling:
+                            value = self._sample(self._sampling[item], value, now)
+                            if value is None:
+                                continue
+                        item(value, 'Sml')
+
+    def _sample(self, sampling, value, now):
+        """
+        applies the down-sampling of an item to a new value
+        :return: the value to set or None if the item is not updated now
+        """
+        if sampling['average'] and isinstance(value, (int, float)) and not isinstance(value, bool):
+            if sampling['start'] is None:
+                sampling['start'] = now
+            sampling['sum'] += value
+            sampling['count'] += 1
+            if now - sampling['start'] < sampling['average']:
+                return None
+            value = sampling['sum'] / sampling['count']
+            sampling.update({'sum': 0, 'count': 0, 'start': now})
+        if sampling['on_change'] and value == sampling['last']:
+            return None
+        if now - sampling['time'] < sampling['interval']:
+            return None
+        sampling['last'] = value
+        sampling['time'] = now
+        return value
+
+    def _parse(self, message):
+        # The message data of a frame is a sequence of SML_Message lists:
+        # [transactionId, groupNo, abortOnError, [tag, body], crc16, endOfSmlMsg]
+        # The values are the SML_ListEntry lists of the valList of a SML_GetList.Res (tag 0x0701) body:
+        # [clientId, serverId, listName, actSensorTime, valList, listSignature, actGatewayTime]
         # Details see http://wiki.volkszaehler.org/software/sml
         values = {}
-        packetsize = 7
-        self.logger.debug('Data:{}'.format(''.join(' {:02x}'.format(x) for x in data)))
-        self._dataoffset = 0
-        while self._dataoffset < len(data)-packetsize:
-
-            # Find SML_ListEntry starting with 0x77 0x07 and OBIS code end with 0xFF
-            if data[self._dataoffset] == 0x77 and data[self._dataoffset+1] == 0x07 and data[self._dataoffset+packetsize] == 0xff:
-                packetstart = self._dataoffset
-                self._dataoffset += 1
-                try:
-                    entry = {
-                      'objName'   : self._read_entity(data),
-                      'status'    : self._read_entity(data),
-                      'valTime'   : self._read_entity(data),
-                      'unit'      : self._read_entity(data),
-                      'scaler'    : self._read_entity(data),
-                      'value'     : self._read_entity(data),
-                      'signature' : self._read_entity(data)
-                    }
-
-                    # add additional calculated fields
-                    entry['obis'] = '{}-{}:{}.{}.{}*{}'.format(entry['objName'][0], entry['objName'][1], entry['objName'][2], entry['objName'][3], entry['objName'][4], entry['objName'][5])
-                    entry['valueReal'] = entry['value'] * 10 ** entry['scaler'] if entry['scaler'] is not None else entry['value']
-                    entry['unitName'] = self._units[entry['unit']] if entry['unit'] != None and entry['unit'] in self._units else None
-
-                    values[entry['obis']] = entry
-                except Exception as e:
-                    if self._dataoffset < len(data) - 1:
-                        self.logger.warning('Can not parse entity at position {}, byte {}: {}:{}...'.format(self._dataoffset, self._dataoffset - packetstart, e, ''.join(' {:02x}'.format(x) for x in data[packetstart:packetstart+64])))
-                        self._dataoffset = packetstart + packetsize - 1
-            else:
-                self._dataoffset += 1
+        self.logger.debug('Data:{}'.format(''.join(' {:02x}'.format(x) for x in message)))
+        offset = 0
+        while offset < len(message):
+            if message[offset] == 0x00:  # padding
+                offset += 1
+                continue
+            try:
+                sml, offset = self._read_entity(message, offset)
+            except Exception as e:
+                self.logger.warning('Can not parse message at position {}: {}'.format(offset, e))
+                break
+            try:
+                tag, body = sml[3]
+            except Exception:
+                continue
+            if tag != 0x0701 or not body[4]:
+                continue
+            for objName, status, valTime, unit, scaler, value, signature in body[4]:
+                entry = {
+                  'objName'   : objName,
+                  'status'    : status,
+                  'valTime'   : valTime,
+                  'unit'      : unit,
+                  'scaler'    : scaler,
+                  'value'     : value,
+                  'signature' : signature
+                }
+
+                # add additional calculated fields
+                entry['obis'] = '{}-{}:{}.{}.{}*{}'.format(objName[0], objName[1], objName[2], objName[3], objName[4], objName[5])
+                entry['valueReal'] = value * 10 ** scaler if scaler is not None and isinstance(value, int) else value
+                entry['unitName'] = self._units[unit] if unit in self._units else None
+
+                values[entry['obis']] = entry
 
         return values
 
-    def _read_entity(self, data):
-        import builtins
-        upack = {
-          5 : { 1 : '>b', 2 : '>h', 4 : '>i', 8 : '>q' },  # int
-          6 : { 1 : '>B', 2 : '>H', 4 : '>I', 8 : '>Q' }   # uint
-        }
-
-        result = None
-
-        tlf = data[self._dataoffset]
-        type = (tlf & 112) >> 4
-        more = tlf & 128
-        len = tlf & 15
-        self._dataoffset += 1
-
-        if more > 0:
-            tlf = data[self._dataoffset]
-            len = (len << 4) + (tlf & 15)
-            self._dataoffset += 1
-
-        len -= 1
-
-        if len == 0:     # skip empty optional value
-            return result
-
-        if self._dataoffset + len >= builtins.len(data):
-            raise Exception("Try to read {} bytes, but only have {}".format(len, builtins.len(data) - self._dataoffset))
-
-        if type == 0:    # octet string
-            result = data[self._dataoffset:self._dataoffset+len]
-
-        elif type == 5 or type == 6:  # int or uint
-            d = data[self._dataoffset:self._dataoffset+len]
-
-            ulen = len
-            if ulen not in upack[type]:  # extend to next greather unpack unit
-              while ulen not in upack[type]:
-                d = b'\x00' + d
-                ulen += 1
-
-            result = struct.unpack(upack[type][ulen], d)[0]
-
-        elif type == 7:  # list
+    def _read_entity(self, data, offset):
+        """
+        reads the entity at offset
+        :return: the value and the offset of the next entity
+        """
+        tl = data[offset]
+        typ = (tl & 0x70) >> 4
+        length = tl & 0x0f
+        size = 1
+        while tl & 0x80:  # length continues in the next type-length byte
+            tl = data[offset + size]
+            length = (length << 4) + (tl & 0x0f)
+            size += 1
+        offset += size
+
+        if typ == 7:  # list, length is the number of entities
             result = []
-            self._dataoffset += 1
-            for i in range(0, len + 1):
-                result.append(self._read_entity(data))
-            return result
-
+            for i in range(length):
+                value, offset = self._read_entity(data, offset)
+                result.append(value)
+            return result, offset
+
+        length -= size  # length includes the type-length bytes
+        if length <= 0:  # end of message or empty optional value
+            return None, offset
+
+        end = offset + length
+        if end > len(data):
+            raise Exception("Try to read {} bytes, but only have {}".format(length, len(data) - offset))
+
+        if typ == 0:    # octet string
+            result = data[offset:end]
+        elif typ == 5 or typ == 6:  # int or uint
+            unpack = SML_INT.get((typ, length))
+            if unpack is not None:
+                result = unpack.unpack_from(data, offset)[0]
+            else:
+                result = int.from_bytes(data[offset:end], byteorder='big', signed=typ == 5)
+        elif typ == 4:  # boolean
+            result = data[offset] != 0
         else:
-            self.logger.warning('Skipping unkown field {}'.format(hex(tlf)))
+            result = None
+            self.logger.warning('Skipping unkown field {}'.format(hex(tl)))
 
-        self._dataoffset += len
-
-        return result
+        return result, end
 
     def _prepareRaw(self, data):
         return data
 
     def _prepareHex(self, data):
-        data = data.decode("iso-8859-1").lower();
+        # keep the text after the last separator for the next call, it may continue there
+        data = self._hexrest + data.decode("iso-8859-1").lower()
+        rest = len(data)
+        while rest > 0 and data[rest - 1] in '0123456789abcdef':
+            rest -= 1
+        if rest == 0:  # no separator, keep an odd digit
+            rest = len(data) - len(data) % 2
+        else:
+            rest -= 1
+        data, self._hexrest = data[:rest], data[rest:]
         data = re.sub("[^a-f0-9]", " ", data)
         data = re.sub("( +[a-f0-9]|[a-f0-9] +)", "", data)
         data = data.encode()
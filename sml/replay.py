@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG.    https://github.com/smarthomeNG//
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""
+Replays a recording of the sml plugin (plugin parameter record) as TCP server, so the plugin
+can be run and measured without a meter:
+
+    python3 plugins/sml/replay.py var/sml.rec --port 7259 --speed 10
+
+and configure the plugin with host = 127.0.0.1 and port = 7259.
+Every client gets the whole recording from its start. The bytes are sent with the gaps
+of the recording divided by speed, speed 0 sends them as fast as possible.
+"""
+
+import argparse
+import logging
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def load(filename):
+    """
+    reads a recording
+    :return: list of (unix time, direction, bytes)
+    """
+    records = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            timestamp, direction, data = line.split(' ')
+            records.append((float(timestamp), direction, bytes.fromhex(data)))
+    return records
+
+
+class ReplayServer():
+    """
+    sends the received bytes of a recording to every client connecting to port
+    """
+
+    def __init__(self, filename, host='127.0.0.1', port=0, speed=1.0, loop=False):
+        self.records = [(timestamp, data) for timestamp, direction, data in load(filename) if direction == 'rx']
+        self.speed = float(speed)
+        self.loop = loop
+        self.sent = []  # time every record was sent to the last client
+        self.alive = False
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, int(port)))
+        self._server.listen(1)
+        self.host, self.port = self._server.getsockname()
+        self._thread = None
+
+    def start(self):
+        self.alive = True
+        self._thread = threading.Thread(target=self._serve, name='sml replay')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.alive = False
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    def _serve(self):
+        while self.alive:
+            try:
+                client, address = self._server.accept()
+            except OSError:
+                break
+            logger.info('replaying {} records to {}'.format(len(self.records), address))
+            try:
+                self._replay(client)
+            except OSError as e:
+                logger.info('client {} disconnected: {}'.format(address, e))
+            finally:
+                client.close()
+
+    def _replay(self, client):
+        self.sent = []
+        while self.alive:
+            start = time.time()
+            first = self.records[0][0] if self.records else 0
+            for timestamp, data in self.records:
+                if not self.alive:
+                    return
+                if self.speed > 0:
+                    delay = start + (timestamp - first) / self.speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                client.sendall(data)
+                self.sent.append(time.time())
+            if not self.loop:
+                return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recording of the sml plugin as TCP server')
+    parser.add_argument('recording')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7259)
+    parser.add_argument('--speed', type=float, default=1.0, help='acceleration of the recording, 0 for no delays')
+    parser.add_argument('--loop', action='store_true', help='start again at the end of the recording')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = ReplayServer(args.recording, args.host, args.port, args.speed, args.loop)
+    server.start()
+    print('replaying {} on {}:{}, stop with Ctrl-C'.format(args.recording, server.host, server.port))
+    try:
+        while server._thread.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
@@ -0,0 +1,94 @@
+"""
+Decoding throughput and end-to-end latency of the sml plugin with the recordings in recordings/, run with
+
+    python -m pytest plugins/sml/tests/test_sml_replay_benchmark.py --benchmark-columns=min,mean,ops
+
+test_push replays a recording with replay.py at SPEED times its speed to the plugin in push mode and
+reports the time from sending the last bytes of a telegram to the item update as extra info.
+Skipped if pyserial or pytest-benchmark are not installed.
+"""
+import logging
+import os
+import time
+
+import pytest
+
+pytest.importorskip('serial')
+pytest.importorskip('pytest_benchmark')
+
+from plugins.sml import Sml, SmlStream
+from plugins.sml.replay import ReplayServer, load
+
+RECORDINGS = os.path.join(os.path.dirname(__file__), 'recordings')
+SPEED = 10
+POWER = '1-0:16.7.0*255'
+
+
+class Connections():
+
+    def monitor(self, plugin):
+        pass
+
+
+class SmartHome():
+
+    def __init__(self):
+        self.connections = Connections()
+
+
+class Item():
+
+    def __init__(self, obis):
+        self.conf = {'sml_obis': obis}
+        self.updates = []
+
+    def __call__(self, value, caller=None):
+        self.updates.append((time.time(), value))
+
+    def id(self):
+        return self.conf['sml_obis']
+
+
+def received(name):
+    return [data for timestamp, direction, data in load(os.path.join(RECORDINGS, name)) if direction == 'rx']
+
+
+@pytest.mark.parametrize('name', sorted(os.listdir(RECORDINGS)))
+def test_decode(benchmark, name):
+    plugin = Sml(SmartHome())
+    reads = received(name)
+    benchmark.group = 'decode'
+
+    def decode():
+        stream = SmlStream(plugin.logger)
+        return [plugin._parse(message) for data in reads for message in stream.feed(data)]
+
+    values = benchmark(decode)
+    assert values and all(POWER in value for value in values)
+
+
+@pytest.mark.parametrize('name', sorted(os.listdir(RECORDINGS)))
+def test_push(benchmark, name):
+    # index of the read completing each telegram
+    stream = SmlStream(logging.getLogger(__name__))
+    completing = [i for i, data in enumerate(received(name)) for message in stream.feed(data)]
+
+    def replay():
+        server = ReplayServer(os.path.join(RECORDINGS, name), speed=SPEED)
+        server.start()
+        plugin = Sml(SmartHome(), host=server.host, port=server.port, push=True)
+        item = Item(POWER)
+        plugin.parse_item(item)
+        plugin.run()
+        timeout = time.time() + 10 + len(server.records) / SPEED
+        while len(item.updates) < len(completing) and time.time() < timeout:
+            time.sleep(0.01)
+        plugin.stop()
+        server.stop()
+        return [updated - server.sent[i] for (updated, value), i in zip(item.updates, completing)]
+
+    benchmark.group = 'push'
+    latencies = benchmark.pedantic(replay, rounds=1, iterations=1)
+    assert len(latencies) == len(completing)
+    benchmark.extra_info['latency_mean'] = sum(latencies) / len(latencies)
+    benchmark.extra_info['latency_max'] = max(latencies)
@@ -25,6 +25,7 @@ import functools
 import time
 import threading
 import sqlite3
+import urllib.request
 from lib.model.smartplugin import SmartPlugin
 
 
@@ -39,6 +40,8 @@ class SQL(SmartPlugin):
     # time, item, avg, vmin, vmax, power
     _create_db = "CREATE TABLE IF NOT EXISTS history (time INTEGER, item TEXT, avg REAL, vmin REAL, vmax REAL, power REAL);"
     _create_index = "CREATE INDEX IF NOT EXISTS idy ON history (item);"
+    _create_time_index = "CREATE INDEX IF NOT EXISTS idt ON history (time, item);"
+    _create_pack = "CREATE TABLE IF NOT EXISTS pack (period INTEGER PRIMARY KEY, time INTEGER);"
     _pack_query = """
         SELECT
         group_concat(rowid),
@@ -47,11 +50,34 @@ class SQL(SmartPlugin):
         group_concat(power),
         item,
         MIN(vmin),
-        MAX(vmax)
+        MAX(vmax),
+        MIN(time)
         FROM history
-        WHERE (time < {})
-        GROUP by CAST((time / {}) AS INTEGER), item
-        ORDER BY time DESC;"""
+        WHERE time >= :start AND time < :end
+        GROUP by CAST((time / :granularity) AS INTEGER), item
+        ORDER BY item, MIN(time);"""
+    _pack_next = "SELECT MIN(time) FROM history WHERE item = :item AND time >= :time;"
+    # length of time slice packed while holding the lock (ms)
+    _pack_slice = 24 * 3600 * 1000
+    # number of pages freed by incremental vacuum while holding the lock
+    _pack_vacuum_pages = 1000
+    # Read queries using bound parameters (statements are cached by sqlite3)
+    _last_query = "SELECT avg FROM history WHERE item = :item ORDER BY time DESC LIMIT 1;"
+    _prev_query = "SELECT time FROM history WHERE item = :item AND time <= :time ORDER BY time DESC LIMIT 1;"
+    _series_where = " FROM history WHERE item = :item AND time >= :start AND time <= :end GROUP BY CAST((time / :step) AS INTEGER)"
+    _series_queries = {
+        'avg': "SELECT CAST(AVG(time) AS INTEGER), ROUND(AVG(avg), 2)" + _series_where + " ORDER BY time DESC;",
+        'min': "SELECT CAST(AVG(time) AS INTEGER), MIN(vmin)" + _series_where + ";",
+        'max': "SELECT CAST(AVG(time) AS INTEGER), MAX(vmax)" + _series_where + ";",
+        'on': "SELECT CAST(AVG(time) AS INTEGER), ROUND(AVG(power), 2)" + _series_where + " ORDER BY time DESC;"
+    }
+    _single_where = " FROM history WHERE item = :item AND time >= :start AND time < :end;"
+    _single_queries = {
+        'avg': "SELECT AVG(avg)" + _single_where,
+        'min': "SELECT MIN(vmin)" + _single_where,
+        'max': "SELECT MAX(vmax)" + _single_where,
+        'on': "SELECT AVG(power)" + _single_where
+    }
 
     def __init__(self, smarthome, cycle=300, path=None):
         self.logger = logging.getLogger(__name__)
@@ -63,6 +89,8 @@ class SQL(SmartPlugin):
         self.logger.debug("SQLite {0}".format(sqlite3.sqlite_version))
         self._fdb_lock = threading.Lock()
         self._fdb_lock.acquire()
+        self._rdb = None
+        self._rdb_lock = self._fdb_lock
         if path is None:
             self.path = smarthome.base_dir + '/var/db/smarthome.db'
         else:
@@ -74,6 +102,11 @@ class SQL(SmartPlugin):
             self._fdb_lock.release()
             return
         self.connected = True
+        try:
+            journal = self._fdb.execute("PRAGMA journal_mode=WAL;").fetchone()[0]
+            self.logger.debug("SQLite: journal mode {}".format(journal))
+        except Exception as e:
+            self.logger.warning("SQLite: Could not enable WAL journal mode: {}".format(e))
         integrity = self._fdb.execute("PRAGMA integrity_check(10);").fetchone()[0]
         if integrity == 'ok':
             self.logger.debug("SQLite: database integrity ok")
@@ -94,11 +127,14 @@ class SQL(SmartPlugin):
         self._fdb.execute("DROP INDEX IF EXISTS idx;")
         self._fdb.execute(self._create_db)
         self._fdb.execute(self._create_index)
+        self._fdb.execute(self._create_time_index)
+        self._fdb.execute(self._create_pack)
         if version < self._version:
             self._fdb.execute("UPDATE common SET version=:version;", {'version': self._version})
             # self.query("alter table history add column power INTEGER;")
         self._fdb.commit()
         self._fdb_lock.release()
+        self._connect_reader()
         minute = 60 * 1000
         hour = 60 * minute
         day = 24 * hour
@@ -110,6 +146,17 @@ class SQL(SmartPlugin):
         smarthome.scheduler.add('SQLite pack', self._pack, cron='2 3 * *', prio=5)
         smarthome.scheduler.add('SQLite dump', self._dump, cycle=self._dump_cycle, offset=20, prio=5)
 
+    def _connect_reader(self):
+        # Separate read-only connection, so reads do not wait for dump and pack
+        # (in WAL mode readers and the writer do not block each other)
+        try:
+            self._rdb = sqlite3.connect('file:{}?mode=ro'.format(urllib.request.pathname2url(self.path)), uri=True, check_same_thread=False)
+            self._rdb_lock = threading.Lock()
+        except Exception as e:
+            self.logger.warning("SQLite: Could not open read-only connection to {}, using shared connection: {}".format(self.path, e))
+            self._rdb = self._fdb
+            self._rdb_lock = self._fdb_lock
+
     def parse_item(self, item):
         if 'history' in item.conf:  # XXX legacy history option remove sometime
             self.logger.warning("{} deprecated history attribute. Use sqlite as keyword instead.".format(item.id()))
@@ -118,7 +165,7 @@ class SQL(SmartPlugin):
             item.series = functools.partial(self._series, item=item.id())
             item.db = functools.partial(self._single, item=item.id())
             if item.conf['sqlite'] == 'init':
-                last = self._fetchone("SELECT avg from history WHERE item = '{0}' ORDER BY time DESC LIMIT 1".format(item.id()))
+                last = self._fetchone(self._last_query, {'item': item.id()})
                 if last is not None:
                     last = last[0]
                     item.set(last, 'SQLite')
@@ -142,6 +189,14 @@ class SQL(SmartPlugin):
         finally:
             self.connected = False
             self._fdb_lock.release()
+        if self._rdb is not None and self._rdb is not self._fdb:
+            self._rdb_lock.acquire()
+            try:
+                self._rdb.close()
+            except Exception:
+                pass
+            finally:
+                self._rdb_lock.release()
 
     def update_item(self, item, caller=None, source=None, dest=None):
         now = self._timestamp(self._sh.now())
@@ -231,75 +286,141 @@ class SQL(SmartPlugin):
         return ts
 
     def _fetchone(self, *query):
-        if not self._fdb_lock.acquire(timeout=2):
+        if not self._rdb_lock.acquire(timeout=2):
             return
         if not self.connected:
-            self._fdb_lock.release()
+            self._rdb_lock.release()
             return
         try:
-            reply = self._fdb.execute(*query).fetchone()
+            reply = self._rdb.execute(*query).fetchone()
         except Exception as e:
             self.logger.warning("SQLite: Problem with '{0}': {1}".format(query, e))
             reply = None
         finally:
-            self._fdb_lock.release()
+            self._rdb_lock.release()
         return reply
 
     def _fetchall(self, *query):
-        if not self._fdb_lock.acquire(timeout=2):
+        if not self._rdb_lock.acquire(timeout=2):
             return
         if not self.connected:
-            self._fdb_lock.release()
+            self._rdb_lock.release()
             return
         try:
-            reply = self._fdb.execute(*query).fetchall()
+            reply = self._rdb.execute(*query).fetchall()
         except Exception as e:
             self.logger.warning("SQLite: Problem with '{0}': {1}".format(query, e))
             reply = None
         finally:
-            self._fdb_lock.release()
+            self._rdb_lock.release()
         return reply
 
     def _pack(self):
-        insert = []
-        delete = []
-        if not self._fdb_lock.acquire(timeout=2):
-            return
+        """ Pack the history incrementally: each period is packed in slices of
+            time, holding the lock and committing per slice only. The progress
+            is recorded in the pack table, so an interrupted pack resumes.
+        """
+        self.logger.debug("SQLite: pack database")
+        coarser = None
+        for entry in self.periods:
+            period, granularity = entry
+            now = self._timestamp(self._sh.now())
+            cutoff = int(now - period * 24 * 3600 * 1000)
+            granularity = int(granularity * 3600 * 1000)
+            cutoff = cutoff - cutoff % granularity
+            length = max(granularity, self._pack_slice - self._pack_slice % granularity)
+            start = self._pack_progress(period, coarser)
+            coarser = cutoff
+            if start is None:
+                continue
+            start = start - start % granularity
+            while start < cutoff:
+                end = min(start + length, cutoff)
+                if not self._pack_slice_run(period, start, end, granularity, now):
+                    return
+                start = end
+        self._vacuum()
+
+    def _pack_progress(self, period, coarser=None):
+        """ Start of the next slice to pack: the saved progress of the period
+            or the oldest entry, but not before the cutoff of the coarser period
+            packed before (which already packed older entries coarser).
+        """
+        reply = self._fetchone("SELECT time FROM pack WHERE period = :period;", {'period': period})
+        if reply is None or reply[0] is None:
+            reply = self._fetchone("SELECT MIN(time) FROM history;")
+        if reply is None or reply[0] is None:
+            return None
+        return reply[0] if coarser is None else max(reply[0], coarser)
+
+    def _pack_slice_run(self, period, start, end, granularity, now):
+        if not self._fdb_lock.acquire(timeout=10):
+            self.logger.warning("SQLite: pack could not acquire lock, will resume on next pack")
+            return False
+        if not self.connected:
+            self._fdb_lock.release()
+            return False
         try:
-            self.logger.debug("SQLite: pack database")
-            for entry in self.periods:
-                now = self._timestamp(self._sh.now())
-                prev = {}
-                period, granularity = entry
-                period = int(now - period * 24 * 3600 * 1000)
-                granularity = int(granularity * 3600 * 1000)
-                for row in self._fdb.execute(self._pack_query.format(period, granularity)):
-                    gid, gtime, gavg, gpower, item, vmin, vmax = row
-                    gtime = gtime.split(',')
-                    if len(gtime) == 1:  # ignore
-                        prev[item] = gtime[0]
-                        continue
-                    if item not in prev:
+            groups = self._fdb.execute(self._pack_query, {'start': start, 'end': end, 'granularity': granularity}).fetchall()
+            for i, row in enumerate(groups):
+                gid, gtime, gavg, gpower, item, vmin, vmax, first = row
+                gtime = gtime.split(',')
+                if len(gtime) == 1:  # ignore
+                    continue
+                # the group lasts until the next entry of the item
+                if i + 1 < len(groups) and groups[i + 1][4] == item:
+                    upper = groups[i + 1][7]
+                else:
+                    upper = self._fdb.execute(self._pack_next, {'item': item, 'time': end}).fetchone()[0]
+                    if upper is None:
                         upper = now
-                    else:
-                        upper = prev[item]
-                    # pack !!!
-                    delete = gid
-                    gavg = gavg.split(',')
-                    gpower = gpower.split(',')
-                    _time, _avg, _power = self.__pack(gtime, gavg, gpower, upper)
-                    insert = (_time, item, _avg, vmin, vmax, _power)
-                    self._fdb.execute("INSERT INTO history VALUES (?,?,?,?,?,?);", insert)
-                    self._fdb.execute("DELETE FROM history WHERE rowid in ({0});".format(delete))
-                    self._fdb.commit()
-                    prev[item] = gtime[0]
-            self._fdb.execute("VACUUM;")
-            self._fdb.execute("PRAGMA shrink_memory;")
+                # pack !!!
+                _time, _avg, _power = self.__pack(gtime, gavg.split(','), gpower.split(','), upper)
+                self._fdb.execute("INSERT INTO history VALUES (?,?,?,?,?,?);", (_time, item, _avg, vmin, vmax, _power))
+                self._fdb.execute("DELETE FROM history WHERE rowid in ({0});".format(gid))
+            self._fdb.execute("INSERT OR REPLACE INTO pack VALUES (:period, :time);", {'period': period, 'time': end})
+            self._fdb.commit()
         except Exception as e:
-            self.logger.exception("problem packing sqlite database: {} period: {} type: {}".format(e, period, type(period)))
+            self.logger.exception("problem packing sqlite database: {} period: {} slice: {} - {}".format(e, period, start, end))
             self._fdb.rollback()
+            return False
         finally:
             self._fdb_lock.release()
+        return True
+
+    def _vacuum(self):
+        """ Release free pages using incremental vacuum, database files created
+            without incremental auto vacuum are converted once using VACUUM.
+        """
+        if not self._fdb_lock.acquire(timeout=10):
+            return
+        try:
+            if self._fdb.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+                self.logger.info("SQLite: enabling incremental vacuum, this requires a full VACUUM once")
+                self._fdb.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+                self._fdb.execute("VACUUM;")
+                self._fdb.execute("PRAGMA shrink_memory;")
+                return
+        except Exception as e:
+            self.logger.warning("SQLite: problem vacuum database: {}".format(e))
+            return
+        finally:
+            self._fdb_lock.release()
+        while self.connected:
+            if not self._fdb_lock.acquire(timeout=10):
+                return
+            try:
+                self._fdb.execute("PRAGMA incremental_vacuum({0});".format(self._pack_vacuum_pages)).fetchall()
+                free = self._fdb.execute("PRAGMA freelist_count;").fetchone()[0]
+                if free == 0:
+                    self._fdb.execute("PRAGMA shrink_memory;")
+            except Exception as e:
+                self.logger.warning("SQLite: problem vacuum database: {}".format(e))
+                free = 0
+            finally:
+                self._fdb_lock.release()
+            if free == 0:
+                break
 
     def __pack(self, gtime, gavg, gpower, end):
         asum = 0.0
@@ -324,12 +445,11 @@ class SQL(SmartPlugin):
             sid = item + '|' + func + '|' + start + '|' + end
         istart = self._get_timestamp(start)
         iend = self._get_timestamp(end)
-        prev = self._fetchone("SELECT time from history WHERE item='{0}' AND time <= {1} ORDER BY time DESC LIMIT 1".format(item, istart))
+        prev = self._fetchone(self._prev_query, {'item': item, 'time': istart})
         if not prev:
             first = istart
         else:
             first = prev[0]
-        where = " from history WHERE item='{0}' AND time >= {1} AND time <= {2}".format(item, first, iend)
         if step is None:
             if count != 0:
                 step = (iend - istart) / count
@@ -338,18 +458,9 @@ class SQL(SmartPlugin):
         reply = {'cmd': 'series', 'series': None, 'sid': sid}
         reply['params'] = {'update': True, 'item': item, 'func': func, 'start': iend, 'end': end, 'step': step, 'sid': sid}
         reply['update'] = self._sh.now() + datetime.timedelta(seconds=int(step / 1000))
-        where += " GROUP by CAST((time / {0}) AS INTEGER)".format(step)
-        if func == 'avg':
-            query = "SELECT CAST(AVG(time) AS INTEGER), ROUND(AVG(avg), 2)" + where + " ORDER BY time DESC"
-        elif func == 'min':
-            query = "SELECT CAST(AVG(time) AS INTEGER), MIN(vmin)" + where
-        elif func == 'max':
-            query = "SELECT CAST(AVG(time) AS INTEGER), MAX(vmax)" + where
-        elif func == 'on':
-            query = "SELECT CAST(AVG(time) AS INTEGER), ROUND(AVG(power), 2)" + where + " ORDER BY time DESC"
-        else:
+        if func not in self._series_queries:
             raise NotImplementedError
-        tuples = self._fetchall(query)
+        tuples = self._fetchall(self._series_queries[func], {'item': item, 'start': first, 'end': iend, 'step': step})
         if not tuples:
             if not update:
                 reply['series'] = [(iend, 0)]
@@ -366,24 +477,15 @@ class SQL(SmartPlugin):
     def _single(self, func, start, end='now', item=None):
         start = self._get_timestamp(start)
         end = self._get_timestamp(end)
-        prev = self._fetchone("SELECT time from history WHERE item = '{0}' AND time <= {1} ORDER BY time DESC LIMIT 1".format(item, start))
+        prev = self._fetchone(self._prev_query, {'item': item, 'time': start})
         if prev is None:
             first = start
         else:
             first = prev[0]
-        where = " from history WHERE item='{0}' AND time >= {1} AND time < {2}".format(item, first, end)
-        if func == 'avg':
-            query = "SELECT AVG(avg)" + where
-        elif func == 'min':
-            query = "SELECT MIN(vmin)" + where
-        elif func == 'max':
-            query = "SELECT MAX(vmax)" + where
-        elif func == 'on':
-            query = "SELECT AVG(power)" + where
-        else:
+        if func not in self._single_queries:
             self.logger.warning("Unknown export function: {0}".format(func))
             return
-        tuples = self._fetchall(query)
+        tuples = self._fetchall(self._single_queries[func], {'item': item, 'start': first, 'end': end})
         if tuples is None:
             return
         return tuples[0][0]
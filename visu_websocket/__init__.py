@@ -22,7 +22,11 @@
 #  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import asyncio
 import base64
+import collections
+import concurrent.futures
+import copy
 import datetime
 import decimal
 import hashlib
@@ -32,11 +36,57 @@ import struct
 import ssl
 import struct
 import threading
+import time
+import zlib
 
 import lib.connection
 from lib.model.smartplugin import SmartPlugin
 
 
+DEFLATE_LEVEL = 6
+DEFLATE_MIN_SIZE = 256      # smaller messages are sent uncompressed
+
+
+def rfc6455_unmask(key, payload):
+    """
+    xors the payload with the 4 byte masking key using one big integer operation instead of a loop per byte
+    """
+    length = len(payload)
+    if length == 0:
+        return b''
+    mask = (bytes(key) * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(length, 'big')
+
+
+def rfc6455_frame(payload, opcode=1, rsv1=False):
+    """
+    returns a final, unmasked frame as sent by the server
+    """
+    first = 0x80 | opcode
+    if rsv1:
+        first |= 0x40
+    length = len(payload)
+    if length < 126:
+        header = bytes([first, length])
+    elif length < (1 << 16):
+        header = bytes([first, 126]) + length.to_bytes(2, byteorder='big')
+    else:
+        header = bytes([first, 127]) + length.to_bytes(8, byteorder='big')
+    return header + payload
+
+
+def rfc7692_deflate(compressor, payload):
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    # the empty stored block of the sync flush is removed, the receiver appends it again
+    if data.endswith(b'\x00\x00\xff\xff'):
+        data = data[:-4]
+    return data
+
+
+def rfc7692_inflate(decompressor, payload):
+    return decompressor.decompress(payload + b'\x00\x00\xff\xff')
+
+
 #########################################################################
 
 class WebSocket(SmartPlugin):
@@ -55,7 +105,7 @@ class WebSocket(SmartPlugin):
         return result
 
 
-    def __init__(self, smarthome, ip='0.0.0.0', port=2424, tls='no', acl='ro', wsproto='3' ):
+    def __init__(self, smarthome, ip='0.0.0.0', port=2424, tls='no', acl='ro', wsproto='3', series_cache=100, series_cache_ttl=60, send_window=50, send_backlog=64, server='connection', series_workers=4 ):
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
 
@@ -85,12 +135,36 @@ class WebSocket(SmartPlugin):
             proto = 3
             self.logger.error("WebSocket: Invalid value '"+str(wsproto)+"' configured for attribute wsproto in plugin.conf, using '"+str(proto)+"' instead")
 
-        self.websocket = _websocket(smarthome, ip, port, self.tls, proto)
+        if not self.is_int(series_cache):
+            self.logger.error("WebSocket: Invalid value '"+str(series_cache)+"' configured for attribute series_cache in plugin.conf, using '100' instead")
+            series_cache = 100
+        if not self.is_int(series_cache_ttl):
+            self.logger.error("WebSocket: Invalid value '"+str(series_cache_ttl)+"' configured for attribute series_cache_ttl in plugin.conf, using '60' instead")
+            series_cache_ttl = 60
+
+        if not self.is_int(send_window):
+            self.logger.error("WebSocket: Invalid value '"+str(send_window)+"' configured for attribute send_window in plugin.conf, using '50' instead")
+            send_window = 50
+        if not self.is_int(send_backlog):
+            self.logger.error("WebSocket: Invalid value '"+str(send_backlog)+"' configured for attribute send_backlog in plugin.conf, using '64' instead")
+            send_backlog = 64
+
+        if not self.is_int(series_workers):
+            self.logger.error("WebSocket: Invalid value '"+str(series_workers)+"' configured for attribute series_workers in plugin.conf, using '4' instead")
+            series_workers = 4
+
+        if str(server).lower() == 'asyncio':
+            self.websocket = _asyncwebsocket(smarthome, ip, self.port, self.tls, proto, int(series_cache), int(series_cache_ttl), int(send_window), int(send_backlog), int(series_workers))
+        else:
+            if str(server).lower() != 'connection':
+                self.logger.error("WebSocket: Invalid value '"+str(server)+"' configured for attribute server in plugin.conf, using 'connection' instead")
+            self.websocket = _websocket(smarthome, ip, port, self.tls, proto, int(series_cache), int(series_cache_ttl), int(send_window), int(send_backlog))
         
 
     def run(self):
         self.alive = True
         self._sh.scheduler.add('series', self.websocket._update_series, cycle=10, prio=5)
+        self.websocket.start()
 
 
     def stop(self):
@@ -154,8 +228,14 @@ class _websocket(lib.connection.Server):
     Websocket specific class of the Plugin. Handles the websocket connections
     """
 
-    def __init__(self, smarthome, ip, port, tls, wsproto ):
+    def __init__(self, smarthome, ip, port, tls, wsproto, series_cache=100, series_cache_ttl=60, send_window=50, send_backlog=64 ):
         lib.connection.Server.__init__(self, ip, port)
+        self._setup(smarthome, tls, wsproto, series_cache, series_cache_ttl, send_window, send_backlog)
+
+    def _setup(self, smarthome, tls, wsproto, series_cache, series_cache_ttl, send_window, send_backlog):
+        """
+        initializes the state shared by the lib.connection and the asyncio server
+        """
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
         self.tls = tls
@@ -165,6 +245,25 @@ class _websocket(lib.connection.Server):
         self.visu_items = {}
         self.visu_logics = {}
 
+        # cache of series replies: key -> (expires, reply), shared by all clients
+        self._series_cache = collections.OrderedDict()
+        self._series_cache_items = {}
+        self._series_cache_lock = threading.Lock()
+        self._series_cache_size = series_cache
+        self._series_cache_ttl = datetime.timedelta(seconds=series_cache_ttl)
+
+        # series updates: sid -> {'update': datetime, 'params': dict, 'clients': {client: last timestamp sent}}
+        self._series_subs = {}
+        self._series_subs_lock = threading.Lock()
+
+        # item updates are queued per client and sent every send_window milliseconds as one frame
+        self._send_window = send_window / 1000.0
+        self._send_backlog = send_backlog
+        self._send_cond = threading.Condition()
+        self._send_pending = False
+        self._send_thread = None
+        self._running = False
+
         self.tls_crt = '/usr/local/smarthome/etc/home.crt'
         self.tls_key = '/usr/local/smarthome/etc/home.key'
         self.tls_ca = '/usr/local/smarthome/etc/ca.crt'
@@ -192,7 +291,18 @@ class _websocket(lib.connection.Server):
         client = websockethandler(self._sh, self, sock, address, self.visu_items, self.visu_logics, self.proto)
         self.clients.append(client)
 
+    def start(self):
+        self._running = True
+        if self._send_window > 0:
+            self._send_thread = threading.Thread(target=self._send_updates, name='visu_websocket send')
+            self._send_thread.daemon = True
+            self._send_thread.start()
+
     def stop(self):
+        self._running = False
+        self._send_cond.acquire()
+        self._send_cond.notify()
+        self._send_cond.release()
         for client in self.clients:
             try:
                 client.close()
@@ -201,16 +311,66 @@ class _websocket(lib.connection.Server):
         self.close()
 
     def update_item(self, item_name, item_value, source):
-        data = {'cmd': 'item', 'items': [[item_name, item_value]]}
-#        self.logger.warning("_websocket: update_item: data {0}".format(data))
-        for client in list(self.clients):
+        self._series_append(item_name, item_value)
+        # serialized once, the clients only join the fragments into their frames
+        try:
+            fragment = json.dumps([item_name, item_value], cls=JSONEncoder, separators=(',', ':'))
+        except Exception as e:
+            self.logger.warning("_websocket / update_item: cannot serialize value of item {0}, error {1}".format(item_name, e))
+            return
+#        self.logger.warning("_websocket: update_item: data {0}".format(fragment))
+        if self._send_thread is None:
+            for client in list(self.clients):
+                try:
+                    if client.queue_update(item_name, fragment, source):
+                        client.send_updates()
+                except:
+                    pass
+            return
+        self._send_cond.acquire()
+        try:
+            for client in list(self.clients):
+                try:
+                    if client.queue_update(item_name, fragment, source):
+                        self._send_pending = True
+                except:
+                    pass
+            if self._send_pending:
+                self._send_cond.notify()
+        finally:
+            self._send_cond.release()
+
+    def _send_updates(self):
+        """
+        Sends the queued item updates of all clients, each client gets at most one
+        frame per send_window. Clients which still have more than send_backlog frames
+        in their output buffer are skipped, their updates keep being coalesced to the
+        latest value per item until they caught up.
+        """
+        while self._running:
+            self._send_cond.acquire()
             try:
-                client.update(item_name, data, source)
-            except:
-                pass
+                while self._running and not self._send_pending:
+                    self._send_cond.wait()
+                self._send_pending = False
+            finally:
+                self._send_cond.release()
+            # collect the updates arriving during the window
+            time.sleep(self._send_window)
+            for client in list(self.clients):
+                try:
+                    if client.backlog() > self._send_backlog:
+                        self._send_cond.acquire()
+                        self._send_pending = True
+                        self._send_cond.release()
+                        continue
+                    client.send_updates()
+                except Exception as e:
+                    self.logger.debug("_websocket / _send_updates: cannot update client {0}, error {1}".format(client.addr, e))
 
     def remove_client(self, client):
         self.clients.remove(client)
+        self.series_unsubscribe(client)
 
 
     def _send_event(self, event, data):
@@ -220,13 +380,145 @@ class _websocket(lib.connection.Server):
             except:
                 pass
 
+    def series_subscribe(self, client, reply):
+        """
+        registers a client for the updates of a series, clients requesting the same
+        series share one subscription
+        :param reply: the initial series reply sent to the client
+        """
+        sid = reply['sid']
+        last = reply['series'][-1][0] if reply['series'] else None
+        self._series_subs_lock.acquire()
+        try:
+            sub = self._series_subs.get(sid)
+            if sub is None:
+                sub = self._series_subs[sid] = {'update': reply['update'], 'params': reply['params'], 'clients': {}}
+            sub['clients'][client] = last
+        finally:
+            self._series_subs_lock.release()
+
+    def series_unsubscribe(self, client):
+        self._series_subs_lock.acquire()
+        try:
+            for sid, sub in list(self._series_subs.items()):
+                sub['clients'].pop(client, None)
+                if not sub['clients']:
+                    del(self._series_subs[sid])
+        finally:
+            self._series_subs_lock.release()
+
     def _update_series(self):
-        for client in list(self.clients):
+        """
+        queries every due series once and sends each subscribed client the points
+        newer than the last point it received
+        """
+        now = self._sh.now()
+        self._series_subs_lock.acquire()
+        due = [(sid, sub) for sid, sub in self._series_subs.items() if sub['update'] < now]
+        self._series_subs_lock.release()
+        for sid, sub in due:
             try:
-                client.update_series()
+                params = dict(sub['params'])
+                reply = self.series(params.pop('item'), **params)
             except Exception as e:
-                self.logger.warning("_websocket / _update_series: cannot update client {0}, error {1}".format(client, e))
-                pass
+                self.logger.exception("Problem updating series for {0}: {1}".format(sub['params'], e))
+                self._series_subs_lock.acquire()
+                self._series_subs.pop(sid, None)
+                self._series_subs_lock.release()
+                continue
+            try:
+                points = reply['series'] or []
+                update, params = reply['update'], reply['params']
+            except (KeyError, TypeError) as e:
+                self.logger.warning("Invalid series update for {0}: {1}".format(sub['params'], reply))
+                continue
+            self._series_subs_lock.acquire()
+            sub['update'] = update
+            sub['params'] = params
+            send = []
+            for client, last in sub['clients'].items():
+                new = [point for point in points if last is None or point[0] > last]
+                if new:
+                    sub['clients'][client] = new[-1][0]
+                    send.append((client, new))
+            self._series_subs_lock.release()
+            for client, new in send:
+                try:
+                    client.json_send({'cmd': 'series', 'series': new, 'sid': sid})
+                except Exception as e:
+                    self.logger.warning("_websocket / _update_series: cannot update client {0}, error {1}".format(client.addr, e))
+
+    def series(self, path, func, start, end='now', count=100, **params):
+        """
+        Returns the series reply of the item's storage plugin. Replies are
+        cached by the normalized query until the next update is due (at most
+        series_cache_ttl), so identical requests of several clients only query
+        the storage plugin once. Every caller gets its own copy of the reply.
+        """
+        item = self.visu_items[path]['item']
+        if self._series_cache_size <= 0:
+            return item.series(func, start, end, count, **params)
+        key = (path, func, str(start), str(end), str(count), str(params.get('step')), bool(params.get('update')), params.get('sid'))
+        now = self._sh.now()
+        self._series_cache_lock.acquire()
+        try:
+            if key in self._series_cache:
+                expires, reply = self._series_cache[key]
+                if expires > now:
+                    self._series_cache.move_to_end(key)
+                    return copy.deepcopy(reply)
+                self._series_remove(key)
+        finally:
+            self._series_cache_lock.release()
+
+        reply = item.series(func, start, end, count, **params)
+        if not isinstance(reply, dict):
+            return reply
+        expires = now + self._series_cache_ttl
+        if 'update' in reply and reply['update'] < expires:
+            expires = reply['update']
+
+        self._series_cache_lock.acquire()
+        try:
+            self._series_cache[key] = (expires, reply)
+            self._series_cache_items.setdefault(path, set()).add(key)
+            while len(self._series_cache) > self._series_cache_size:
+                self._series_remove(next(iter(self._series_cache)))
+        finally:
+            self._series_cache_lock.release()
+        return copy.deepcopy(reply)
+
+    def _series_remove(self, key):
+        del(self._series_cache[key])
+        keys = self._series_cache_items.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del(self._series_cache_items[key[0]])
+
+    def _series_append(self, path, value):
+        """
+        adds the changed item value as point to the cached raw series of the item ending now while
+        they are below their count, other series ending now are dropped as their points are aggregates,
+        series ending before are not affected by the change
+        """
+        if path not in self._series_cache_items:
+            return
+        point = None
+        if isinstance(value, (bool, int, float, decimal.Decimal)):
+            point = (int(self._sh.now().timestamp() * 1000), float(value))
+        self._series_cache_lock.acquire()
+        try:
+            for key in list(self._series_cache_items.get(path, [])):
+                if key[3] != 'now':
+                    continue
+                expires, reply = self._series_cache[key]
+                if point is not None and key[1] == 'raw' and isinstance(reply.get('series'), list) and key[4].isdigit() and len(reply['series']) < int(key[4]):
+                    reply['series'].append(point)
+                else:
+                    self._series_remove(key)
+        finally:
+            self._series_cache_lock.release()
 
     def dialog(self, header, content):
         for client in list(self.clients):
@@ -255,6 +547,12 @@ class websockethandler(lib.connection.Stream):
 
     def __init__(self, smarthome, dispatcher, sock, addr, items, logics, proto=4):
         lib.connection.Stream.__init__(self, sock, addr)
+        self._setup(smarthome, dispatcher, addr, items, logics, proto)
+
+    def _setup(self, smarthome, dispatcher, addr, items, logics, proto):
+        """
+        initializes the protocol state shared by the lib.connection and the asyncio handler
+        """
         self.terminator = b"\r\n\r\n"
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
@@ -262,14 +560,21 @@ class websockethandler(lib.connection.Stream):
         self.found_terminator = self.parse_header
         self.addr = addr
         self.header = {}
-        self.monitor = {'item': [], 'rrd': [], 'log': []}
+        self.monitor = {'item': set(), 'rrd': set(), 'log': set()}
+        self._updates = collections.OrderedDict()  # item path: serialized [path, value] waiting to be sent
+        self._updates_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._fragments = None          # payloads of a fragmented message received so far
+        self._compressed = False
+        self._deflate = None            # permessage-deflate compressor and decompressor, if negotiated
+        self._deflate_wbits = 15
+        self._deflate_no_context = False
+        self._inflate = None
         self.monitor_id = {'item': 'item', 'rrd': 'item', 'log': 'name'}
-        self._update_series = {}
         self.items = items
         self.rrd = False
         self.log = False
         self.logs = smarthome.return_logs()
-        self._series_lock = threading.Lock()
         self.logics = logics
         self.proto = proto
         self.logger.info("VISU: Websocket handler uses protocol version {0}".format(self.proto))
@@ -292,41 +597,46 @@ class websockethandler(lib.connection.Stream):
     def json_send(self, data):
         self.logger.debug("Visu: DUMMY send to {0}: {1}".format(self.addr, data))
 
+    def text_send(self, data):
+        self.logger.debug("Visu: DUMMY send to {0}: {1}".format(self.addr, data))
+
     def handle_close(self):
         # remove circular references
         self._dp.remove_client(self)
         try:
-            del(self.json_send, self.found_terminator)
+            del(self.json_send, self.text_send, self.found_terminator)
         except:
             pass
 
-    def update(self, path, data, source):
-        if path in self.monitor['item']:
-            if self.addr != source:
-#                self.logger.warning("VISU: update send to {0}: {1}, path={2}, source={3}".format(self.addr, data, path, source))
-                self.json_send(data)
-
-    def update_series(self):
-        now = self._sh.now()
-        self._series_lock.acquire()
-        remove = []
-        for sid, series in self._update_series.items():
-            if series['update'] < now:
-                try:
-                    reply = self.items[series['params']['item']]['item'].series(**series['params'])
-                except Exception as e:
-                    self.logger.exception("Problem updating series for {0}: {1}".format(series['params'], e))
-                    remove.append(sid)
-                    continue
-                self._update_series[reply['sid']] = {'update': reply['update'], 'params': reply['params']}
-                del(reply['update'])
-                del(reply['params'])
-                if reply['series'] is not None:
-#                    self.logger.warning("Visu: update send to {0}: {1}".format(self.addr, reply))
-                    self.json_send(reply)
-        for sid in remove:
-            del(self._update_series[sid])
-        self._series_lock.release()
+    def queue_update(self, path, fragment, source):
+        """
+        queues the serialized update of a monitored item, an update still waiting
+        for the same item is replaced
+        :return: True if the update was queued
+        """
+        if path not in self.monitor['item'] or self.addr == source:
+            return False
+        self._updates_lock.acquire()
+        self._updates[path] = fragment
+        self._updates_lock.release()
+        return True
+
+    def send_updates(self):
+        """
+        sends all queued item updates in one {'cmd': 'item', 'items': [...]} frame
+        """
+        self._updates_lock.acquire()
+        updates = self._updates
+        self._updates = collections.OrderedDict()
+        self._updates_lock.release()
+        if updates:
+            self.text_send('{"cmd":"item","items":[' + ','.join(updates.values()) + ']}')
+
+    def backlog(self):
+        """
+        number of frames in the output buffer which are not yet sent to the client
+        """
+        return len(self.outbuffer)
 
     def difference(self, a, b):
         return list(set(b).difference(set(a)))
@@ -338,6 +648,9 @@ class websockethandler(lib.connection.Stream):
         except Exception as e:
             self.logger.debug("Problem decoding {0} from {1}: {2}".format(repr(data), self.addr, e))
             return
+        self.json_command(data)
+
+    def json_command(self, data):
         command = data['cmd']
         if command == 'item':
             path = data['id']
@@ -360,7 +673,7 @@ class websockethandler(lib.connection.Stream):
                     self.logger.warning("Client {0} requested invalid item: {1}".format(self.addr, path))
             self.logger.debug("VISU json_parse: send to {0}: {1}".format(self.addr, ({'cmd': 'item', 'items': items})))	# MSinn
             self.json_send({'cmd': 'item', 'items': items})
-            self.monitor['item'] = data['items']
+            self.monitor['item'] = set(data['items'])
         elif command == 'ping':
             self.logger.debug("VISU json_parse: send to {0}: {1}".format(self.addr, ({'cmd': 'pong'})))
             self.json_send({'cmd': 'pong'})
@@ -398,15 +711,13 @@ class websockethandler(lib.connection.Stream):
             if path in self.items:
                 if hasattr(self.items[path]['item'], 'series'):
                     try:
-                        reply = self.items[path]['item'].series(series, start, end, count)
+                        reply = self._dp.series(path, series, start, end, count)
 #                        self.logger.warning("VISU json_parse: send to {0}: {1}".format(self.addr, reply))	# MSinn
                     except Exception as e:
                         self.logger.error("Problem fetching series for {0}: {1} - Wrong sqlite plugin?".format(path, e))
                     else:
                         if 'update' in reply:
-                            self._series_lock.acquire()
-                            self._update_series[reply['sid']] = {'update': reply['update'], 'params': reply['params']}
-                            self._series_lock.release()
+                            self._dp.series_subscribe(self, reply)
                             del(reply['update'])
                             del(reply['params'])
                         if reply['series'] is not None:
@@ -425,8 +736,7 @@ class websockethandler(lib.connection.Stream):
                 self.json_send({'cmd': 'log', 'name': name, 'log': self.logs[name].export(num), 'init': 'y'})
             else:
                 self.logger.warning("Client {0} requested invalid log: {1}".format(self.addr, name))
-            if name not in self.monitor['log']:
-                self.monitor['log'].append(name)
+            self.monitor['log'].add(name)
         elif command == 'proto':  # protocol version
             proto = data['ver']
             if proto > self.proto:
@@ -471,74 +781,144 @@ class websockethandler(lib.connection.Stream):
 
     def rfc6455_handshake(self):
         self.logger.debug("rfc6455 Handshake")
-        self.terminator = 8
+        self.terminator = 2
         self.found_terminator = self.rfc6455_parse
         self.json_send = self.rfc6455_send
+        self.text_send = self.rfc6455_send_text
         key = self.header[b'Sec-WebSocket-Key'] + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
         key = base64.b64encode(hashlib.sha1(key).digest()).decode()
         self.send('HTTP/1.1 101 Switching Protocols\r\n'.encode())
         self.send('Upgrade: websocket\r\n'.encode())
         self.send('Connection: Upgrade\r\n'.encode())
         self.send('Sec-WebSocket-Accept: {0}\r\n'.format(key).encode())
+        deflate = self.rfc7692_negotiate()
+        if deflate is not None:
+            response, wbits, no_context = deflate
+            self.logger.debug("WebSocket: permessage-deflate for {0}: {1}".format(self.addr, response))
+            self._deflate_wbits = wbits
+            self._deflate_no_context = no_context
+            self._deflate = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -wbits)
+            self._inflate = zlib.decompressobj(-15)
+            self.send('Sec-WebSocket-Extensions: {0}\r\n'.format(response).encode())
         self.send('\r\n'.encode())
 
+    def rfc7692_negotiate(self):
+        """
+        picks the first permessage-deflate offer of the client we can accept
+        :return: (response header, server window bits, server_no_context_takeover) or None
+        """
+        extensions = self.header.get(b'Sec-WebSocket-Extensions')
+        if not extensions:
+            return None
+        for offer in extensions.decode(errors='replace').split(','):
+            params = [param.strip() for param in offer.split(';')]
+            if params[0] != 'permessage-deflate':
+                continue
+            response = ['permessage-deflate']
+            wbits = 15
+            no_context = False
+            for param in params[1:]:
+                name, _, value = param.partition('=')
+                name = name.strip()
+                value = value.strip().strip('"')
+                if name == 'server_no_context_takeover':
+                    no_context = True
+                    response.append(name)
+                elif name == 'server_max_window_bits':
+                    # zlib does not support raw deflate with a 256 byte window
+                    if not value.isdigit() or not 9 <= int(value) <= 15:
+                        break
+                    wbits = int(value)
+                    response.append('{0}={1}'.format(name, wbits))
+                elif name in ('client_no_context_takeover', 'client_max_window_bits'):
+                    # messages of the client are inflated with the maximum window which fits every window size
+                    pass
+                else:
+                    break
+            else:
+                return '; '.join(response), wbits, no_context
+        return None
+
     def rfc6455_parse(self, data):
-        # fin = bit_set(data[0], 7)
-        # rsv1 = bit_set(data[0], 6)
-        # rsv2 = bit_set(data[0], 5)
-        # rsv1 = bit_set(data[0], 4)
+        fin = data[0] & 0x80
+        rsv1 = data[0] & 0x40   # compressed message (permessage-deflate)
         opcode = data[0] & 0x0f
-        if opcode == 8:
-            self.logger.debug("WebSocket: closing connection to {0}.".format(self.addr))
-            self.close()
-            return
+        masked = data[1] & 0x80
+        length = data[1] & 0x7f
         header = 2
-        masked = self.bit_set(data[1], 7)
+        if length == 126:
+            header += 2
+        elif length == 127:
+            header += 8
         if masked:
             header += 4
-        length = data[1] & 0x7f
+        if len(data) < header:  # header too short, read more
+            self.inbuffer = data + self.inbuffer
+            self.terminator = header
+            return
         if length == 126:
-            header += 2
             length = int.from_bytes(data[2:4], byteorder='big')
         elif length == 127:
-            header += 8
             length = int.from_bytes(data[2:10], byteorder='big')
         read = header + length
         if len(data) < read:  # data too short, read more
             self.inbuffer = data + self.inbuffer
             self.terminator = read
             return
+        self.terminator = 2
+        payload = bytes(data[header:read])
         if masked:
-            key = data[header - 4:header]
-            payload = bytearray(data[header:])
-            for i in range(length):
-                payload[i] ^= key[i % 4]
+            payload = rfc6455_unmask(data[header - 4:header], payload)
+
+        if opcode == 8:
+            self.logger.debug("WebSocket: closing connection to {0}.".format(self.addr))
+            self.close()
+            return
+        elif opcode == 9:  # ping
+            self.rfc6455_send_frame(payload, 10)
+            return
+        elif opcode == 10:  # pong
+            return
+        elif opcode == 0:  # continuation
+            if self._fragments is None:
+                self.logger.debug("WebSocket: continuation frame without a message from {0}".format(self.addr))
+                return
+            self._fragments.append(payload)
         else:
-            payload = data[header:]
+            self._fragments = [payload]
+            self._compressed = rsv1 and self._inflate is not None
+        if not fin:
+            return
+        payload = b''.join(self._fragments)
+        self._fragments = None
+        if self._compressed:
+            payload = rfc7692_inflate(self._inflate, payload)
         self.json_parse(payload.decode())
-        self.terminator = 8
 
     def rfc6455_send(self, data):
-        data = json.dumps(data, cls=JSONEncoder, separators=(',', ':'))
-        header = bytearray(2)
-        header[0] = self.set_bit(header[0], 0)  # opcode text
-        header[0] = self.set_bit(header[0], 7)  # final
-        length = len(data)
-        if length < 126:
-            header[1] = length
-        elif length < ((1 << 16) - 1):
-            header[1] = 126
-            header += bytearray(length.to_bytes(2, byteorder='big'))
-        elif length < ((1 << 64) - 1):
-            header[1] = 127
-            header += bytearray(length.to_bytes(8, byteorder='big'))
-        else:
-            self.logger.warning("data to big: {0}".format(data))
-            return
-        self.send(header + data.encode())
+        self.rfc6455_send_text(json.dumps(data, cls=JSONEncoder, separators=(',', ':')))
+
+    def rfc6455_send_text(self, data):
+        self.rfc6455_send_frame(data.encode())
+
+    def rfc6455_send_frame(self, payload, opcode=1):
+        # compressing with context takeover requires the frames to be sent in the order they are compressed
+        self._send_lock.acquire()
+        try:
+            rsv1 = False
+            if self._deflate is not None and opcode == 1 and len(payload) >= DEFLATE_MIN_SIZE:
+                if self._deflate_no_context:
+                    self._deflate = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -self._deflate_wbits)
+                payload = rfc7692_deflate(self._deflate, payload)
+                rsv1 = True
+            self.send(rfc6455_frame(payload, opcode, rsv1))
+        finally:
+            self._send_lock.release()
 
     def hixie76_send(self, data):
-        data = json.dumps(data, cls=JSONEncoder, separators=(',', ':'))
+        self.hixie76_send_text(json.dumps(data, cls=JSONEncoder, separators=(',', ':')))
+
+    def hixie76_send_text(self, data):
         packet = bytearray()
         packet.append(0x00)
         packet.extend(data.encode())
@@ -568,9 +948,148 @@ class websockethandler(lib.connection.Stream):
         self.send(key.digest())
         self.found_terminator = self.hixie76_parse
         self.json_send = self.hixie76_send
+        self.text_send = self.hixie76_send_text
         self.terminator = b"\xff"
 
 
+#########################################################################
+
+class _asyncwebsocket(_websocket):
+    """
+    Websocket server running on its own asyncio event loop instead of the select loop of
+    lib.connection, series queries are run in a thread pool
+    """
+
+    def __init__(self, smarthome, ip, port, tls, wsproto, series_cache=100, series_cache_ttl=60, send_window=50, send_backlog=64, series_workers=4 ):
+        self._setup(smarthome, tls, wsproto, series_cache, series_cache_ttl, send_window, send_backlog)
+        self._ip = ip
+        self._port = port
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._loop_thread = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, series_workers))
+
+    def start(self):
+        _websocket.start(self)
+        self._loop_thread = threading.Thread(target=self._run_loop, name='visu_websocket asyncio')
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        context = None
+        if self.tls:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+            context.verify_mode = ssl.CERT_OPTIONAL
+            context.load_cert_chain(self.tls_crt, self.tls_key)
+            context.load_verify_locations(self.tls_ca)
+        try:
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle_connection, self._ip, self._port, ssl=context))
+        except Exception as e:
+            self.logger.error("WebSocket: cannot listen on {0}:{1}: {2}".format(self._ip, self._port, e))
+            return
+        self.logger.debug("WebSocket: asyncio server listening on {0}:{1}".format(self._ip, self._port))
+        self._loop.run_forever()
+        self._server.close()
+        self._loop.run_until_complete(self._server.wait_closed())
+        self._loop.close()
+
+    async def _handle_connection(self, reader, writer):
+        client = asynchandler(self._sh, self, reader, writer, self.visu_items, self.visu_logics, self.proto, self._loop, self._executor)
+        self.clients.append(client)
+        await client.run()
+
+    def stop(self):
+        self._running = False
+        self._send_cond.acquire()
+        self._send_cond.notify()
+        self._send_cond.release()
+        for client in list(self.clients):
+            try:
+                client.close()
+            except:
+                pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._executor.shutdown(wait=False)
+
+
+class asynchandler(websockethandler):
+    """
+    Websocket handler for the asyncio server. Received data is split at the terminators
+    like lib.connection.Stream does, so the handshake and framing of websockethandler are reused.
+    """
+
+    # buffered output is counted in blocks of this size to compare it with send_backlog
+    BACKLOG_BLOCK = 4096
+
+    def __init__(self, smarthome, dispatcher, reader, writer, items, logics, proto, loop, executor):
+        self._reader = reader
+        self._writer = writer
+        self._loop = loop
+        self._executor = executor
+        self._closed = False
+        self.inbuffer = bytearray()
+        peer = writer.get_extra_info('peername')
+        self._setup(smarthome, dispatcher, '{0}:{1}'.format(peer[0], peer[1]), items, logics, proto)
+
+    async def run(self):
+        try:
+            while not self._closed:
+                data = await self._reader.read(4096)
+                if not data:
+                    break
+                self.inbuffer.extend(data)
+                self._process()
+        except (ConnectionError, OSError) as e:
+            self.logger.debug("WebSocket: connection to {0} lost: {1}".format(self.addr, e))
+        finally:
+            self._closed = True
+            self.handle_close()
+            self._writer.close()
+
+    def _process(self):
+        while not self._closed:
+            terminator = self.terminator
+            if isinstance(terminator, int):
+                if len(self.inbuffer) < terminator:
+                    return
+                data = self.inbuffer[:terminator]
+                del self.inbuffer[:terminator]
+            else:
+                index = self.inbuffer.find(terminator)
+                if index == -1:
+                    return
+                data = self.inbuffer[:index]
+                del self.inbuffer[:index + len(terminator)]
+            self.found_terminator(data)
+
+    def send(self, data):
+        # called from the loop, the send thread and scheduler threads, writes always happen in the loop
+        if not self._closed:
+            self._loop.call_soon_threadsafe(self._writer.write, bytes(data))
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._loop.call_soon_threadsafe(self._writer.close)
+
+    def backlog(self):
+        return self._writer.transport.get_write_buffer_size() // self.BACKLOG_BLOCK
+
+    def json_command(self, data):
+        # series queries may take seconds, they must not block the event loop
+        if data.get('cmd') == 'series':
+            self._loop.run_in_executor(self._executor, self._series_command, data)
+        else:
+            websockethandler.json_command(self, data)
+
+    def _series_command(self, data):
+        try:
+            websockethandler.json_command(self, data)
+        except Exception as e:
+            self.logger.exception("WebSocket: series request of {0} failed: {1}".format(self.addr, e))
+
+
 #########################################################################
 
 class JSONEncoder(json.JSONEncoder):
@@ -0,0 +1,58 @@
+"""
+Throughput of the rfc6455 frame encoding/decoding and the permessage-deflate compression, run with
+
+    python -m pytest plugins/visu_websocket/tests/test_frame_benchmark.py --benchmark-columns=min,mean,ops
+
+Skipped if pytest-benchmark is not installed.
+"""
+import json
+import os
+import zlib
+
+import pytest
+
+from plugins.visu_websocket import DEFLATE_LEVEL, rfc6455_frame, rfc6455_unmask, rfc7692_deflate, rfc7692_inflate
+
+pytest.importorskip('pytest_benchmark')
+
+# a small item update and a series reply with 2000 points
+MESSAGES = {
+    'item': json.dumps({'cmd': 'item', 'items': [['living_room.temperature', 21.5]]}, separators=(',', ':')).encode(),
+    'series': json.dumps({'cmd': 'series', 'sid': 'living_room.temperature|avg|1d|now|100',
+                          'series': [[1500000000000 + i * 60000, 20 + (i % 50) / 10] for i in range(2000)]},
+                         separators=(',', ':')).encode(),
+}
+
+
+@pytest.mark.parametrize('message', sorted(MESSAGES))
+def test_frame(benchmark, message):
+    payload = MESSAGES[message]
+    benchmark.group = 'frame'
+    frame = benchmark(rfc6455_frame, payload)
+    assert frame.endswith(payload)
+
+
+@pytest.mark.parametrize('message', sorted(MESSAGES))
+def test_unmask(benchmark, message):
+    payload = MESSAGES[message]
+    key = os.urandom(4)
+    masked = rfc6455_unmask(key, payload)
+    benchmark.group = 'unmask'
+    assert benchmark(rfc6455_unmask, key, masked) == payload
+
+
+@pytest.mark.parametrize('message', sorted(MESSAGES))
+def test_deflate(benchmark, message):
+    payload = MESSAGES[message]
+    compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15)
+    benchmark.group = 'deflate'
+    benchmark(rfc7692_deflate, compressor, payload)
+
+
+@pytest.mark.parametrize('message', sorted(MESSAGES))
+def test_inflate(benchmark, message):
+    payload = MESSAGES[message]
+    deflated = rfc7692_deflate(zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15), payload)
+    benchmark.group = 'inflate'
+    # every round inflates the same message with a fresh decompressor, as sent without context takeover
+    assert benchmark(lambda: rfc7692_inflate(zlib.decompressobj(-15), deflated)) == payload